@@ -1,3 +1,11 @@
 class BaseCleaner:
+    # Keys of the line that clean (or keep) reads and that are not columns of its table
+    input_keys: tuple[str, ...] = ()
+    # True if clean never changes the line and only decides if it is kept, keep is then used instead of clean
+    filter_only = False
+
+    def keep(self, line) -> bool:
+        return True
+
     def clean(self, line, primary_key: list[str]):
         return line
@@ -0,0 +1,158 @@
+import os
+import threading
+import orjson as json
+
+
+def load_checkpoints(file_path: str) -> dict[str, dict]:
+    """
+    Loads all checkpoints saved in a checkpoint file.
+
+    :param file_path: path to the checkpoint file
+    :return: dict with the keys of the checkpoints (see Checkpoint.key) as keys, empty if the file doesn't exist
+    """
+    if not os.path.isfile(file_path):
+        return {}
+    with open(file_path, 'rb') as f:
+        return json.loads(f.read())
+
+
+def save_checkpoints(checkpoints: dict[str, dict], file_path: str):
+    """
+    Saves the checkpoints atomically: they are written to a temporary file that replaces the checkpoint file, so
+    a crash while saving leaves the previous checkpoints instead of a half written file.
+
+    :param checkpoints: the checkpoints, as returned by load_checkpoints
+    :param file_path: path to the checkpoint file
+    """
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    temporary_path = f'{file_path}.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(json.dumps(checkpoints, option=json.OPT_INDENT_2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, file_path)
+
+
+class Checkpoint:
+    def __init__(self, file_path: str, data_file: str, tables: list[str]):
+        """
+        How far the import of a data file into a set of tables is: the number of lines and the byte offset after the
+        last line of which all rows are committed, and the number of rows written per table. The data file is read in
+        chunks that are written by multiple writer threads, so the checkpoint only moves past a chunk when the
+        batches of all chunks before it are committed too. It is saved after every committed batch that moves it.
+
+        :param file_path: path to the checkpoint file (shared by all data files of a database)
+        :param data_file: path to the data file
+        :param tables: the tables that are filled from the data file
+        """
+        self.file_path = file_path
+        self.data_file = data_file
+        self.tables = sorted(tables)
+        self.key = f"{data_file}|{','.join(self.tables)}"
+        self.fingerprint: dict | None = None
+        self.line_number = 0
+        self.byte_offset: int | None = 0
+        self.rows = {table: 0 for table in self.tables}
+
+        self._lock = threading.Lock()  # The batches are committed by the writer threads
+        self._chunks: dict[int, dict] = {}  # Chunks that are not completely committed yet (or not added to the state)
+        self._next_chunk_id = 0
+        self._first_chunk_id = 0
+
+    def load(self) -> bool:
+        """
+        Loads the saved state of the checkpoint.
+
+        :return: True if the checkpoint was saved before
+        """
+        entry = load_checkpoints(self.file_path).get(self.key)
+        if entry is None:
+            return False
+        self.fingerprint = entry['fingerprint']
+        self.line_number = entry['line_number']
+        self.byte_offset = entry['byte_offset']
+        self.rows = {table: entry['rows'].get(table, 0) for table in self.tables}
+        return True
+
+    def start(self, fingerprint: dict, byte_offsets: bool = True):
+        """
+        Starts the checkpoint at the start of the data file and saves it.
+
+        :param fingerprint: fingerprint of the data file (see line_counts.compute_fingerprint), to check that the
+        data file didn't change when the import continues
+        :param byte_offsets: False if the data file can't be read from a byte offset (a compressed file), then only the
+        line number is saved
+        """
+        self.fingerprint = fingerprint
+        self.line_number = 0
+        self.byte_offset = 0 if byte_offsets else None
+        self.rows = {table: 0 for table in self.tables}
+        self.save()
+
+    def add_chunk(self, line_number: int, byte_offset: int, batches: int) -> int:
+        """
+        Adds a chunk that is being written.
+
+        :param line_number: the number of lines of the data file after the chunk
+        :param byte_offset: the byte offset after the last line of the chunk
+        :param batches: the number of batches (tables) of the chunk that are written
+        :return: the id of the chunk, to pass to batch_committed
+        """
+        with self._lock:
+            chunk_id = self._next_chunk_id
+            self._next_chunk_id += 1
+            self._chunks[chunk_id] = {'line_number': line_number, 'byte_offset': byte_offset,
+                                      'batches': batches, 'rows': {}}
+            self._advance()
+        return chunk_id
+
+    def batch_committed(self, chunk_id: int, table: str, rows: int):
+        """
+        Marks a batch of a chunk as committed.
+
+        :param chunk_id: the id of the chunk (from add_chunk)
+        :param table: the table of the batch
+        :param rows: the number of rows of the batch that were written
+        """
+        with self._lock:
+            chunk = self._chunks[chunk_id]
+            chunk['batches'] -= 1
+            chunk['rows'][table] = chunk['rows'].get(table, 0) + rows
+            self._advance()
+
+    def _advance(self):
+        """
+        Moves the checkpoint past the chunks that are committed completely (without a chunk before them that isn't)
+        and saves it if it moved.
+        """
+        moved = False
+        while (chunk := self._chunks.get(self._first_chunk_id)) is not None and chunk['batches'] <= 0:
+            del self._chunks[self._first_chunk_id]
+            self._first_chunk_id += 1
+            self.line_number = chunk['line_number']
+            if self.byte_offset is not None:
+                self.byte_offset = chunk['byte_offset']
+            for table, rows in chunk['rows'].items():
+                self.rows[table] = self.rows.get(table, 0) + rows
+            moved = True
+        if moved:
+            self.save()
+
+    def save(self):
+        """
+        Saves the state of the checkpoint in the checkpoint file (see save_checkpoints).
+        """
+        checkpoints = load_checkpoints(self.file_path)
+        checkpoints[self.key] = {'data_file': self.data_file, 'tables': self.tables, 'fingerprint': self.fingerprint,
+                                 'line_number': self.line_number, 'byte_offset': self.byte_offset,
+                                 'rows': self.rows}
+        save_checkpoints(checkpoints, self.file_path)
+
+    def remove(self):
+        """
+        Removes the checkpoint from the checkpoint file, for example when the data file is imported completely.
+        """
+        with self._lock:
+            checkpoints = load_checkpoints(self.file_path)
+            if checkpoints.pop(self.key, None) is not None:
+                save_checkpoints(checkpoints, self.file_path)
@@ -0,0 +1,226 @@
+import os
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+
+MERGE_MIN_KEYS = 100_000  # Minimum number of new keys before they are merged into the sorted array
+MERGE_RATIO = 8  # The new keys are also merged when there are more than 1/MERGE_RATIO of the keys in the sorted array
+SQLITE_QUERY_KEYS = 500  # Number of keys that are looked up in one query (SQLite limits the number of parameters)
+
+
+def fingerprint(values) -> int:
+    """
+    Makes a 64-bit fingerprint of the primary key values of a row. With 64 bits, the chance that two different keys
+    get the same fingerprint is negligible, also for hundreds of millions of keys.
+
+    :param values: the primary key values
+    :return: the fingerprint as a signed 64-bit integer (so it also fits in an SQLite INTEGER)
+    """
+    key = '\x1f'.join([str(value) for value in values])
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+class DedupStore(ABC):
+    def __init__(self, tables: list[str]):
+        """
+        Remembers the primary keys of the rows that were already added to tables, so rows with the same primary key
+        in later chunks (or data files) are skipped. Only fingerprints of the keys are stored (see fingerprint).
+
+        :param tables: the tables to deduplicate
+        """
+        self.tables = set(tables)
+        self.duplicates = {table: 0 for table in self.tables}
+
+    def filter_new(self, table: str, rows: list[tuple], key_indexes: list[int]) -> list[tuple]:
+        """
+        Gets the rows with a primary key that was not seen before, the keys of these rows are added to the store.
+
+        :param table: the table of the rows
+        :param rows: the rows
+        :param key_indexes: indexes of the primary key columns in the rows
+        :return: the new rows, in the same order (of rows with the same key in the rows, only the first is kept)
+        """
+        if len(key_indexes) == 1:
+            # Most tables have one primary key column, this is the same as fingerprint without the function calls
+            i = key_indexes[0]
+            fingerprints = [int.from_bytes(blake2b(str(row[i]).encode('utf-8'), digest_size=8).digest(), 'little',
+                                           signed=True) for row in rows]
+        else:
+            fingerprints = [fingerprint([row[i] for i in key_indexes]) for row in rows]
+        is_new = self._add(table, fingerprints)
+        new_rows = [row for row, new in zip(rows, is_new) if new]
+        self.duplicates[table] += len(rows) - len(new_rows)
+        return new_rows
+
+    @abstractmethod
+    def _add(self, table: str, fingerprints: list[int]) -> list[bool]:
+        """
+        Adds fingerprints to the store.
+
+        :return: for every fingerprint, True if it was not in the store yet (or earlier in the list)
+        """
+
+    @abstractmethod
+    def count(self, table: str) -> int:
+        """Gets the number of keys stored for a table."""
+
+    @abstractmethod
+    def clear(self, table: str):
+        """Removes the keys of a table, for example when the table is deleted."""
+
+    def commit(self):
+        """Makes the added keys permanent (only for stores that are saved)."""
+
+    def close(self):
+        """Closes the store."""
+
+    @abstractmethod
+    def memory_bytes(self) -> int:
+        """Gets the approximate number of bytes of memory used for the keys."""
+
+    def get_statistics(self) -> dict:
+        """
+        Gets the number of keys and skipped duplicates per table, and the memory use of the store.
+
+        :return: dict with the statistics
+        """
+        return {'store': type(self).__name__, 'memory_bytes': self.memory_bytes(),
+                'tables': {table: {'keys': self.count(table), 'duplicates': self.duplicates[table]}
+                           for table in sorted(self.tables)}}
+
+
+class MemoryDedupStore(DedupStore):
+    def __init__(self, tables: list[str]):
+        """
+        Keeps the fingerprints in memory: most of them in a sorted array of 64-bit integers (8 bytes per key), the
+        newest ones in a set that is merged into the array once it is large enough.
+
+        :param tables: the tables to deduplicate
+        """
+        super().__init__(tables)
+        self._sorted = {table: array('q') for table in self.tables}
+        self._new = {table: set() for table in self.tables}
+
+    def _add(self, table: str, fingerprints: list[int]) -> list[bool]:
+        sorted_fingerprints = self._sorted[table]
+        new_fingerprints = self._new[table]
+        sorted_count = len(sorted_fingerprints)
+        is_new = []
+        for value in fingerprints:
+            if value in new_fingerprints:
+                is_new.append(False)
+                continue
+            i = bisect_left(sorted_fingerprints, value)
+            if i < sorted_count and sorted_fingerprints[i] == value:
+                is_new.append(False)
+                continue
+            new_fingerprints.add(value)
+            is_new.append(True)
+
+        if len(new_fingerprints) >= max(MERGE_MIN_KEYS, sorted_count // MERGE_RATIO):
+            self._merge(table)
+        return is_new
+
+    def _merge(self, table: str):
+        """
+        Merges the set of new fingerprints of a table into its sorted array. The parts of the array between the new
+        fingerprints are copied as slices, so only the new fingerprints are handled one by one.
+        """
+        old_sorted = self._sorted[table]
+        merged = array('q')
+        position = 0
+        for value in sorted(self._new[table]):
+            i = bisect_left(old_sorted, value, position)
+            merged.extend(old_sorted[position:i])
+            merged.append(value)
+            position = i
+        merged.extend(old_sorted[position:])
+        self._sorted[table] = merged
+        self._new[table] = set()
+
+    def count(self, table: str) -> int:
+        return len(self._sorted[table]) + len(self._new[table])
+
+    def clear(self, table: str):
+        if table in self.tables:
+            self._sorted[table] = array('q')
+            self._new[table] = set()
+
+    def memory_bytes(self) -> int:
+        memory = 0
+        for table in self.tables:
+            memory += sys.getsizeof(self._sorted[table]) + sys.getsizeof(self._new[table])
+            memory += sum(sys.getsizeof(value) for value in self._new[table])
+        return memory
+
+
+class SQLiteDedupStore(DedupStore):
+    def __init__(self, tables: list[str], file_path: str):
+        """
+        Keeps the fingerprints in a table of an SQLite file, so they are kept when the import is started again.
+        The added keys are only saved by commit, which is done after a data file is added completely; keys of a data
+        file that was interrupted are not saved. When its tables continue from their checkpoint, the keys of the rows
+        in these tables are loaded again (see load_dedup_keys in data_to_sql.py).
+
+        :param tables: the tables to deduplicate
+        :param file_path: path to the SQLite file
+        """
+        super().__init__(tables)
+        self.file_path = file_path
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(file_path)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS dedup_keys (table_name TEXT NOT NULL, '
+                                 'fingerprint INTEGER NOT NULL, PRIMARY KEY (table_name, fingerprint)) WITHOUT ROWID')
+        self._connection.commit()
+
+    def _add(self, table: str, fingerprints: list[int]) -> list[bool]:
+        # Only the first of the same fingerprints in the list can be new
+        first_fingerprints = list(dict.fromkeys(fingerprints))
+        existing = set()
+        for i in range(0, len(first_fingerprints), SQLITE_QUERY_KEYS):
+            keys = first_fingerprints[i:i + SQLITE_QUERY_KEYS]
+            placeholders = ','.join('?' * len(keys))
+            cursor = self._connection.execute(f'SELECT fingerprint FROM dedup_keys WHERE table_name = ? '
+                                              f'AND fingerprint IN ({placeholders})', [table, *keys])
+            existing.update(row[0] for row in cursor)
+        new_fingerprints = [value for value in first_fingerprints if value not in existing]
+        self._connection.executemany('INSERT INTO dedup_keys (table_name, fingerprint) VALUES (?, ?)',
+                                     [(table, value) for value in new_fingerprints])
+
+        is_new = []
+        remaining = set(new_fingerprints)
+        for value in fingerprints:
+            if value in remaining:
+                remaining.remove(value)
+                is_new.append(True)
+            else:
+                is_new.append(False)
+        return is_new
+
+    def count(self, table: str) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM dedup_keys WHERE table_name = ?', (table,)).fetchone()[0]
+
+    def clear(self, table: str):
+        self._connection.execute('DELETE FROM dedup_keys WHERE table_name = ?', (table,))
+        self._connection.commit()
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()  # Keys that were not committed are discarded
+
+    def memory_bytes(self) -> int:
+        # The keys are on disk, only the page cache is in memory (a negative cache size is in KiB instead of pages)
+        cache_size = self._connection.execute('PRAGMA cache_size').fetchone()[0]
+        if cache_size < 0:
+            return -cache_size * 1024
+        return cache_size * self._connection.execute('PRAGMA page_size').fetchone()[0]
+
+    def get_statistics(self) -> dict:
+        statistics = super().get_statistics()
+        statistics['disk_bytes'] = os.path.getsize(self.file_path)
+        return statistics
@@ -0,0 +1,108 @@
+from datetime import datetime, timezone
+from classes.FilePlan import FilePlan
+
+BOOL_TEXT_VALUES = {'true': True, 'false': False, '1': True, '0': False}
+
+
+def convert_value(value, column_type: str, is_date: bool = False):
+    """
+    Converts a cleaned value to the type of its column in the schema, so it is stored as a typed BSON value
+    (some data files have numbers and booleans as text). Values that can't be converted are kept as they are.
+
+    :param value: the cleaned value
+    :param column_type: type of the column in the schema (integer, float, bool or text)
+    :param is_date: True if the column is a Unix timestamp that is stored as a date
+    :return: the converted value
+    """
+    if value is None:
+        return None
+    match column_type.lower():
+        case 'integer':
+            if isinstance(value, bool):
+                value = int(value)
+            elif isinstance(value, float) and value.is_integer():
+                value = int(value)
+            elif isinstance(value, str):
+                try:
+                    value = int(float(value)) if '.' in value or 'e' in value.lower() else int(value)
+                except ValueError:
+                    return value
+        case 'float':
+            if isinstance(value, (int, str)) and not isinstance(value, bool):
+                try:
+                    value = float(value)
+                except ValueError:
+                    return value
+        case 'bool':
+            if isinstance(value, str):
+                value = BOOL_TEXT_VALUES.get(value.lower(), value)
+            elif isinstance(value, (int, float)):
+                value = bool(value)
+    if is_date and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    return value
+
+
+class DocumentPlan:
+    def __init__(self, collection: str, file_plan: FilePlan, column_types: dict[str, dict[str, str]],
+                 embed_tables: bool = False, date_columns: list[str] | None = None):
+        """
+        Turns a decoded line of a data file into MongoDB documents with the same columns as the SQL tables: the line
+        is cleaned by the plan of the SQL tables (see FilePlan) and every row becomes a document with typed values.
+        Columns without a value are left out of the documents.
+
+        :param collection: the collection of the data file, also the table of the main rows of the data file
+        :param file_plan: plan of the tables of the data file
+        :param column_types: for every table, the types of its columns in the schema
+        :param embed_tables: True to add the rows of the other tables of the line to the document of the main row
+        (one row as sub-document, more rows as array, under the name of the table). Otherwise these rows are
+        documents of collections with the name of their table.
+        :param date_columns: columns with a Unix timestamp that are stored as dates
+        """
+        self.collection = collection
+        self.file_plan = file_plan
+        self.column_types = column_types
+        self.embed_tables = embed_tables
+        self.date_columns = set(date_columns or [])
+
+    def to_document(self, table: str, row: tuple) -> dict:
+        """
+        Makes a document of a row of a table, with the values converted to the types of the columns.
+
+        :param table: the table of the row
+        :param row: the row, with the values in the order of the columns of the table
+        :return: the document
+        """
+        column_types = self.column_types[table]
+        document = {}
+        for column, value in zip(self.file_plan.table_plans[table].columns, row):
+            value = convert_value(value, column_types.get(column, 'text'), column in self.date_columns)
+            if value is not None:
+                document[column] = value
+        return document
+
+    def execute(self, line: dict) -> list[tuple[str, dict]]:
+        """
+        Cleans a decoded line and makes its documents.
+
+        :param line: the decoded line
+        :return: the documents with their collection. When the tables are embedded, a line without a main row has no
+        documents (the rows of the other tables have no document to be embedded in).
+        """
+        table_rows = self.file_plan.execute(line)
+        documents = []
+        if self.embed_tables:
+            main_rows = table_rows.get(self.collection) or []
+            embedded = {table: [self.to_document(table, row) for row in rows]
+                        for table, rows in table_rows.items() if table != self.collection and rows}
+            for row in main_rows:
+                document = self.to_document(self.collection, row)
+                for table, table_documents in embedded.items():
+                    document[table] = table_documents[0] if len(table_documents) == 1 else table_documents
+                documents.append((self.collection, document))
+            return documents
+
+        for table, rows in table_rows.items():
+            if rows:
+                documents.extend((table, self.to_document(table, row)) for row in rows)
+        return documents
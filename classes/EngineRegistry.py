@@ -0,0 +1,90 @@
+import time
+from typing import Any
+from sqlalchemy import Engine, text
+from classes.DBType import DBType, DBTypes
+from general import make_sqlite_engine, make_postgres_engine, make_mysql_engine, make_mongodb_client
+
+
+class EngineRegistry:
+    def __init__(self):
+        """
+        Keeps one engine per database for a whole benchmark run, so the queries reuse the pooled connections instead of
+        making an engine (and for PostgreSQL checking the database) and connecting for every query. The databases are
+        keyed by their type and name suffix, since the benchmarks make new DBType objects for every loop.
+        """
+        self._engines: dict[tuple[DBTypes, str], Any] = {}
+        self.setup_seconds: dict[tuple[DBTypes, str], float] = {}
+
+    @staticmethod
+    def get_key(db_type: DBType) -> tuple[DBTypes, str]:
+        """
+        Gets the key of a database in the registry.
+
+        :param db_type: the database
+        :return: the type and name suffix of the database
+        """
+        return db_type.get_type(), db_type.name_suffix
+
+    def get(self, db_type: DBType) -> Engine | Any:
+        """
+        Gets the engine of a database (the MongoDB database for MongoDB), which is made and warmed up the first time.
+        The time this takes is kept in setup_seconds.
+
+        :param db_type: the database
+        :return: the engine
+        """
+        key = self.get_key(db_type)
+        if key not in self._engines:
+            start_time = time.perf_counter()
+            engine = self._make_engine(db_type)
+            self._warm_up(engine, db_type)
+            self._engines[key] = engine
+            self.setup_seconds[key] = time.perf_counter() - start_time
+            print(f'[{db_type.display_name}] Connected in {self.setup_seconds[key]:.3f} s')
+        return self._engines[key]
+
+    def get_setup_seconds(self, db_type: DBType) -> float | None:
+        """
+        Gets the time it took to make and warm up the engine of a database.
+
+        :param db_type: the database
+        :return: the time in seconds, None if the engine was not made yet
+        """
+        return self.setup_seconds.get(self.get_key(db_type))
+
+    @staticmethod
+    def _make_engine(db_type: DBType) -> Engine | Any:
+        match db_type.get_type():
+            case DBTypes.SQLITE:
+                return make_sqlite_engine(db_type)
+            case DBTypes.POSTGRESQL:
+                return make_postgres_engine(db_type=db_type)
+            case DBTypes.MYSQL:
+                return make_mysql_engine(db_type)
+            case DBTypes.MONGODB:
+                return make_mongodb_client(db_type)
+            case _:
+                raise ValueError(f'Unknown database type: {db_type}')
+
+    @staticmethod
+    def _warm_up(engine: Engine | Any, db_type: DBType):
+        """
+        Opens the first connection of the pool (with the handshake and authentication) and runs a trivial command,
+        so the first measured query doesn't pay for it.
+        """
+        if db_type.is_type(DBTypes.MONGODB):
+            engine.command('ping')
+            return
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1')).fetchall()
+
+    def dispose(self):
+        """
+        Closes the connections of all engines.
+        """
+        for (db_type, _), engine in self._engines.items():
+            if db_type == DBTypes.MONGODB:
+                engine.client.close()
+            else:
+                engine.dispose()
+        self._engines.clear()
@@ -0,0 +1,69 @@
+from operator import itemgetter
+from classes.TablePlan import TablePlan
+
+
+class FilePlan:
+    def __init__(self, table_plans: dict[str, TablePlan]):
+        """
+        Turns a decoded line of a data file into rows for all the tables of that file. The keys that are needed by
+        any of the tables are taken from the line once, and the tables are filled from this shared projection.
+
+        :param table_plans: plans of the tables of the data file, the tables are cleaned in this order
+        """
+        self.table_plans = table_plans
+
+        # Union of the columns and the keys the cleaners read, in order of first appearance
+        keys = dict()
+        for table_plan in table_plans.values():
+            keys.update(dict.fromkeys(table_plan.columns))
+            keys.update(dict.fromkeys(table_plan.cleaner.input_keys))
+        self.keys = list(keys)
+        self._get_values = itemgetter(*self.keys)
+        self._single_key = len(self.keys) == 1
+
+        # When a line has more non-empty keys than a table has primary keys, at least one of them is not a primary key
+        self._non_empty_keys_needed = max([len(table_plan.primary_keys) for table_plan in table_plans.values()],
+                                          default=0) + 1
+
+    def get_non_empty_keys(self, line: dict) -> list[str]:
+        """
+        Gets the first keys of the whole line with a value that is not None or empty, as many as needed to check
+        for every table if the line has a value besides the primary keys (see TablePlan.is_skipped).
+
+        :param line: the decoded line
+        :return: the keys, all the non-empty keys of the line if there are less than needed
+        """
+        non_empty_keys = []
+        for key, value in line.items():
+            if value is not None and value != '':
+                non_empty_keys.append(key)
+                if len(non_empty_keys) == self._non_empty_keys_needed:
+                    break
+        return non_empty_keys
+
+    def project(self, line: dict) -> dict:
+        """
+        Takes the keys that are needed by the tables from a decoded line.
+
+        :param line: the decoded line
+        :return: a new dict with all the needed keys, missing keys have the value None
+        """
+        try:
+            values = self._get_values(line)
+            if self._single_key:
+                values = (values,)
+        except KeyError:  # Not every line has all the keys
+            values = [line.get(key) for key in self.keys]
+        return dict(zip(self.keys, values))
+
+    def execute(self, line: dict) -> dict[str, list[tuple] | None]:
+        """
+        Cleans a decoded line for all the tables.
+
+        :param line: the decoded line
+        :return: A dict with as a key the table name and value the rows for that table (None if the line is skipped).
+        """
+        non_empty_keys = self.get_non_empty_keys(line)
+        shared_line = self.project(line)
+        # The tables are cleaned in order on the same projection, since a cleaner can change it for the next tables
+        return {table: table_plan.execute(shared_line, non_empty_keys) for table, table_plan in self.table_plans.items()}
@@ -0,0 +1,38 @@
+from zlib import crc32
+
+MAX_INDEX_NAME_LENGTH = 63  # PostgreSQL cuts off longer names (MySQL allows 64 characters)
+
+
+class IndexDefinition:
+    def __init__(self, table: str, columns: list[str], primary_key: bool = False, reason: str = ''):
+        """
+        An index (or the primary key) of a table that is built after the data is loaded. The name contains the table,
+        so indexes on columns with the same name in different tables (for example 'id') don't collide.
+
+        :param table: name of the table (or MongoDB collection)
+        :param columns: the indexed columns, in order
+        :param primary_key: True for the primary key of the table (a unique index where the database has no separate
+        primary key to add)
+        :param reason: why the index is built (for example 'primary key' or a foreign key), shown in the logs
+        """
+        self.table = table
+        self.columns = list(columns)
+        self.primary_key = primary_key
+        self.reason = reason or ('primary key' if primary_key else 'index')
+        if primary_key:
+            self.name = f'{table}_pkey'  # The same name PostgreSQL gives the primary key of CREATE TABLE
+        else:
+            self.name = f"idx_{table}_{'_'.join(self.columns)}"
+        if len(self.name) > MAX_INDEX_NAME_LENGTH:
+            # A hash of the whole name keeps shortened names unique
+            self.name = f'{self.name[:MAX_INDEX_NAME_LENGTH - 9]}_{crc32(self.name.encode()):08x}'
+
+    def __repr__(self) -> str:
+        return f"IndexDefinition({self.name}: {self.table}({', '.join(self.columns)}), {self.reason})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IndexDefinition) and (self.table, self.columns, self.primary_key) == \
+            (other.table, other.columns, other.primary_key)
+
+    def __hash__(self) -> int:
+        return hash((self.table, tuple(self.columns), self.primary_key))
@@ -0,0 +1,127 @@
+HISTOGRAM_BUCKETS = 64  # Bucket b counts the lengths with b bits, so lengths from 2 ** (b - 1) up to 2 ** b - 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LengthProfiler:
+    def __init__(self, columns: set[str] | list[str]):
+        """
+        Profiles the number of characters of the values of columns in NDJSON lines: the maximum length and a histogram
+        of the lengths, from which percentiles are estimated. The number of null values and the types of the values
+        are also counted. Profilers of different parts of a file can be merged.
+
+        :param columns: the keys of the values to profile, other keys are skipped
+        """
+        self.columns = set(columns)
+        self.line_count = 0
+        self.max_lengths: dict[str, int] = {}
+        self.histograms: dict[str, list[int]] = {}
+        self.type_counts: dict[str, dict[str, int]] = {}
+
+    def get_values(self, obj) -> dict:
+        """
+        Gets the values of the profiled columns of a decoded line, also the values of nested objects and lists.
+        The nested keys are used without the keys of their parents, only the last value is kept when a key is found
+        more than once.
+
+        :param obj: the decoded line
+        :return: dict with the column names as keys and the values as values
+        """
+        values = {}
+        columns = self.columns
+
+        def _get_values(nested_obj):
+            if isinstance(nested_obj, dict):
+                for key, value in nested_obj.items():
+                    if isinstance(value, (dict, list)):
+                        _get_values(value)
+                    elif key in columns:
+                        values[key] = value
+            elif isinstance(nested_obj, list):
+                for item in nested_obj:
+                    _get_values(item)
+
+        _get_values(obj)
+        return values
+
+    def profile_line(self, obj):
+        """
+        Adds the lengths of the values of a decoded line, the length is the number of characters of str(value).
+
+        :param obj: the decoded line
+        """
+        self.line_count += 1
+        max_lengths = self.max_lengths
+        histograms = self.histograms
+        type_counts = self.type_counts
+        for key, value in self.get_values(obj).items():
+            length = len(value) if type(value) is str else len(str(value))
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = [0] * HISTOGRAM_BUCKETS
+                max_lengths[key] = length
+                type_counts[key] = {}
+            elif length > max_lengths[key]:
+                max_lengths[key] = length
+            histogram[length.bit_length()] += 1
+            column_type_counts = type_counts[key]
+            type_name = type(value).__name__
+            column_type_counts[type_name] = column_type_counts.get(type_name, 0) + 1
+
+    def merge(self, other: 'LengthProfiler'):
+        """
+        Adds the lengths profiled by another profiler, for example of another shard of the same file.
+
+        :param other: the other profiler
+        """
+        self.line_count += other.line_count
+        for key, length in other.max_lengths.items():
+            if length > self.max_lengths.get(key, -1):
+                self.max_lengths[key] = length
+        for key, other_histogram in other.histograms.items():
+            histogram = self.histograms.setdefault(key, [0] * HISTOGRAM_BUCKETS)
+            for bucket, count in enumerate(other_histogram):
+                histogram[bucket] += count
+        for key, other_type_counts in other.type_counts.items():
+            column_type_counts = self.type_counts.setdefault(key, {})
+            for type_name, count in other_type_counts.items():
+                column_type_counts[type_name] = column_type_counts.get(type_name, 0) + count
+
+    def get_percentile(self, key: str, percentile: float) -> int:
+        """
+        Estimates a percentile of the lengths of a column from its histogram.
+
+        :param key: the column
+        :param percentile: the percentile (0 - 100)
+        :return: the upper bound of the histogram bucket of the percentile, at most the maximum length
+        """
+        histogram = self.histograms[key]
+        needed = sum(histogram) * percentile / 100
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= needed and count > 0:
+                return min(2 ** bucket - 1, self.max_lengths[key])
+        return self.max_lengths[key]
+
+    def get_statistics(self) -> dict[str, dict]:
+        """
+        Gets the statistics of the lengths per column: the number of values, maximum, percentiles, the histogram
+        (as a dict with the upper bound of a bucket as key and the number of lengths in it as value), the ratio of lines
+        where the value is null or missing and the number of values per type.
+
+        :return: dict with the column names as keys and the statistics as values
+        """
+        statistics = {}
+        for key in sorted(self.max_lengths):
+            histogram = self.histograms[key]
+            column_statistics = {'count': sum(histogram), 'max': self.max_lengths[key]}
+            for percentile in PERCENTILES:
+                column_statistics[f'p{percentile:g}'] = self.get_percentile(key, percentile)
+            column_statistics['histogram'] = {str(2 ** bucket - 1): count for bucket, count in enumerate(histogram)
+                                              if count > 0}
+            non_null_count = column_statistics['count'] - self.type_counts[key].get('NoneType', 0)
+            if self.line_count > 0:
+                column_statistics['null_ratio'] = round(1 - non_null_count / self.line_count, 6)
+            column_statistics['types'] = dict(sorted(self.type_counts[key].items()))
+            statistics[key] = column_statistics
+        return statistics
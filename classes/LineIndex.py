@@ -0,0 +1,70 @@
+from array import array
+from bisect import bisect_right
+
+
+class LineIndex:
+    def __init__(self, interval: int, line_numbers: list[int] | None = None, offsets: list[int] | None = None):
+        """
+        Sparse index of the byte offsets of lines in a NDJSON file, roughly one entry every `interval` lines.
+        A line is found by going to the closest entry before it and reading at most about `interval` lines from there.
+        The entries are kept in arrays of unsigned 64-bit integers, so the index is small and fast to save and load.
+
+        :param interval: number of lines between the entries
+        :param line_numbers: line numbers of the entries (starting at 0), in increasing order
+        :param offsets: byte offsets of the start of these lines
+        """
+        self.interval = interval
+        # The first line always starts at the start of the file
+        self.line_numbers = array('Q', line_numbers if line_numbers is not None else [0])
+        self.offsets = array('Q', offsets if offsets is not None else [0])
+
+    def __len__(self):
+        return len(self.line_numbers)
+
+    def add(self, line_number: int, offset: int):
+        """
+        Adds an entry after the last one.
+
+        :param line_number: line number (starting at 0), must be larger than the line numbers in the index
+        :param offset: byte offset of the start of the line
+        """
+        self.line_numbers.append(line_number)
+        self.offsets.append(offset)
+
+    def locate(self, line_number: int) -> tuple[int, int]:
+        """
+        Finds the closest entry at or before a line.
+
+        :param line_number: line number (starting at 0)
+        :return: (line number, byte offset) of the entry, the line is reached by skipping the difference in lines
+        """
+        i = max(bisect_right(self.line_numbers, line_number) - 1, 0)
+        return self.line_numbers[i], self.offsets[i]
+
+    def save(self, file_path: str):
+        """
+        Saves the index as a binary file: the interval and number of entries, then the line numbers and the offsets.
+
+        :param file_path: path to the index file
+        """
+        with open(file_path, 'wb') as f:
+            array('Q', [self.interval, len(self)]).tofile(f)
+            self.line_numbers.tofile(f)
+            self.offsets.tofile(f)
+
+    @classmethod
+    def load(cls, file_path: str) -> 'LineIndex':
+        """
+        Loads an index that was saved with save.
+
+        :param file_path: path to the index file
+        :return: the index
+        """
+        with open(file_path, 'rb') as f:
+            header = array('Q')
+            header.fromfile(f, 2)
+            interval, entries = header
+            line_index = cls(interval, [], [])
+            line_index.line_numbers.fromfile(f, entries)
+            line_index.offsets.fromfile(f, entries)
+        return line_index
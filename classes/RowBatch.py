@@ -0,0 +1,42 @@
+import csv
+
+
+def sanitize_value(value):
+    """
+    Makes a value writable to every database: lists and dicts are converted to text
+    and null characters are removed from text.
+
+    :param value: the value to sanitize
+    :return: the sanitized value
+    """
+    if isinstance(value, str):
+        return value.replace('\x00', '') if '\x00' in value else value
+    if isinstance(value, (list, dict)):
+        return str(value).replace('\x00', '')
+    return value
+
+
+class RowBatch:
+    def __init__(self, columns: list[str], rows: list[tuple]):
+        """
+        Rows of one table, each row is a tuple with the values in the same order as the columns.
+
+        :param columns: names of the columns
+        :param rows: the rows
+        """
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def to_csv(self, file_path: str):
+        """
+        Writes the batch to a CSV file, for example to inspect rows that could not be written to the database.
+
+        :param file_path: path to the CSV file
+        """
+        with open(file_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(self.rows)
@@ -0,0 +1,47 @@
+import threading
+
+
+class RssSampler:
+    def __init__(self, interval_seconds: float):
+        """
+        Samples the resident set size (RSS) of the process in a background thread while a query runs, to find the
+        peak memory of the whole process (also memory that tracemalloc doesn't see, for example of the database
+        drivers). Use it as a context manager around the query.
+
+        :param interval_seconds: time between two samples
+        :raises ImportError: if psutil is not installed
+        """
+        try:
+            import psutil
+        except ImportError:
+            raise ImportError('The package psutil is needed to sample the memory of the process, install it with: '
+                              'pip install psutil (or set rss_sample_interval_ms to 0 in config.json)')
+        self.interval_seconds = interval_seconds
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.baseline_bytes = 0
+        self.peak_bytes = 0
+
+    def _sample(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.peak_bytes = max(self.peak_bytes, self._process.memory_info().rss)
+
+    def __enter__(self) -> 'RssSampler':
+        self._stop.clear()
+        self.baseline_bytes = self.peak_bytes = self._process.memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self._process.memory_info().rss)
+
+    @property
+    def peak_increase_kb(self) -> float:
+        """
+        :return: how much the peak RSS during the query was above the RSS before the query, in KB
+        """
+        return (self.peak_bytes - self.baseline_bytes) / 1024
@@ -0,0 +1,77 @@
+from operator import itemgetter
+from classes.BaseCleaner import BaseCleaner
+from classes.RowBatch import sanitize_value
+from general import should_skip
+
+
+class TablePlan:
+    def __init__(self, table: str, columns: list[str], primary_keys: list[str], cleaner: BaseCleaner):
+        """
+        Everything that is needed to turn a line of a data file into rows of one table, made once per import
+        so the cleaner, primary keys and columns are not looked up again for every line.
+
+        :param table: name of the table
+        :param columns: columns of the table (the order of the values in the rows)
+        :param primary_keys: primary key columns of the table
+        :param cleaner: cleaner of the table
+        """
+        self.table = table
+        self.columns = columns
+        self.primary_keys = primary_keys
+        self.cleaner = cleaner
+
+        # itemgetter gets all the values in one call, but with one column it returns the value instead of a tuple
+        self._get_values = itemgetter(*columns)
+        self._single_column = len(columns) == 1
+
+    def is_skipped(self, line: dict | list[dict], non_empty_keys: list[str] | None = None) -> bool:
+        """
+        Checks if a cleaned line is skipped, see should_skip.
+
+        :param line: the cleaned line
+        :param non_empty_keys: keys with a value that is not None or empty in the whole decoded line, as found by
+        FilePlan.get_non_empty_keys. If given, the other values of the line are not checked again.
+        :return: True if the line should be skipped, False otherwise
+        """
+        if non_empty_keys is None:
+            return should_skip(line, self.primary_keys)
+        if any(line.get(key) is None or line.get(key) == '' for key in self.primary_keys):
+            return True
+        return not any(key not in self.primary_keys for key in non_empty_keys)
+
+    def project(self, line: dict) -> tuple:
+        """
+        Gets the values of the columns of the table from a cleaned line, every value is sanitized (see sanitize_value).
+
+        :param line: the cleaned line
+        :return: the row with the values in the same order as the columns, missing columns are None
+        """
+        try:
+            values = self._get_values(line)
+            if self._single_column:
+                values = (values,)
+        except KeyError:  # Not every line has all the columns
+            values = [line.get(column) for column in self.columns]
+        return tuple([sanitize_value(value) for value in values])
+
+    def execute(self, line: dict, non_empty_keys: list[str] | None = None) -> list[tuple] | None:
+        """
+        Cleans a line, checks if it is skipped and projects it to the columns of the table.
+
+        :param line: the decoded line of the data file, the cleaner can change it
+        :param non_empty_keys: see is_skipped
+        :return: the rows for the table, or None if the line is skipped
+        """
+        if self.cleaner.filter_only:
+            cleaned_line = line if self.cleaner.keep(line) else None
+        else:
+            cleaned_line = self.cleaner.clean(line, self.primary_keys)
+        if cleaned_line is None:
+            return None
+
+        # The non-empty keys belong to the decoded line, so they can't be used when the cleaner made a new line
+        if self.is_skipped(cleaned_line, non_empty_keys if cleaned_line is line else None):
+            return None
+        if isinstance(cleaned_line, list):
+            return [self.project(l) for l in cleaned_line]
+        return [self.project(cleaned_line)]
@@ -0,0 +1,165 @@
+import queue
+import threading
+from typing import Callable
+from sqlalchemy import Engine, Connection
+
+
+class WriterPipeline:
+    def __init__(self, engine: Engine, write_function: Callable, writer_threads: int = 1, queue_size: int = 4,
+                 setup_connection: Callable[[Connection], None] | None = None,
+                 teardown_connection: Callable[[Connection], None] | None = None):
+        """
+        Writes chunks to the database in background threads, so the main thread can parse the next chunks
+        while the previous ones are being written. Every writer thread has its own connection from the engine pool.
+        The queue is bounded: when the writers can't keep up, put() blocks until there is room again (backpressure),
+        so the memory usage stays bounded.
+
+        :param engine: database engine, every writer thread gets its own connection from this engine
+        :param write_function: function that writes one chunk, it is called as write_function(*args, connection)
+        with the args that are passed to put(). A write function that leaves rows uncommitted after the connection is
+        committed (for example to commit once every few chunks) sets connection.info['chunks_not_committed'] to the
+        number of chunks that are not committed yet
+        :param writer_threads: number of writer threads, with 0 the chunks are written directly in put() (no pipelining)
+        :param queue_size: maximum number of chunks waiting to be written
+        :param setup_connection: function called with every new connection before the first chunk is written
+        (for example to change session settings for the whole load)
+        :param teardown_connection: function called with every connection after the last chunk is written
+        (for example to restore the session settings)
+        """
+        self.engine = engine
+        self.write_function = write_function
+        self.setup_connection = setup_connection
+        self.teardown_connection = teardown_connection
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.error = None
+        self.connection = None
+        self.threads = []
+
+        if writer_threads <= 0:
+            self.connection = self._open_connection()
+        for i in range(writer_threads):
+            thread = threading.Thread(target=self._run, name=f'writer-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _write(self, args: tuple, on_commit: Callable | None, connection: Connection):
+        """
+        Writes and commits one chunk, then calls the on_commit functions of the chunks that are committed now.
+        """
+        result = self.write_function(*args, connection)
+        connection.commit()
+        callbacks = connection.info.setdefault('on_commit_callbacks', [])
+        if on_commit is not None:
+            callbacks.append((on_commit, result))
+        # Chunks that the write function didn't commit yet wait until a later chunk (or the teardown) commits them
+        if not connection.info.get('chunks_not_committed'):
+            self._run_commit_callbacks(connection)
+
+    @staticmethod
+    def _run_commit_callbacks(connection: Connection):
+        """
+        Calls the on_commit functions of the committed chunks of a connection with the results of the write function.
+        """
+        callbacks = connection.info.pop('on_commit_callbacks', [])
+        for on_commit, result in callbacks:
+            on_commit(result)
+
+    def _open_connection(self) -> Connection:
+        """
+        Opens a connection from the engine pool and prepares it for writing.
+        """
+        connection = self.engine.connect()
+        if self.setup_connection is not None:
+            self.setup_connection(connection)
+            connection.commit()
+        return connection
+
+    def _close_connection(self, connection: Connection):
+        """
+        Restores and closes a connection that was opened with _open_connection.
+        """
+        if self.error is not None:
+            # The session settings are possibly not restored, so don't give this connection back to the pool
+            connection.invalidate()
+        else:
+            if self.teardown_connection is not None:
+                self.teardown_connection(connection)
+                connection.commit()
+            self._run_commit_callbacks(connection)
+        connection.close()
+
+    def _run(self):
+        """
+        Loop of a writer thread: takes chunks from the queue and writes them until it receives None.
+        """
+        connection = None
+        try:
+            connection = self._open_connection()
+        except BaseException as e:
+            self.error = e
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            # After an error, the remaining chunks are only taken from the queue, so put() doesn't block forever
+            if self.error is None:
+                try:
+                    self._write(*item, connection)
+                except BaseException as e:  # Also catch SystemExit, since exit() in a thread only stops the thread
+                    self.error = e
+            self.queue.task_done()
+
+        if connection is not None:
+            try:
+                self._close_connection(connection)
+            except BaseException as e:
+                self.error = self.error or e
+
+    def _raise_error(self):
+        """
+        Raises the error of a writer thread in the thread that uses the pipeline.
+        """
+        if self.error is not None:
+            raise self.error
+
+    def put(self, *args, on_commit: Callable | None = None):
+        """
+        Adds a chunk to the queue to be written, blocks when the queue is full.
+
+        :param args: arguments for the write function (without the connection)
+        :param on_commit: function that is called with the result of the write function once the chunk is committed
+        (from the writer thread), for example to save how far the import is
+        """
+        self._raise_error()
+        if self.connection is not None:
+            try:
+                self._write(args, on_commit, self.connection)
+            except BaseException as e:
+                self.error = e
+                raise
+            return
+        self.queue.put((args, on_commit))
+
+    def join(self):
+        """
+        Waits until all the chunks in the queue are written.
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Writes the remaining chunks and stops the writer threads.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.connection is not None:
+            self._close_connection(self.connection)
+            self.connection = None
+        self._raise_error()
@@ -6,6 +6,8 @@ from classes.DBType import DBType, DBTypes
 from general import should_skip
 
 class SubredditRulesCleaner(BaseCleaner):
+    input_keys = ('subreddit', 'rules')
+
     def clean(self, line: dict, primary_key: list[str]) -> list[dict]|None:
         """
         Helper method to process a line for the subreddit_rules table. Unpacks the rule dictionary.
@@ -31,12 +33,20 @@ class SubredditRulesCleaner(BaseCleaner):
         return lines_rules_cleaned
 
 class RemovedCleaner(BaseCleaner):
+    input_keys = ('removal_reason', 'removed_by')
+    filter_only = True
+
+    def keep(self, line):
+        return line['removal_reason'] is not None or line['removed_by'] is not None
+
     def clean(self, line, primary_key):
-        if line['removal_reason'] is None and line['removed_by'] is None:
+        if not self.keep(line):
             return None
         return line
 
 class WikiCleaner(BaseCleaner):
+    input_keys = ('revision_date', 'path', 'content')
+
     def __init__(self, db_type: DBType):
         self.db_type = db_type
 
@@ -57,62 +67,96 @@ class WikiCleaner(BaseCleaner):
         return line
 
 class WikiRevisionCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class PostCleaner(BaseCleaner):
+    input_keys = ('edited',)
+
     def clean(self, line, primary_key):
         line['edited'] = bool(int(line['edited']))
         return line
 
 class CommentCleaner(BaseCleaner):
+    input_keys = ('edited',)
+
     def clean(self, line, primary_key):
         line['edited'] = bool(int(line['edited']))
         return line
 
 class CollapsedCommentCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class DistinguishedCommentCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class AuthorCleaner(BaseCleaner):
+    input_keys = ('author',)
+    filter_only = True
+
     def __init__(self, ignored_authors):
         self.ignored_authors = ignored_authors
 
+    def keep(self, line):
+        return line['author'].strip().lower() not in self.ignored_authors
+
     def clean(self, line, primary_key):
-        if line['author'].strip().lower() in self.ignored_authors:
+        if not self.keep(line):
             return None
         return line
 
 class DistinguishedPostCleaner(BaseCleaner):
+    input_keys = ('distinguished',)
+    filter_only = True
+
+    def keep(self, line):
+        return line['distinguished'] is not None
+
     def clean(self, line, primary_key):
-        if line['distinguished'] is None:
+        if not self.keep(line):
             return None
         return line
 
 class SubredditCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class SubredditMetadataCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class SubredditCommentMediaCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class SubredditMediaCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class SubredditSettingsCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
 
 class SubredditPermissionsCleaner(BaseCleaner):
+    filter_only = True
+
     def clean(self, line, primary_key):
         return line
\ No newline at end of file
@@ -1,77 +1,125 @@
 import orjson as json
-from general import write_json, load_json
-from line_counts import get_line_count_file
+from general import load_json, save_character_lengths
+from line_counts import get_line_count_file, load_line_index
+from ndjson_reader import iter_lines, iter_line_blocks, split_block_lines, split_file_shards, get_line_offset, is_compressed
+from classes.LengthProfiler import LengthProfiler
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from tqdm import tqdm
 import os
 import time
 import gdown
 
-def unnest_json(nested_json: dict) -> dict:
+PROFILE_WORKERS = min(8, os.cpu_count() or 1)  # Number of processes that profile parts of a file
+PROFILE_SHARD_SIZE_BYTES = 64 * 1024 * 1024  # Size of the byte ranges that are profiled by one worker at a time
+PROFILE_BLOCK_SIZE_BYTES = 16 * 1024 * 1024  # Size of the decompressed blocks of a .zst file sent to a worker
+
+
+def get_profile_columns(ndjson_file: str) -> set[str]:
+    """
+    Gets the columns of the tables that are made from a data file (see data_files_tables in config.json), only the
+    lengths of these columns are needed for the column types.
+
+    :param ndjson_file: the data file
+    :return: the column names
+    """
+    tables = load_json('config.json')['data_files_tables'][ndjson_file]['sql']
+    schema = load_json('schemas/db_schema.json')
+    return {column for table in tables for column in schema[table]['columns']}
+
+
+def profile_lines(lines, columns: set[str]) -> tuple[LengthProfiler, int]:
     """
-    Flatten a nested JSON object, keeping only the final key names.
-    If keys repeat at different levels, later ones will overwrite earlier ones.
+    Profiles the character lengths of the columns in NDJSON lines.
 
-    :param nested_json: The JSON object to flatten.
-    :return: A flattened dictionary with only leaf keys.
+    :param lines: the lines as bytes
+    :param columns: the columns to profile
+    :return: the profiler and the number of lines read
     """
-    flat_dict = {}
+    profiler = LengthProfiler(columns)
+    line_count = 0
+    for line in lines:
+        line_count += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            profiler.profile_line(json.loads(line))
+        except json.JSONDecodeError:
+            print(f"Skipping invalid JSON line: {line.decode('utf-8', errors='replace')}")
+    return profiler, line_count
 
-    def _unnest(obj):
-        if isinstance(obj, dict):
-            for key, value in obj.items():
-                if isinstance(value, (dict, list)):
-                    _unnest(value)
-                else:
-                    flat_dict[key] = value
-        elif isinstance(obj, list):
-            for item in obj:
-                _unnest(item)
 
-    _unnest(nested_json)
-    return flat_dict
+def profile_shard(ndjson_file: str, start: int, end: int, columns: set[str]) -> tuple[LengthProfiler, int]:
+    """Profiles a shard (byte range) of an uncompressed data file, see profile_lines. Runs in a worker process."""
+    return profile_lines(iter_lines(ndjson_file, start, end), columns)
 
 
-def find_max_char_lengths(ndjson_file, output_file, max_line_count, progress_bar):
+def profile_block(block: bytes, columns: set[str]) -> tuple[LengthProfiler, int]:
+    """Profiles a block of a decompressed data file (see iter_line_blocks), see profile_lines. Runs in a worker process."""
+    return profile_lines(split_block_lines(block), columns)
+
+
+def iter_profile_tasks(ndjson_file: str, max_line_count: int | None, columns: set[str]):
+    """
+    Splits a data file into tasks for the worker processes: shards of an uncompressed file (ending at the maximum
+    number of lines), or blocks of a compressed file (the last block is cut at the maximum number of lines).
+
+    :return: generator yielding the tasks as (function, arguments...)
+    """
+    if not is_compressed(ndjson_file):
+        line_index = load_line_index(ndjson_file)
+        stop = None if max_line_count is None else get_line_offset(ndjson_file, max_line_count, line_index)
+        for start, end in split_file_shards(ndjson_file, PROFILE_SHARD_SIZE_BYTES, line_index, stop):
+            yield profile_shard, ndjson_file, start, end, columns
+        return
+
+    remaining_lines = max_line_count
+    blocks = iter_line_blocks(ndjson_file, PROFILE_BLOCK_SIZE_BYTES)
+    try:
+        for block in blocks:
+            if remaining_lines is not None:
+                lines = split_block_lines(block)
+                if len(lines) >= remaining_lines:
+                    if remaining_lines > 0:
+                        yield profile_block, b'\n'.join(lines[:remaining_lines]), columns
+                    return
+                remaining_lines -= len(lines)
+            yield profile_block, block, columns
+    finally:
+        blocks.close()  # Stops the decompression
+
+
+def find_max_char_lengths(ndjson_file, output_file, max_line_count, progress_bar, workers=PROFILE_WORKERS):
     """
     Finds the maximum count of characters per attribute in a NDJSON file, writes this results to a json file.
+    Only the columns of the tables of the file in the schema are counted. Parts of the file are profiled in parallel,
+    besides the maximum also the percentiles and histogram of the lengths are written (to
+    character_length_statistics.json, see save_character_lengths).
 
     :param ndjson_file: the NDJSON file containing the data you want to count
     :param output_file: the JSON file where the results will be written to
     :param max_line_count: the maximum number of lines to process in the NDJSON file, set to None to process all lines
     :param progress_bar: a tqdm progress bar that displays the progress made in counting
+    :param workers: number of worker processes
     """
-    max_lengths = {}
-    count = 0
-    current_data = {}
-    if os.path.isfile(output_file):
-        current_data = load_json(output_file)
-    with open(ndjson_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            progress_bar.update(1)
-            line = line.strip()
-            count += 1
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-                obj = unnest_json(obj)
-                for key, value in obj.items():
-                    value_str = str(value)
-                    current_length = len(value_str)
-                    if key not in max_lengths or current_length > max_lengths[key]:
-                        max_lengths[key] = current_length
-            except json.JSONDecodeError:
-                print(f"Skipping invalid JSON line: {line}")
-            if max_line_count is not None and count >= max_line_count:
+    columns = get_profile_columns(ndjson_file)
+    profiler = LengthProfiler(columns)
+
+    tasks = iter_profile_tasks(ndjson_file, max_line_count, columns)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Keep a limited number of tasks in flight, so the blocks of a compressed file don't fill the memory
+            while len(pending) < workers * 2 and (task := next(tasks, None)) is not None:
+                pending.append(executor.submit(*task))
+            if not pending:
                 break
+            task_profiler, line_count = pending.popleft().result()
+            profiler.merge(task_profiler)
+            progress_bar.update(line_count)
 
-    # Write the results as JSON
-    current_data[ndjson_file] = max_lengths
-
-    # Add rule_id for subreddit_rules_2025-01
-    if ndjson_file == 'data/subreddits/subreddit_rules_2025-01/subreddit_rules_2025-01':
-        current_data['data/subreddits/subreddit_rules_2025-01/subreddit_rules_2025-01']['rule_id'] = 20
-    write_json(current_data, output_file)
+    save_character_lengths(ndjson_file, profiler, output_file)
 
 
 def generate_character_lengths(files_to_process_count: dict):
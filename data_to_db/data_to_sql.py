@@ -1,29 +1,48 @@
 from typing import Any, Generator
 from classes.DBType import DBTypes, DBType
 from classes.logger import Logger
-import pandas as pd
 import orjson as json
 import os
 import math
-from itertools import chain
-from pandas import DataFrame
+from itertools import chain, islice
+from array import array
 from sqlalchemy import text, Engine, Connection
 from tqdm import tqdm
-from general import get_tables_database, write_json, update_summary_log
+from general import get_tables_database, write_json, update_summary_log, save_character_lengths, write_dead_letter
+from general import update_index_summary_log
 from general import load_json_cached as load_json
 from general import load_json as load_json_no_cache
-from line_counts import get_line_count_file
+from line_counts import get_line_count_file, load_line_index, save_line_count, compute_fingerprint, is_unchanged
 import sys
 import time
 from classes.cleaners import *
 from classes.BaseCleaner import BaseCleaner
 from datetime import datetime
-from general import should_skip
+from ndjson_reader import split_file_shards, iter_lines, iter_line_blocks, split_block_lines, is_compressed
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from classes.WriterPipeline import WriterPipeline
+from classes.RowBatch import RowBatch
+from classes.TablePlan import TablePlan
+from classes.FilePlan import FilePlan
+from classes.LengthProfiler import LengthProfiler
+from classes.DedupStore import DedupStore, MemoryDedupStore, SQLiteDedupStore
+from classes.Checkpoint import Checkpoint, load_checkpoints
+from functools import partial
+import threading
+from data_to_db.sql_writers import insert_rows, copy_to_postgres, load_data_to_mysql, start_mysql_bulk_load, end_mysql_bulk_load
+from data_to_db.sql_writers import executemany_to_sqlite, start_sqlite_bulk_load, end_sqlite_bulk_load, analyze_sqlite
+from data_to_db.sql_writers import commit_sqlite_chunk, savepoint, ON_CONFLICT_MODES, MAX_MYSQL_VARCHAR_PRIMARY_KEY_LENGTH
+from data_to_db.index_builder import build_indexes
 
 progress_bar = None
 clean_errors = 0
+line_profiler = None  # Profiles the decoded lines during the import when profile_during_import is set, see extract_lines
 maximum_rows_database = 0
 MAX_MYSQL_TEXT_LENGTH = 65_500 # The actual max length is 65,535, but we keep some safety margin
+SHARD_SIZE_BYTES = 64 * 1024 * 1024  # Size of the byte ranges that are cleaned by one worker process at a time
+# Size of the decompressed blocks of a .zst file that are sent to a worker process (compressed files can't be split)
+COMPRESSED_SHARD_SIZE_BYTES = 16 * 1024 * 1024
 
 # Load the schema in memory since it improved performance, reading the JSON many times takes time
 schema_global = None
@@ -78,37 +97,50 @@ def get_cleaner(table: str, db_type: DBType, ignored_author_names: set) -> BaseC
     :param ignored_author_names: author names to ignore
     :return: cleaner for the given table.
     """
+    # Only the cleaner of the given table is made
     cleaners = {
-        'post': PostCleaner(),
-        'distinguished_post': DistinguishedPostCleaner(),
-        'author': AuthorCleaner(ignored_author_names),
-        'subreddit': SubredditCleaner(),
-        'subreddit_metadata': SubredditMetadataCleaner(),
-        'subreddit_settings': SubredditSettingsCleaner(),
-        'subreddit_media': SubredditMediaCleaner(),
-        'subreddit_permissions': SubredditPermissionsCleaner(),
-        'subreddit_comment_media': SubredditCommentMediaCleaner(),
-        'subreddit_rules': SubredditRulesCleaner(),
-        'removed': RemovedCleaner(),
-        'comment': CommentCleaner(),
-        'collapsed_comment': CollapsedCommentCleaner(),
-        'distinguished_comment': DistinguishedCommentCleaner(),
-        'wiki': WikiCleaner(db_type),
-        'revision_wiki': WikiRevisionCleaner(),
+        'post': PostCleaner,
+        'distinguished_post': DistinguishedPostCleaner,
+        'author': lambda: AuthorCleaner(ignored_author_names),
+        'subreddit': SubredditCleaner,
+        'subreddit_metadata': SubredditMetadataCleaner,
+        'subreddit_settings': SubredditSettingsCleaner,
+        'subreddit_media': SubredditMediaCleaner,
+        'subreddit_permissions': SubredditPermissionsCleaner,
+        'subreddit_comment_media': SubredditCommentMediaCleaner,
+        'subreddit_rules': SubredditRulesCleaner,
+        'removed': RemovedCleaner,
+        'comment': CommentCleaner,
+        'collapsed_comment': CollapsedCommentCleaner,
+        'distinguished_comment': DistinguishedCommentCleaner,
+        'wiki': lambda: WikiCleaner(db_type),
+        'revision_wiki': WikiRevisionCleaner,
     }
-    return cleaners.get(table, BaseCleaner())
+    return cleaners.get(table, BaseCleaner)()
 
 
-def clean_line(line_input: str, tables: list, table_columns: dict, ignored_author_names: set, db_type: DBType) -> dict[str, list[dict]]|None:
+def make_table_plans(tables: list, table_columns: dict, ignored_author_names: set, db_type: DBType) -> dict[str, TablePlan]:
     """
-    Gets a line and cleans it for all the tables.
+    Makes the plans to clean the lines for the tables, once per import.
 
-    :param line_input: Line to clean
-    :param tables: tables for the line
+    :param tables: tables for the lines
     :param table_columns: columns for the tables
     :param ignored_author_names: author names to ignore
     :param db_type: database type
-    :return: A dict with as a key the table name and value the cleaned line for that table.
+    :return: A dict with as a key the table name and value the plan for that table (in the order of tables).
+    """
+    return {table: TablePlan(table, table_columns[table], get_primary_key(table),
+                             get_cleaner(table, db_type, ignored_author_names))
+            for table in tables}
+
+
+def clean_line(line_input: bytes | memoryview, file_plan: FilePlan) -> dict[str, list[tuple] | None] | None:
+    """
+    Gets a line and cleans it for all the tables.
+
+    :param line_input: Line to clean
+    :param file_plan: plan of the tables for the line, see make_table_plans
+    :return: A dict with as a key the table name and value the rows for that table (None if the line is skipped).
     If there is an error with the line, it returns None.
     """
     global clean_errors
@@ -118,45 +150,55 @@ def clean_line(line_input: str, tables: list, table_columns: dict, ignored_autho
     except:
         clean_errors += 1
         return None
+    if line_profiler is not None:
+        line_profiler.profile_line(line_input)
+    if not isinstance(line_input, dict):
+        clean_errors += 1
+        return None
 
-    cleaned_data = dict()
-    for table in tables:
-        cleaned_data[table] = None
-
-    for table in tables:
-        line = line_input
-        items_to_keep = table_columns[table]
-        pm = get_primary_key(table)
-        cleaner = get_cleaner(table, db_type, ignored_author_names)
-        line = cleaner.clean(line, pm)
-        if line is None:
-            continue
+    return file_plan.execute(line_input)
 
-        # If the value of the primary key(s) is/are null or all other values are null, then skip this line
-        if should_skip(line, pm):
-            continue
-        if not isinstance(line, list):
-            line = [line]
+DEDUP_STORES = ('memory', 'sqlite')
+DEFAULT_DEDUP_TABLES = ['author']
+# Primary keys of the rows that were already added to the deduplicated tables, set per database by main
+dedup_store: DedupStore = MemoryDedupStore(DEFAULT_DEDUP_TABLES)
 
-        cleaned_lines = []
-        for l in line:
-            l = {key: l[key] for key in items_to_keep if key in l}
-            cleaned_lines.append(l)
 
-        cleaned_data[table] = cleaned_lines
+def make_dedup_store(db_type: DBType, db_config: dict, tables: list[str] | None = None) -> DedupStore:
+    """
+    Makes the store that deduplicates the rows of tables over all chunks and data files, set by dedup_store
+    ('memory' or 'sqlite', which is saved in the databases folder so it is kept when the import is started again)
+    and dedup_tables in the config of the database.
 
-    return cleaned_data
+    :param db_type: database type
+    :param db_config: config of the database type
+    :param tables: the tables to deduplicate instead of dedup_tables
+    :raises ValueError: if the store is unknown or a table has no primary key
+    :return: the dedup store
+    """
+    store = db_config.get('dedup_store', 'memory')
+    if tables is None:
+        tables = db_config.get('dedup_tables', DEFAULT_DEDUP_TABLES)
+    for table in tables:
+        if not get_primary_key(table):
+            raise ValueError(f'[{db_type.display_name}] Table {table} has no primary key to deduplicate on')
+    match store:
+        case 'memory':
+            return MemoryDedupStore(tables)
+        case 'sqlite':
+            return SQLiteDedupStore(tables, f'databases/dedup_{db_type.to_string()}_{db_type.name_suffix}.db')
+        case _:
+            raise ValueError(f"[{db_type.display_name}] Unknown dedup_store '{store}', use one of {DEDUP_STORES}")
 
-seen_authors = set()
 
-def process_cleaned_lines(cleaned_lines_dct) -> dict[str, pd.DataFrame]:
+def process_cleaned_lines(cleaned_lines_dct, table_columns: dict) -> dict[str, RowBatch | None]:
     """
-    Converts cleaned line entries to DataFrames, optionally ensuring globally unique rows based on primary keys.
+    Converts cleaned rows to row batches, optionally ensuring globally unique rows based on primary keys.
 
-    :param cleaned_lines_dct: cleaned lines dictionary
-    :return: A dict with the table name as key and a DataFrame (deduplicated if authors) as value.
+    :param cleaned_lines_dct: cleaned rows dictionary
+    :param table_columns: columns for the tables, the order of the values in the rows
+    :return: A dict with the table name as key and a RowBatch (deduplicated for the tables of the dedup store) as value.
     """
-    global seen_authors
 
     for table_name, data in cleaned_lines_dct.items():
         if not data:
@@ -168,37 +210,77 @@ def process_cleaned_lines(cleaned_lines_dct) -> dict[str, pd.DataFrame]:
             cleaned_lines_dct[table_name] = None
             continue
 
-        # Check if users are already added
-        if table_name == 'author':
-            unique_rows_author = []
-            for d in data:
-                author_fullname = d['author_fullname']
-                if author_fullname in seen_authors:
-                    continue
-                seen_authors.add(author_fullname)
-                unique_rows_author.append(d)
+        # Skip the rows with a primary key that was already added (for example authors with more than one post)
+        if table_name in dedup_store.tables:
+            key_indexes = [table_columns[table_name].index(column) for column in primary_key_column]
+            data = dedup_store.filter_new(table_name, data, key_indexes)
+            if len(data) == 0:
+                cleaned_lines_dct[table_name] = None
+                continue
 
-            cleaned_lines_dct['author'] = unique_rows_author
-            del unique_rows_author  # Clean the list to clean memory
-            if len(cleaned_lines_dct['author']) == 0:
-                cleaned_lines_dct['author'] = None
+        cleaned_lines_dct[table_name] = RowBatch(table_columns[table_name], data)
+    return cleaned_lines_dct
 
 
-        df = pd.DataFrame(cleaned_lines_dct[table_name])
 
-        # Clean up strange data types and null characters
-        df = df.map(lambda x: str(x) if isinstance(x, (list, dict)) else x)
-        df = df.map(lambda x: x.replace("\x00", "") if isinstance(x, str) else x)
+sql_count = 0
 
-        cleaned_lines_dct[table_name] = df
-    return cleaned_lines_dct
+sql_count_lock = threading.Lock()
+write_stats = {}  # Number of rows written and time spent writing them for the current data file
 
+# Methods to write the chunks to the database and the database types that support them
+WRITE_METHODS = {
+    'insert': [DBTypes.SQLITE, DBTypes.MYSQL, DBTypes.POSTGRESQL],
+    'copy': [DBTypes.POSTGRESQL],
+    'load_data': [DBTypes.MYSQL],
+    'executemany': [DBTypes.SQLITE],
+}
 
 
-sql_count = 0
+def get_write_method(db_type: DBType, db_config: dict) -> str:
+    """
+    Gets the method to write the chunks to the database from the database config.
+
+    :param db_type: database type
+    :param db_config: config of the database in config.json
+    :raises ValueError: if the write method is unknown or not supported by the database type, or if the SQLite journal
+    is turned off for executemany (then a savepoint can't be rolled back, see write_isolating_rows)
+    :return: the write method
+    """
+    write_method = db_config.get('write_method', 'insert')
+    if write_method == 'to_sql':
+        write_method = 'insert'  # Name of the insert method when it still wrote through pandas
+    if write_method not in WRITE_METHODS:
+        raise ValueError(f'[{db_type.display_name}] Unknown write method: {write_method}')
+    if db_type.get_type() not in WRITE_METHODS[write_method]:
+        raise ValueError(f"[{db_type.display_name}] Write method '{write_method}' is not supported for {db_type.to_string_capitalized()}")
+    if write_method == 'executemany' and db_config.get('executemany', {}).get('journal_mode', 'MEMORY').upper() == 'OFF':
+        raise ValueError(f"[{db_type.display_name}] journal_mode 'OFF' can't roll back the rows of a batch that failed, "
+                         f"so they would be in the table and in the dead-letter file. Use 'MEMORY' or 'WAL'")
+    return write_method
+
+
+def get_on_conflict(db_type: DBType, db_config: dict, table: str) -> str:
+    """
+    Gets what to do with rows of a table that have the same primary key as a row in the table, from the database
+    config: 'on_conflict_tables' can set the mode per table, the other tables use 'on_conflict' (default 'ignore').
+
+    :param db_type: database type
+    :param db_config: config of the database in config.json
+    :param table: the table
+    :raises ValueError: if the mode is unknown
+    :return: the conflict mode, see ON_CONFLICT_MODES
+    """
+    on_conflict = db_config.get('on_conflict_tables', {}).get(table, db_config.get('on_conflict', 'ignore'))
+    if on_conflict not in ON_CONFLICT_MODES:
+        raise ValueError(f"[{db_type.display_name}] Unknown on_conflict mode for table {table}: {on_conflict}")
+    return on_conflict
+
 
 def process_table(data_file: str, tables: list, engine: Engine,
-                  table_columns: dict, ignored_author_names: set, chunk_size: int, db_type: DBType):
+                  table_columns: dict, ignored_author_names: set, chunk_size: int, db_type: DBType, workers: int = 1,
+                  writer_threads: int = 1, write_queue_size: int = 4, write_method: str = 'insert',
+                  on_conflict: dict[str, str] | None = None, checkpoint: Checkpoint | None = None):
     """
     Processes tables, so writing the data to a database.
 
@@ -209,22 +291,203 @@ def process_table(data_file: str, tables: list, engine: Engine,
     :param ignored_author_names: author names to ignore.
     :param chunk_size: Number of lines to read at a time
     :param db_type: database type
+    :param workers: number of processes that parse and clean the lines, 1 cleans the lines in the main process
+    :param writer_threads: number of threads that write the chunks to the database while the next chunks are parsed,
+    0 writes the chunks in the main thread
+    :param write_queue_size: maximum number of chunks that wait to be written, limits the memory usage
+    :param write_method: method to write the chunks, see WRITE_METHODS
+    :param on_conflict: conflict mode per table (see get_on_conflict), tables that are not in it use 'error'
+    :param checkpoint: checkpoint of the data file and tables, the import continues from it and it is moved forward
+    when the chunks are committed
     """
-    global sql_count
+    global sql_count, write_stats
+    write_stats = {'write_method': write_method, 'rows_written': 0, 'write_seconds': 0.0, 'dead_letter_rows': 0}
+
+    # SQLite allows only one writer at a time, more writer threads would only wait for each other's locks
+    if db_type.is_type(DBTypes.SQLITE):
+        writer_threads = min(writer_threads, 1)
+
+    # With LOAD DATA and executemany, the session settings are changed for the whole load (per connection)
+    # and restored afterward
+    setup_connection, teardown_connection = None, None
+    if write_method == 'load_data':
+        setup_connection, teardown_connection = start_mysql_bulk_load, end_mysql_bulk_load
+    elif write_method == 'executemany':
+        setup_connection, teardown_connection = start_sqlite_bulk_load, end_sqlite_bulk_load
+
+    write_function = partial(write_to_db, len_tables=len(tables), db_type=db_type, chunk_size=chunk_size,
+                             write_method=write_method, on_conflict=on_conflict or {})
+    writer = WriterPipeline(engine, write_function, writer_threads=writer_threads, queue_size=write_queue_size,
+                            setup_connection=setup_connection, teardown_connection=teardown_connection)
+    start_line, start_offset = 0, 0
+    if checkpoint is not None and checkpoint.line_number > 0:
+        start_line, start_offset = checkpoint.line_number, checkpoint.byte_offset or 0
+        print(f'[{db_type.display_name}] Continuing {tables} from line {start_line:,} of {data_file}')
 
     added_count = 0
-    for chunk_data in extract_lines(data_file, tables, table_columns, ignored_author_names, db_type, chunk_size):
-        for table_name, data in chunk_data.items():
-            if data is not None and not data.empty:
-                write_to_db(data, table_name, engine, len(chunk_data), chunk_size=chunk_size, db_type=db_type)
+    try:
+        for chunk_data, line_number, byte_offset in extract_lines(data_file, tables, table_columns,
+                                                                  ignored_author_names, db_type, chunk_size, workers,
+                                                                  writer, start_line, start_offset):
+            batches = [(table_name, data) for table_name, data in chunk_data.items()
+                       if data is not None and len(data) > 0]
+            chunk_id = None
+            if checkpoint is not None:
+                chunk_id = checkpoint.add_chunk(line_number, byte_offset, len(batches))
+            for table_name, data in batches:
+                on_commit = None
+                if checkpoint is not None:
+                    on_commit = partial(checkpoint.batch_committed, chunk_id, table_name)
+                writer.put(data, table_name, on_commit=on_commit)
                 added_count += 1
+    finally:
+        writer.close()
     sql_count = 0  # Reset count for the progress bar
-    if added_count == 0:
+    if added_count == 0 and start_line == 0:
         print(f'[{db_type.display_name}] Error! All chunks of {tables} were empty')
 
 
-def extract_lines(data_file: str, tables: list, table_columns: dict, ignored_author_names: set, db_type: DBType, chunk_size: int) -> Generator[
-    dict[str, DataFrame], Any, None]:
+# Plan of the tables and the columns to profile (None if not profiled), set once per worker process by init_clean_worker
+_worker_file_plan = None
+_worker_profile_columns = None
+
+
+def init_clean_worker(file_plan: FilePlan, profile_columns: set[str] | None = None):
+    """
+    Initializes a worker process of the cleaning pool, so the plan doesn't have to be sent with every shard.
+
+    :param file_plan: plan of the tables of the data file
+    :param profile_columns: columns to profile the lengths of (see LengthProfiler), None to not profile the lines
+    """
+    global _worker_file_plan, _worker_profile_columns
+    _worker_file_plan = file_plan
+    _worker_profile_columns = profile_columns
+
+
+def start_worker_profile():
+    """
+    Starts a new profile for a shard or block in a worker process, when the lines are profiled.
+    """
+    global line_profiler
+    line_profiler = None if _worker_profile_columns is None else LengthProfiler(_worker_profile_columns)
+
+
+def clean_lines(lines) -> tuple[list[dict[str, list[tuple] | None] | None], array, int, LengthProfiler | None]:
+    """
+    Cleans lines with the plan of the worker process, see clean_shard and clean_block.
+    """
+    global clean_errors
+    clean_errors = 0
+    start_worker_profile()
+    cleaned_lines = []
+    line_sizes = array('Q')
+    for line in lines:
+        cleaned_lines.append(clean_line(line, _worker_file_plan))
+        line_sizes.append(len(line) + 1)
+    return cleaned_lines, line_sizes, clean_errors, line_profiler
+
+
+def clean_shard(data_file: str, start: int, end: int) -> tuple[list[dict[str, list[tuple] | None] | None], array, int,
+                                                                LengthProfiler | None]:
+    """
+    Cleans all the lines of a shard (byte range) of the data file. Runs in a worker process.
+
+    :param data_file: Path to the Reddit data file
+    :param start: byte offset of the first line of the shard
+    :param end: byte offset of the end of the shard (exclusive)
+    :return: The cleaned lines (output of clean_line) in input order, the number of bytes of each line (with the
+    newline), the number of lines that could not be cleaned and the profile of the lines (None if the lines are not
+    profiled)
+    """
+    return clean_lines(iter_lines(data_file, start, end, use_mmap=True))
+
+
+def clean_block(block: bytes) -> tuple[list[dict[str, list[tuple] | None] | None], array, int, LengthProfiler | None]:
+    """
+    Cleans all the lines of a block of a decompressed data file (see iter_line_blocks). Runs in a worker process.
+
+    :param block: the block, it only has complete lines
+    :return: The cleaned lines (output of clean_line) in input order, the number of bytes of each line (with the
+    newline), the number of lines that could not be cleaned and the profile of the lines (None if the lines are not
+    profiled)
+    """
+    return clean_lines(split_block_lines(block))
+
+
+def iter_cleaned_lines(data_file: str, file_plan: FilePlan, workers: int = 1, start_line: int = 0,
+                       start_offset: int = 0) -> Generator[tuple[dict[str, list[tuple] | None] | None, int], Any, None]:
+    """
+    Yields the cleaned lines (output of clean_line) of the data file in input order.
+    With more than one worker, the file is split in shards at newline boundaries that are cleaned by a process pool.
+    A compressed file is decompressed in the main process and its blocks are sent to the pool instead.
+
+    :param data_file: Path to the Reddit data file
+    :param file_plan: Plan of the tables of the data file
+    :param workers: Number of worker processes, 1 cleans the lines in the main process
+    :param start_line: number of the first line to clean, to continue an import (the lines before it are skipped)
+    :param start_offset: byte offset of the first line to clean (for uncompressed files, these are read from there)
+    :return: generator yielding the cleaned line and the number of bytes of the line (with the newline)
+    """
+    global clean_errors
+
+    compressed = is_compressed(data_file)
+    if workers <= 1:
+        if compressed:
+            lines = islice(iter_lines(data_file), start_line, None)
+        else:
+            lines = iter_lines(data_file, start=start_offset)
+        for line in lines:
+            yield clean_line(line, file_plan), len(line) + 1
+        return
+
+    if compressed:
+        blocks = iter_line_blocks(data_file, COMPRESSED_SHARD_SIZE_BYTES, skip_lines=start_line)
+        tasks = ((clean_block, block) for block in blocks)
+    else:
+        blocks = None
+        # The line index made when the lines were counted gives the shard boundaries without reading the file
+        shards = split_file_shards(data_file, SHARD_SIZE_BYTES, load_line_index(data_file), start=start_offset)
+        tasks = ((clean_shard, data_file, start, end) for start, end in shards)
+
+    pending = deque()
+    profile_columns = None if line_profiler is None else line_profiler.columns
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_clean_worker,
+                             initargs=(file_plan, profile_columns)) as executor:
+        try:
+            while True:
+                # Keep a limited number of shards in flight, so memory stays bounded when the writes are slower
+                while len(pending) < workers * 2 and (task := next(tasks, None)) is not None:
+                    pending.append(executor.submit(*task))
+                if not pending:
+                    break
+
+                cleaned_lines, line_sizes, shard_clean_errors, shard_profiler = pending.popleft().result()
+                clean_errors += shard_clean_errors
+                if shard_profiler is not None:
+                    line_profiler.merge(shard_profiler)
+                yield from zip(cleaned_lines, line_sizes)
+        finally:
+            # Cancel the shards that are not needed anymore (for example when the maximum number of rows is reached)
+            for future in pending:
+                future.cancel()
+            if blocks is not None:
+                blocks.close()  # Stops the decompression
+
+
+def is_file_profiled(data_file: str) -> bool:
+    """
+    Checks if the character lengths of a data file were already found, by count_characters_db.py or the profile stage.
+
+    :param data_file: Path to the Reddit data file
+    :return: True if the data file is in character_lengths.json
+    """
+    # Checked without load_json, since that would make an empty character_lengths.json
+    return os.path.isfile('character_lengths.json') and data_file in load_json_no_cache('character_lengths.json')
+
+
+def extract_lines(data_file: str, tables: list, table_columns: dict, ignored_author_names: set, db_type: DBType, chunk_size: int,
+                  workers: int = 1, writer: WriterPipeline | None = None, start_line: int = 0,
+                  start_offset: int = 0) -> Generator[tuple[dict[str, RowBatch | None], int, int], Any, None]:
     """
     Processes lines from the Reddit data file.
 
@@ -235,75 +498,202 @@ def extract_lines(data_file: str, tables: list, table_columns: dict, ignored_aut
     :param ignored_author_names: Author names to ignore
     :param db_type: The database type
     :param chunk_size: Number of lines to read at a time
+    :param workers: Number of processes that parse and clean the lines, 1 cleans the lines in the main process
+    :param writer: Pipeline that writes the yielded chunks, the summary log is written after it has written all chunks
+    :param start_line: number of the first line to process, to continue an import from a checkpoint
+    :param start_offset: byte offset of the first line to process
 
-    :return: A dict with as a key the table name and value the cleaned lines for that table in pandas DataFrame
+    :return: A dict with as a key the table name and value the cleaned lines for that table in a RowBatch, the number
+    of lines of the data file after the chunk and the byte offset after the last line of the chunk
     """
-    global progress_bar
+    global progress_bar, line_profiler
     lines_clean = {}
     for table_name in tables:
         lines_clean[table_name] = []
 
     start_time = datetime.now()
-    progress_bar_total = min(get_line_count_file(data_file), maximum_rows_database)
-    progress_bar = tqdm(total=progress_bar_total, desc=f"[{db_type.display_name}] Processing {len(tables)} table(s): {tables} (from {data_file.split('/')[-1]})")
-
-    lines_cleaned_count = 0
-    with open(data_file, 'r', encoding='utf-8') as f_data:
-
-        for line in f_data:
-            cleaned_data = clean_line(line, tables, table_columns, ignored_author_names, db_type)
+    # The line count is only used for the progress bar, so it can be estimated if it is not cached yet
+    estimate_line_count = load_json('config.json').get('estimate_line_counts', False)
+    progress_bar_total = min(get_line_count_file(data_file, estimate=estimate_line_count), maximum_rows_database)
+    progress_bar = tqdm(total=progress_bar_total, initial=min(start_line, progress_bar_total),
+                        desc=f"[{db_type.display_name}] Processing {len(tables)} table(s): {tables} (from {data_file.split('/')[-1]})")
+
+    # The profile stage saves the line count and character lengths of the file while it is read anyway, so they don't
+    # need a separate pass for the next database types (only for files that are not in character_lengths.json yet,
+    # and not when the import continues from a checkpoint, since then not all lines are read)
+    if load_json('config.json').get('profile_during_import', False) and not is_file_profiled(data_file) \
+            and start_line == 0:
+        line_profiler = LengthProfiler({column for table_name in tables for column in table_columns[table_name]})
+
+    lines_cleaned_count = start_line
+    byte_offset = start_offset
+    file_plan = FilePlan(make_table_plans(tables, table_columns, ignored_author_names, db_type))
+    cleaned_lines_iterator = iter_cleaned_lines(data_file, file_plan, workers, start_line, start_offset)
+    for cleaned_data, line_size in cleaned_lines_iterator:
+        # Checked before the line is added, since a checkpoint can already be at the maximum
+        if lines_cleaned_count >= maximum_rows_database:
+            break
+        if cleaned_data is not None:  # None if the line could not be decoded
             for table_name, lines_cleaned in cleaned_data.items():
                 if lines_cleaned is not None:
                     lines_clean[table_name].extend(lines_cleaned)
 
-            lines_cleaned_count += 1
-            progress_bar.update(1)
-
-            if lines_cleaned_count % chunk_size == 0 and lines_cleaned_count > 0:
-                yield process_cleaned_lines(lines_clean)
-                # Clean the dict for the next iteration
-                lines_clean = dict()
-                for table_name in tables:
-                    lines_clean[table_name] = []
-            if lines_cleaned_count >= maximum_rows_database:
-                break
+        lines_cleaned_count += 1
+        byte_offset += line_size
+        progress_bar.update(1)
+
+        if lines_cleaned_count % chunk_size == 0 and lines_cleaned_count > 0:
+            yield process_cleaned_lines(lines_clean, table_columns), lines_cleaned_count, byte_offset
+            # Clean the dict for the next iteration
+            lines_clean = dict()
+            for table_name in tables:
+                lines_clean[table_name] = []
+    cleaned_lines_iterator.close()  # Stops the worker processes if the loop stopped early
+
+    # The profile is only complete when the whole file was read (the loop only stops early at the maximum rows)
+    if line_profiler is not None and lines_cleaned_count < maximum_rows_database:
+        save_line_count(data_file, lines_cleaned_count)
+        save_character_lengths(data_file, line_profiler)
+        print(f"[{db_type.display_name}] Saved the line count and character lengths of {data_file}")
+    line_profiler = None
 
     # Write progress bar results to log a file
     print(str(progress_bar))
 
     progress_bar.close()
     if lines_clean:
-        yield process_cleaned_lines(lines_clean)
+        # The last line of the file doesn't always end with a newline
+        if not is_compressed(data_file):
+            byte_offset = min(byte_offset, os.path.getsize(data_file))
+        yield process_cleaned_lines(lines_clean, table_columns), lines_cleaned_count, byte_offset
 
     # Update log summary
+    if writer is not None:
+        writer.join()
+    # All rows of the file are written, so the keys of the deduplicated tables can be saved
+    dedup_store.commit()
+    dedup_stats = None
+    if dedup_store.tables & set(tables):
+        dedup_stats = dedup_store.get_statistics()
+        print(f"[{db_type.display_name}] Dedup store: {dedup_stats['tables']}, "
+              f"{dedup_stats['memory_bytes'] / 1024 / 1024:.1f} MB memory")
     end_time = datetime.now()
     update_summary_log(db_type=db_type, data_file=data_file,
                        start_time=start_time, end_time=end_time,
                        line_count=lines_cleaned_count, total_lines=progress_bar_total,
                        tables=tables, chunk_size=chunk_size,
-                       sql_writes=sql_count)
+                       sql_writes=sql_count, write_stats=write_stats, dedup_stats=dedup_stats)
+
+
+def write_batch(batch: RowBatch, table: str, conn: Connection, write_method: str, on_conflict: str) -> int:
+    """
+    Writes a batch of rows to the database with the write method.
+
+    :param batch: rows to write
+    :param table: table name
+    :param conn: database connection
+    :param write_method: method to write the batch, see WRITE_METHODS
+    :param on_conflict: what to do with rows that have the same primary key as a row in the table, see ON_CONFLICT_MODES
+    :return: the number of rows written (rows skipped because of a conflict are not counted)
+    """
+    match write_method:
+        case 'copy':
+            return copy_to_postgres(batch, table, conn, on_conflict)
+        case 'load_data':
+            return load_data_to_mysql(batch, table, conn, get_mysql_column_types(table), on_conflict)
+        case 'executemany':
+            return executemany_to_sqlite(batch, table, conn, on_conflict)
+        case _:
+            return insert_rows(batch, table, conn, on_conflict)
+
 
+def is_row_error(error: BaseException) -> bool:
+    """
+    Checks if an error is caused by the values of rows (for example a duplicate key or a value that is too long for
+    its column), then writing the batch without these rows works. Errors of the connection or the database are not.
 
-def write_to_db(df: pd.DataFrame, table: str, conn: Engine, len_tables: int, db_type: DBType, chunk_size: int=10_000):
+    :param error: the error raised while writing a batch
+    :return: True if the error is caused by the values of rows
     """
-    Write dataframe to the database.
+    if isinstance(error, ValueError):
+        return True  # Raised by the writers for values that the database would change or for rows that were not loaded
+    # The errors of the database drivers (and the SQLAlchemy errors that wrap them) use the class names of the DB API
+    return any(error_class.__name__ in ('IntegrityError', 'DataError') for error_class in type(error).__mro__)
+
 
-    :param df: Pandas DataFrame
+def write_isolating_rows(batch: RowBatch, table: str, conn: Connection, db_type: DBType, write_method: str,
+                         on_conflict: str) -> tuple[int, int]:
+    """
+    Writes a batch of rows in a savepoint. If the values of some rows cause an error, the savepoint is rolled back and
+    both halves of the batch are written separately, until the rows that cause the error are found. Only these rows
+    are written to the dead-letter file (see write_dead_letter), the other rows are written to the table.
+
+    :param batch: rows to write
+    :param table: table name
+    :param conn: database connection
+    :param db_type: database type
+    :param write_method: method to write the batch, see WRITE_METHODS
+    :param on_conflict: what to do with rows that have the same primary key as a row in the table, see ON_CONFLICT_MODES
+    :return: the number of rows written to the table and the number of rows written to the dead-letter file
+    """
+    try:
+        with savepoint(conn, raw_connection=write_method == 'executemany'):
+            rows_written = write_batch(batch, table, conn, write_method, on_conflict)
+        return rows_written, 0
+    except Exception as e:
+        if not is_row_error(e):
+            raise
+        if len(batch) == 1:
+            # The error of the driver, the SQLAlchemy error also contains the whole statement and parameters
+            write_dead_letter(db_type, table, [dict(zip(batch.columns, batch.rows[0]))], str(getattr(e, 'orig', e)))
+            return 0, 1
+
+    middle = len(batch) // 2
+    first_written, first_dead_letter = write_isolating_rows(RowBatch(batch.columns, batch.rows[:middle]), table, conn,
+                                                            db_type, write_method, on_conflict)
+    second_written, second_dead_letter = write_isolating_rows(RowBatch(batch.columns, batch.rows[middle:]), table,
+                                                              conn, db_type, write_method, on_conflict)
+    return first_written + second_written, first_dead_letter + second_dead_letter
+
+
+def write_to_db(batch: RowBatch, table: str, conn: Connection, len_tables: int, db_type: DBType, chunk_size: int=10_000,
+                write_method: str = 'insert', on_conflict: dict[str, str] | None = None) -> int:
+    """
+    Write a batch of rows to the database. Rows that can't be written because of their values go to the dead-letter
+    file, other errors stop the import.
+
+    :param batch: rows to write
     :param table: table name
     :param conn: database connection
     :param len_tables: number of tables that are currently being processed (only used to display in tqdm progress bar)
     :param db_type: database type, either sqlite, mysql, or PostgreSQL
     :param chunk_size: number of lines to read at a time
+    :param write_method: method to write the batch, see WRITE_METHODS
+    :param on_conflict: conflict mode per table (see get_on_conflict), tables that are not in it use 'error'
+    :return: the number of rows written to the table
     """
     global sql_count, progress_bar
+    write_start_time = time.perf_counter()
     try:
-        df.to_sql(table, conn, if_exists="append", index=False, chunksize=5000)
+        rows_written, dead_letter_rows = write_isolating_rows(batch, table, conn, db_type, write_method,
+                                                              (on_conflict or {}).get(table, 'error'))
+        if write_method == 'executemany':
+            commit_sqlite_chunk(conn)
     except Exception as e:
-        df.to_csv('error.csv', index=False)
-        print(f"\n[{db_type.display_name}] Error writing to database: {e}. df written to error.csv.")
+        batch.to_csv('error.csv')
+        print(f"\n[{db_type.display_name}] Error writing to database: {e}. Rows written to error.csv.")
         exit(1)
-    sql_count += 1
-    progress_bar.set_postfix_str(f'[{sql_count:,}/{math.ceil(progress_bar.total / chunk_size * len_tables):,} SQL writes]')
+    if dead_letter_rows:
+        print(f"\n[{db_type.display_name}] {dead_letter_rows:,} row(s) of {table} could not be written, "
+              f"they are in the dead-letter file (logs/dead_letter)")
+    write_seconds = time.perf_counter() - write_start_time
+    with sql_count_lock:  # write_to_db can be called from multiple writer threads
+        sql_count += 1
+        write_stats['rows_written'] = write_stats.get('rows_written', 0) + rows_written
+        write_stats['dead_letter_rows'] = write_stats.get('dead_letter_rows', 0) + dead_letter_rows
+        write_stats['write_seconds'] = write_stats.get('write_seconds', 0.0) + write_seconds
+        progress_bar.set_postfix_str(f'[{sql_count:,}/{math.ceil(progress_bar.total / chunk_size * len_tables):,} SQL writes]')
+    return rows_written
 
 
 def is_file_tables_added_db(data_file, tables, db_info_file) -> list:
@@ -421,19 +811,58 @@ def delete_table_db(table_name: str, engine: Engine, db_type: DBType, schema_tab
         case DBTypes.SQLITE:
             with engine.connect() as conn:
                 conn.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+                conn.commit()
             print(f'[{db_type.display_name}] Deleted table {table_name}')
         case DBTypes.MYSQL:
             with engine.connect() as conn:
                 conn.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+                conn.commit()
             print(f'[{db_type.display_name}] Deleted table {table_name}')
         case DBTypes.POSTGRESQL:
             with engine.connect() as conn:
                 conn.execute(text(f"DROP TABLE IF EXISTS {table_name} CASCADE"))
+                conn.commit()
             print(f'[{db_type.display_name}] Deleted table {table_name}')
         case _:
             raise ValueError(f'[{db_type.display_name}] Unknown database type: {db_type}')
 
 
+def verify_checkpoint(engine: Engine, checkpoint: dict, db_type: DBType, on_conflict: dict[str, str]) -> bool:
+    """
+    Checks if the import of a data file can continue from a saved checkpoint: the data file must not have changed and
+    the tables must have at least the number of rows of the checkpoint. More rows is possible, these rows were
+    committed after the checkpoint was saved and are written again (on_conflict decides what happens with them).
+    Fewer rows means that rows were lost, for example because the database was restored from a backup. Tables with
+    on_conflict 'update' can have fewer rows, since the updated rows are counted in the checkpoint too.
+
+    :param engine: Database engine
+    :param checkpoint: the saved checkpoint, as returned by load_checkpoints
+    :param db_type: the type of the database
+    :param on_conflict: conflict mode per table (see get_on_conflict)
+    :return: True if the import can continue from the checkpoint
+    """
+    data_file = checkpoint['data_file']
+    if not os.path.isfile(data_file) or not is_unchanged(checkpoint['fingerprint'], compute_fingerprint(data_file)):
+        print(f"[{db_type.display_name}] Can't continue from the checkpoint of {data_file}, the data file changed")
+        return False
+
+    with engine.connect() as conn:
+        for table in checkpoint['tables']:
+            if not table_exists(conn, table, db_type):
+                print(f"[{db_type.display_name}] Can't continue from the checkpoint of {data_file}, "
+                      f"table {table} does not exist")
+                return False
+            row_count = conn.execute(text(f'SELECT COUNT(*) FROM {table}')).scalar()
+            checkpoint_rows = checkpoint['rows'].get(table, 0)
+            print(f"[{db_type.display_name}] Checkpoint of {table}: {checkpoint_rows:,} rows at line "
+                  f"{checkpoint['line_number']:,}, the table has {row_count:,} rows")
+            if row_count < checkpoint_rows and on_conflict.get(table, 'error') != 'update':
+                print(f"[{db_type.display_name}] Can't continue from the checkpoint of {data_file}, "
+                      f"table {table} has fewer rows than the checkpoint")
+                return False
+    return True
+
+
 def table_exists(connection: Connection, table_name: str, db_type: DBType):
     """
     Checks if a table exists in the database.
@@ -473,85 +902,28 @@ def table_exists(connection: Connection, table_name: str, db_type: DBType):
         raise ValueError(f'[{db_type.display_name}] Unknown database type: {db_type}')
 
 
-def set_index(engine: Engine, table_name: str, db_type: DBType):
+def load_dedup_keys(engine: Engine, table_name: str, db_type: DBType):
     """
-    Sets the index of a database table, ensuring efficient lookups.
-    If the index already exists, it will be recreated.
+    Loads the primary keys of the rows that are already in a table into the dedup store. This is needed for a table
+    that continues from its checkpoint, since the keys added before the import stopped are not in the dedup store
+    (or not committed to it), and when the primary keys are built after the import (defer_indexes): rows are then only
+    deduplicated by the dedup store, which doesn't know the rows of earlier data files.
 
     :param engine: Database engine
-    :param table_name: the name of the table you want to set the index for
-    :param db_type: the type of the database, either sqlite, mysql, or postgresql
-
-    :raises ValueError: If the connection type is not supported
+    :param table_name: Name of the table
+    :param db_type: Database type
     """
-    pms = get_primary_key(table_name)
-
-    print(f"[{db_type.display_name}] Setting index for table '{table_name}' and columns {pms}...")
-    
-    # Set the index for the primary key columns
-    for pm in pms:
-        if db_type.is_type(DBTypes.SQLITE):
-            # SQLite doesn't use 'connect()', just use the provided 'conn'
-            with engine.connect() as conn:
-                # Drop the index if it already exists
-                conn.execute(text(f"DROP INDEX IF EXISTS index_{pm}"))
-                # Create the index
-                conn.execute(text(f"CREATE INDEX index_{pm} ON {table_name} ({pm})"))
-
-        elif db_type.is_type(DBTypes.MYSQL):
-            with engine.connect() as conn:
-                # Check if the table exists
-                if not table_exists(conn, table_name, db_type):
-                    print(f"Table '{table_name}' does not exist. Skipping index creation.")
-                    return
-
-                # Check if the index exists
-                index_check_query = text(f"""
-                    SELECT 1 FROM information_schema.statistics
-                    WHERE table_name = :table_name AND index_name = :index_name
-                """)
-                result = conn.execute(index_check_query,
-                                      {'table_name': table_name, 'index_name': f'index_{pm}'}).fetchone()
-
-                # Drop the index if it exists
-                if result:
-                    try:
-                        drop_index_query = text(f"DROP INDEX index_{pm} ON {table_name}")
-                        conn.execute(drop_index_query)
-                    except Exception as e:
-                        pass
-                        # print(f"[{db_type.display_name}] Error removing index index_{pm} on {table_name}: {e}")
-                        # print('Will just set the index now...')
-
-                # Check if the column is of type TEXT or BLOB
-                column_type_query = text(f"""
-                    SELECT COLUMN_TYPE
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_NAME = :table_name AND COLUMN_NAME = :column_name
-                """)
-                column_type = conn.execute(column_type_query,
-                                           {'table_name': table_name, 'column_name': pm}).fetchone()
-
-                # If the column is TEXT or BLOB, we need to specify the length for the index
-                if column_type and ('text' in column_type[0].lower() or 'blob' in column_type[0].lower()):
-                    create_index_query = text(f"CREATE INDEX index_{pm} ON {table_name} ({pm}(255))")
-                else:
-                    create_index_query = text(f"CREATE INDEX index_{pm} ON {table_name} ({pm})")
-
-                # Create the index
-                conn.execute(create_index_query)
-                conn.commit()
+    primary_keys = get_primary_key(table_name)
+    dedup_store.clear(table_name)
+    columns_text = ', '.join(primary_keys)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(text(f'SELECT {columns_text} FROM {table_name}'))
+        for rows in result.partitions(100_000):
+            dedup_store.filter_new(table_name, rows, list(range(len(primary_keys))))
+    dedup_store.commit()
+    if dedup_store.count(table_name):
+        print(f'[{db_type.display_name}] Loaded {dedup_store.count(table_name):,} primary keys of table {table_name}')
 
-        elif db_type.is_type(DBTypes.POSTGRESQL):
-            with engine.connect() as conn:
-                # Drop the index if it already exists
-                conn.execute(text(f"DROP INDEX IF EXISTS index_{pm}"))
-                # Create the index
-                conn.execute(text(f"CREATE INDEX index_{pm} ON {table_name} ({pm})"))
-                conn.commit()
-
-        else:
-            raise ValueError(f'[{db_type.display_name}] Unknown database type: {db_type}')
 
 def get_file_from_table_name(table_name: str) -> str|None:
     """
@@ -568,13 +940,48 @@ def get_file_from_table_name(table_name: str) -> str|None:
     return None
 
 
-def generate_create_table_statement(table_name: str, schema_json_file: str, db_type: DBType) -> str:
+def get_mysql_column_types(table_name: str, schema_json_file: str = 'schemas/db_schema.json') -> dict[str, str]:
+    """
+    Gets the column types of a table for MySQL. MySQL has a shorter character length for TEXT than other databases,
+    so columns with longer values (according to character_lengths.json) get the type LONGTEXT. A text column that is
+    the only primary key gets the type VARCHAR(255), since MySQL needs a maximum length for the primary key.
+
+    :param table_name: Name of the table
+    :param schema_json_file: JSON schema file
+
+    :return: dict with the column names as keys and the column types as values
+    """
+    schema = load_json(schema_json_file)
+    columns = dict(schema[table_name]["columns"])  # Copy, so the cached schema is not changed
+    data_file = get_file_from_table_name(table_name)
+    character_lengths_data = load_json('character_lengths.json')[data_file]
+    for col_name in columns:
+        if col_name in character_lengths_data:
+            length = character_lengths_data[col_name]
+            if 'selftext' in col_name:  # Make sure that selftext has always the maximum length of character since this value is always long
+                length = MAX_MYSQL_TEXT_LENGTH
+        else:
+            length = MAX_MYSQL_TEXT_LENGTH
+        if length >= MAX_MYSQL_TEXT_LENGTH:
+            columns[col_name] = 'LONGTEXT'
+
+    # Since the primary key value is always relatively short, we can pick 255 as the max length
+    # For the values of non-primary keys; this is not necessary
+    primary_keys = schema[table_name].get("primary_keys", [])
+    if len(primary_keys) == 1 and columns.get(primary_keys[0], '').lower() == 'text':
+        columns[primary_keys[0]] = f'VARCHAR({MAX_MYSQL_VARCHAR_PRIMARY_KEY_LENGTH})'
+    return columns
+
+
+def generate_create_table_statement(table_name: str, schema_json_file: str, db_type: DBType,
+                                    primary_key: bool = True) -> str:
     """
     Makes the CREATE TABLE statements from the JSON schema file.
 
     :param schema_json_file: JSON schema file
     :param table_name: Name of the table
     :param db_type: Type of db (sqlite, postgreSQL, or mysql)
+    :param primary_key: False to leave out the primary key, it is then added after the import (see index_builder.py)
 
     :return: CREATE TABLE statement
     """
@@ -586,19 +993,9 @@ def generate_create_table_statement(table_name: str, schema_json_file: str, db_t
     table = schema[table_name]
     # MySQL has a shorter character length for TEXT than other databases, so change it to LONGTEXT if needed
     if db_type.is_type(DBTypes.MYSQL):
-        data_file = get_file_from_table_name(table_name)
-        character_lengths_data = load_json('character_lengths.json')[data_file]
-        for col_name, col_type in table["columns"].items():
-            if col_name in character_lengths_data:
-                length = character_lengths_data[col_name]
-                if 'selftext' in col_name:  # Make sure that selftext has always the maximum length of character since this value is always long
-                    length = MAX_MYSQL_TEXT_LENGTH
-            else:
-                length = MAX_MYSQL_TEXT_LENGTH
-            if length >= MAX_MYSQL_TEXT_LENGTH:
-                table["columns"][col_name] = 'LONGTEXT'
-
-    columns = table["columns"]
+        columns = get_mysql_column_types(table_name, schema_json_file)
+    else:
+        columns = table["columns"]
     primary_keys = table.get("primary_keys", [])
 
     lines = []
@@ -613,23 +1010,16 @@ def generate_create_table_statement(table_name: str, schema_json_file: str, db_t
         raise ValueError(f'[{db_type.display_name}] Unsupported database type: {db_type}')
 
     for col_name, col_type in columns.items():
-
-        # If the database is mysql and the current column is the only primary key, then mysql requires
-        # that we set a maximum length of the primary keys (always type varchar).
-        # Since the primary key value is always relatively short, we can pick 255 as the max length
-        # For the values of non-primary keys; this is not necessary
-        if db_type.is_type(DBTypes.MYSQL) and col_name in primary_keys and len(primary_keys) == 1 and col_type.lower() == 'text':
-            col_type = 'VARCHAR(255)'
-
+        # For MySQL, the only primary key is already a VARCHAR (see get_mysql_column_types)
         line = f'  {quotation_mark_table_statements}{col_name}{quotation_mark_table_statements} {col_type}'
 
         # Don't add PRIMARY KEY here if there are multiple keys
-        if isinstance(primary_keys, list) and len(primary_keys) == 1 and col_name in primary_keys:
+        if primary_key and isinstance(primary_keys, list) and len(primary_keys) == 1 and col_name in primary_keys:
             line += " PRIMARY KEY"
         lines.append(line)
 
     # Add a composite PRIMARY KEY constraint if needed
-    if isinstance(primary_keys, list) and len(primary_keys) > 1:
+    if primary_key and isinstance(primary_keys, list) and len(primary_keys) > 1:
         primary_keys_alt = [f'{quotation_mark_table_statements}{pk}{quotation_mark_table_statements}' for pk in primary_keys]
         pks_text = ", ".join(primary_keys_alt)
         pk_line = f'  PRIMARY KEY ({pks_text})'
@@ -640,7 +1030,8 @@ def generate_create_table_statement(table_name: str, schema_json_file: str, db_t
 
     return create_stmt
 
-def create_tables_from_sql(engine: Engine, db_type: DBType, schema_json_file:str ='schemas/db_schema.json'):
+def create_tables_from_sql(engine: Engine, db_type: DBType, schema_json_file:str ='schemas/db_schema.json',
+                           primary_key: bool = True):
     """
     Creates tables in the database from the provided JSON schema file,
     only if they don't already exist.
@@ -648,6 +1039,7 @@ def create_tables_from_sql(engine: Engine, db_type: DBType, schema_json_file:str
     :param engine: SQLAlchemy engine or sqlite3 connection.
     :param schema_json_file: Path to the schema JSON file
     :param db_type: type of db (sqlite, PostgreSQL, or mysql)
+    :param primary_key: False to make the tables without primary keys (see generate_create_table_statement)
     """
     # Get db type (based on the db connection) and load the db schema
     schema = load_json(schema_json_file)
@@ -666,12 +1058,14 @@ def create_tables_from_sql(engine: Engine, db_type: DBType, schema_json_file:str
             # It can be that there is an error with creating the table statement (THIS SHOULD NOT HAPPEN!), 
             # if so, then print that there is an error and print the statement for debugging.
             try:
-                create_table_statement = generate_create_table_statement(table_name, schema_json_file, db_type)
+                create_table_statement = generate_create_table_statement(table_name, schema_json_file, db_type,
+                                                                         primary_key)
                 connection.execute(text(create_table_statement))
                 print(f"[{db_type.display_name}] Created table: {table_name}")
             except Exception as e:
                 print(f"Error creating table {table_name}: {e}")
-                print(generate_create_table_statement(table_name, schema_json_file, db_type))
+                print(generate_create_table_statement(table_name, schema_json_file, db_type, primary_key))
+        connection.commit()  # Without a commit, the created tables are rolled back on PostgreSQL
 
 
 def main(engine: Engine, db_type: DBType):
@@ -683,7 +1077,7 @@ def main(engine: Engine, db_type: DBType):
     :param db_type: The type of the database, either sqlite, mysql, or postgresql
     """
     # Global variables
-    global maximum_rows_database
+    global maximum_rows_database, dedup_store
 
     # Set up the logger
     os.makedirs("logs/summaries", exist_ok=True)
@@ -714,7 +1108,28 @@ def main(engine: Engine, db_type: DBType):
 
     tables_exist_skip = set()
     schema_tables = list(load_json('schemas/db_schema.json').keys())
-    
+    db_config = load_json('config.json')[db_type.to_string()]
+    defer_indexes = db_config.get('defer_indexes', False)
+    if defer_indexes:
+        # Without primary keys during the import, the dedup store is what keeps the rows of every table unique
+        print(f'[{db_type.display_name}] The primary keys and indexes are built after the import, '
+              f'the rows of all tables with a primary key are deduplicated by the dedup store')
+        dedup_store = make_dedup_store(db_type, db_config, [table for table in schema_tables if get_primary_key(table)])
+        on_conflict = {table: 'error' for table in schema_tables}
+    else:
+        dedup_store = make_dedup_store(db_type, db_config)
+        on_conflict = {table: get_on_conflict(db_type, db_config, table) for table in schema_tables}
+
+    # Tables of an import that stopped before the end of the data file can continue from their checkpoint,
+    # the other checkpoints are removed (and their tables are deleted below)
+    checkpoint_file = f'databases/checkpoints_{db_type.to_string()}_{db_type.name_suffix}.json'
+    checkpoint_tables = set()
+    for saved_checkpoint in load_checkpoints(checkpoint_file).values():
+        if verify_checkpoint(engine, saved_checkpoint, db_type, on_conflict):
+            checkpoint_tables.update(saved_checkpoint['tables'])
+        else:
+            Checkpoint(checkpoint_file, saved_checkpoint['data_file'], saved_checkpoint['tables']).remove()
+
     # Check if tables in the database are also in the db info file, if not ask user to delete it
     for table in get_tables_database(engine, db_type):
         delete_table = True
@@ -723,11 +1138,16 @@ def main(engine: Engine, db_type: DBType):
             if table in obj['success_tables']:
                 delete_table = False
                 break
+        if delete_table and table in checkpoint_tables:
+            print(f'[{db_type.display_name}] Table {table} continues from its checkpoint')
+            delete_table = False
         if delete_table:
             result_delete = delete_table_db(table, engine, db_type, schema_tables)
             if result_delete:
                 tables_exist_skip.add(table)
                 print(f'[{db_type.display_name}] Skipping table {table}')
+            else:
+                dedup_store.clear(table)  # The keys of the deleted rows can be added again
 
     table_columns = dict()
 
@@ -743,8 +1163,12 @@ def main(engine: Engine, db_type: DBType):
         maximum_rows_database = data['maximum_rows_database']
 
     chunk_size = data[db_type.to_string()]['chunk_size']
+    workers = data[db_type.to_string()].get('workers', 1)
+    writer_threads = data[db_type.to_string()].get('writer_threads', 1)
+    write_queue_size = data[db_type.to_string()].get('write_queue_size', 4)
+    write_method = get_write_method(db_type, data[db_type.to_string()])
 
-    create_tables_from_sql(engine, db_type)
+    create_tables_from_sql(engine, db_type, primary_key=not defer_indexes)
    
     # Preparing data
     for file in data_files:
@@ -758,6 +1182,17 @@ def main(engine: Engine, db_type: DBType):
         for ignored_name in ignored:
             ignored_author_names.add(ignored_name.strip().lower())  # Make author names not case-sensitive since it is about the name and not the capitalizing of it
 
+    # Rows that are already in the tables (of a continued import or an earlier data file) are duplicates too
+    tables_to_load = set(checkpoint_tables)
+    if defer_indexes:
+        for file in data_files:
+            tables_to_load.update(is_file_tables_added_db(file, data_files_tables[file]['sql'], db_info_file))
+    with engine.connect() as conn:
+        tables_with_rows = [table for table in sorted(tables_to_load - tables_exist_skip)
+                            if table in dedup_store.tables and table_exists(conn, table, db_type)]
+    for table in tables_with_rows:
+        load_dedup_keys(engine, table, db_type)
+
     # Add the data to the SQL database
     for file in data_files:
         tables = data_files_tables[file]['sql']
@@ -765,13 +1200,28 @@ def main(engine: Engine, db_type: DBType):
         tables_to_process = is_file_tables_added_db(file, tables, db_info_file)
         tables_to_process = list(set(tables_to_process) - tables_exist_skip)
         if tables_to_process:
+            checkpoint = Checkpoint(checkpoint_file, file, tables_to_process)
+            if not checkpoint.load():
+                checkpoint.start(compute_fingerprint(file), byte_offsets=not is_compressed(file))
             process_table(data_file=file, tables=tables_to_process, engine=engine, table_columns=table_columns,
-                          ignored_author_names=ignored_author_names, chunk_size=chunk_size, db_type=db_type)
+                          ignored_author_names=ignored_author_names, chunk_size=chunk_size, db_type=db_type,
+                          workers=workers, writer_threads=writer_threads, write_queue_size=write_queue_size,
+                          write_method=write_method, on_conflict=on_conflict, checkpoint=checkpoint)
             add_file_table_db_info(file, tables_to_process, db_info_file)
-            
-            # Set index for better read performance
-            for table in tables_to_process:
-                set_index(engine=engine, table_name=table, db_type=db_type)
+            checkpoint.remove()  # The tables are in the db info file now
+
+    # Build the primary keys and indexes after all data is added (also for tables of earlier imports, if building
+    # their indexes was interrupted; indexes that exist are skipped)
+    success_tables = {table for obj in load_json_no_cache(db_info_file) for table in obj['success_tables']}
+    index_stats = build_indexes(engine, [table for table in schema_tables if table in success_tables], db_type, db_config)
+    if index_stats:
+        update_index_summary_log(db_type, index_stats)
+
+    # The fast SQLite import doesn't update the statistics of the query planner, so gather them once at the end
+    if write_method == 'executemany':
+        print(f'[{db_type.display_name}] Running ANALYZE...')
+        analyze_sqlite(engine)
+    dedup_store.close()
 
     # Rename log file for clarity
     logger.close()
@@ -0,0 +1,259 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import Connection, Engine, text
+from classes.DBType import DBType, DBTypes
+from classes.IndexDefinition import IndexDefinition
+from general import load_json_cached as load_json
+
+MYSQL_INDEX_PREFIX_LENGTH = 255  # Number of characters of TEXT columns that MySQL indexes (it can't index all of them)
+
+
+def get_configured_indexes(table_name: str) -> list[list[str]]:
+    """
+    Gets the extra indexes of a table that are set in config.json ('indexes', the same for all databases so they
+    are compared with the same indexes), for example {"post": [["subreddit_id"], ["score"]]}.
+
+    :param table_name: Name of the table.
+    :return: the columns of every index
+    """
+    configured = load_json('config.json').get('indexes', {}).get(table_name, [])
+    return [[columns] if isinstance(columns, str) else list(columns) for columns in configured]
+
+
+def get_table_indexes(table_name: str, schema_json_file: str = "schemas/db_schema.json") -> list[IndexDefinition]:
+    """
+    Gets the indexes that are built for a table after the data is loaded:
+    - the primary key and an index on every primary key column after the first;
+    - an index on every foreign key column of the table (from 'foreign_keys' in the schema), for joins on it;
+    - an index on every column of the table that a foreign key of another table references;
+    - the indexes set for the table in config.json (see get_configured_indexes), for filters and sorting.
+    Indexes on the first columns of the primary key are left out, the primary key is used for these. Foreign keys
+    on columns that are not in the table (the schema has some for columns that are not imported) are left out too.
+
+    :param table_name: Name of the table.
+    :param schema_json_file: Path to the schema json file.
+    :raises ValueError: If a configured index has a column that is not in the table
+    :return: the indexes, the primary key first
+    """
+    schema = load_json(schema_json_file)
+    table = schema.get(table_name, {})
+    primary_keys = table.get('primary_keys', [])
+
+    candidates = []
+    for column in primary_keys[1:]:
+        candidates.append(IndexDefinition(table_name, [column], reason='primary key column'))
+    for foreign_key in table.get('foreign_keys', []):
+        references = foreign_key['references']
+        candidates.append(IndexDefinition(table_name, [foreign_key['column']],
+                                          reason=f"foreign key to {references['table']}.{references['column']}"))
+    for other_table_name, other_table in schema.items():
+        for foreign_key in other_table.get('foreign_keys', []):
+            if foreign_key['references']['table'] == table_name:
+                candidates.append(IndexDefinition(table_name, [foreign_key['references']['column']],
+                                                  reason=f"referenced by {other_table_name}.{foreign_key['column']}"))
+    for columns in get_configured_indexes(table_name):
+        unknown_columns = [column for column in columns if column not in table.get('columns', {})]
+        if unknown_columns:
+            raise ValueError(f"Index on {table_name}({', '.join(columns)}) in config.json has columns that are not "
+                             f"in the table: {unknown_columns}")
+        candidates.append(IndexDefinition(table_name, columns, reason='config.json'))
+
+    indexes = []
+    if primary_keys:
+        indexes.append(IndexDefinition(table_name, primary_keys, primary_key=True))
+    columns = table.get('columns', {})
+    for index in candidates:
+        if index.columns == primary_keys[:len(index.columns)] or index in indexes:
+            continue  # The primary key (or an index with the same columns) is used for these columns
+        if not all(column in columns for column in index.columns):
+            continue
+        indexes.append(index)
+    return indexes
+
+
+def quote_name(name: str, db_type: DBType) -> str:
+    """
+    Quotes the name of a table, column or index for the database.
+
+    :param name: the name
+    :param db_type: the type of the database
+    :return: the quoted name
+    """
+    if db_type.is_type(DBTypes.POSTGRESQL):
+        return f'"{name}"'
+    return f'`{name}`'
+
+
+def index_exists(connection: Connection, index: IndexDefinition, db_type: DBType) -> bool:
+    """
+    Checks if an index (or the primary key) of a table already exists, for example because it was made by
+    CREATE TABLE or by an earlier import. An index that PostgreSQL could not finish building (an invalid index of
+    CREATE INDEX CONCURRENTLY) is removed, so it is built again.
+
+    :param connection: connection to the database
+    :param index: the index
+    :param db_type: the type of the database
+    :raises ValueError: If the database type is not supported
+    :return: True if the index exists
+    """
+    parameters = {'table_name': index.table, 'index_name': index.name}
+    match db_type.get_type():
+        case DBTypes.SQLITE:
+            if index.primary_key:
+                table_info = connection.exec_driver_sql(f'PRAGMA table_info({quote_name(index.table, db_type)})')
+                if any(column[5] > 0 for column in table_info):  # Column 5 is the position in the primary key
+                    return True
+            return connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :index_name"),
+                                      parameters).fetchone() is not None
+        case DBTypes.POSTGRESQL:
+            if index.primary_key:
+                return connection.execute(text("SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(:table_name) "
+                                               "AND contype = 'p'"), {'table_name': f'"{index.table}"'}).fetchone() is not None
+            valid = connection.execute(text("SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                                            "WHERE c.relname = :index_name"), parameters).scalar()
+            if valid is False:
+                connection.exec_driver_sql(f'DROP INDEX {quote_name(index.name, db_type)}')
+                return False
+            return valid is not None
+        case DBTypes.MYSQL:
+            if index.primary_key:
+                return connection.execute(text("SELECT 1 FROM information_schema.table_constraints "
+                                               "WHERE table_schema = DATABASE() AND table_name = :table_name "
+                                               "AND constraint_type = 'PRIMARY KEY'"), parameters).fetchone() is not None
+            return connection.execute(text("SELECT 1 FROM information_schema.statistics "
+                                           "WHERE table_schema = DATABASE() AND table_name = :table_name "
+                                           "AND index_name = :index_name"), parameters).fetchone() is not None
+        case _:
+            raise ValueError(f'[{db_type.display_name}] Unknown database type: {db_type}')
+
+
+def get_mysql_index_columns(connection: Connection, index: IndexDefinition) -> list[str]:
+    """
+    Gets the columns of an index for MySQL, where TEXT and BLOB columns can only be indexed with a prefix length.
+
+    :param connection: connection to the MySQL database
+    :param index: the index
+    :return: the quoted columns, with a prefix length for TEXT and BLOB columns
+    """
+    column_types = dict(connection.execute(text("SELECT column_name, column_type FROM information_schema.columns "
+                                                "WHERE table_schema = DATABASE() AND table_name = :table_name"),
+                                           {'table_name': index.table}).fetchall())
+    index_columns = []
+    for column in index.columns:
+        column_type = column_types.get(column, '').lower()
+        if 'text' in column_type or 'blob' in column_type:
+            index_columns.append(f'`{column}`({MYSQL_INDEX_PREFIX_LENGTH})')
+        else:
+            index_columns.append(f'`{column}`')
+    return index_columns
+
+
+def create_index(connection: Connection, index: IndexDefinition, db_type: DBType, concurrently: bool = False):
+    """
+    Creates an index or adds the primary key to a table that was loaded without it. SQLite can't add a primary key
+    to an existing table, so a unique index is made instead (this also makes sure the rows are unique and is used
+    the same way by queries).
+
+    :param connection: connection to the database, in autocommit mode
+    :param index: the index
+    :param db_type: the type of the database
+    :param concurrently: build PostgreSQL indexes with CREATE INDEX CONCURRENTLY, so the table can still be written
+    :raises ValueError: If the database type is not supported
+    """
+    table = quote_name(index.table, db_type)
+    name = quote_name(index.name, db_type)
+    columns_text = ', '.join(quote_name(column, db_type) for column in index.columns)
+    match db_type.get_type():
+        case DBTypes.SQLITE:
+            unique = 'UNIQUE ' if index.primary_key else ''
+            connection.exec_driver_sql(f'CREATE {unique}INDEX IF NOT EXISTS {name} ON {table} ({columns_text})')
+        case DBTypes.POSTGRESQL:
+            concurrently_text = 'CONCURRENTLY ' if concurrently else ''
+            if index.primary_key:
+                # The primary key uses the unique index, so it can also be built concurrently
+                connection.exec_driver_sql(f'CREATE UNIQUE INDEX {concurrently_text}IF NOT EXISTS {name} '
+                                           f'ON {table} ({columns_text})')
+                connection.exec_driver_sql(f'ALTER TABLE {table} ADD CONSTRAINT {name} PRIMARY KEY USING INDEX {name}')
+            else:
+                connection.exec_driver_sql(f'CREATE INDEX {concurrently_text}IF NOT EXISTS {name} '
+                                           f'ON {table} ({columns_text})')
+        case DBTypes.MYSQL:
+            index_columns_text = ', '.join(get_mysql_index_columns(connection, index))
+            if index.primary_key:
+                connection.exec_driver_sql(f'ALTER TABLE {table} ADD PRIMARY KEY ({index_columns_text})')
+            else:
+                connection.exec_driver_sql(f'CREATE INDEX {name} ON {table} ({index_columns_text})')
+        case _:
+            raise ValueError(f'[{db_type.display_name}] Unknown database type: {db_type}')
+
+
+def build_table_indexes(engine: Engine, table_name: str, indexes: list[IndexDefinition], db_type: DBType,
+                        db_config: dict) -> dict[str, dict]:
+    """
+    Builds the indexes of one table on one connection, the primary key first. Indexes that already exist are skipped.
+
+    :param engine: Database engine
+    :param table_name: the table
+    :param indexes: the indexes of the table
+    :param db_type: the type of the database
+    :param db_config: config of the database in config.json ('maintenance_work_mem' and 'create_index_concurrently'
+    are used for PostgreSQL)
+    :return: dict with the index names as keys and the table, columns, reason and build time (or error) as values
+    """
+    statistics = {}
+    # CREATE INDEX CONCURRENTLY can't run in a transaction, the other databases commit DDL statements anyway
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if db_type.is_type(DBTypes.POSTGRESQL) and db_config.get('maintenance_work_mem'):
+            connection.exec_driver_sql(f"SET maintenance_work_mem = '{db_config['maintenance_work_mem']}'")
+
+        for index in indexes:
+            index_statistics = {'table': table_name, 'columns': index.columns, 'reason': index.reason}
+            statistics[index.name] = index_statistics
+            if index_exists(connection, index, db_type):
+                index_statistics['existed'] = True
+                continue
+
+            start_time = time.perf_counter()
+            try:
+                create_index(connection, index, db_type, db_config.get('create_index_concurrently', False))
+            except Exception as e:
+                # For example duplicate keys for a primary key, the other indexes are still built
+                index_statistics['error'] = str(getattr(e, 'orig', e))
+                print(f"[{db_type.display_name}] Error building {index.name} on {table_name}: {index_statistics['error']}")
+                continue
+            index_statistics['seconds'] = round(time.perf_counter() - start_time, 3)
+            print(f"[{db_type.display_name}] Built {index.name} on {table_name}({', '.join(index.columns)}) "
+                  f"({index.reason}) in {index_statistics['seconds']:.2f} s")
+    return statistics
+
+
+def build_indexes(engine: Engine, tables: list[str], db_type: DBType, db_config: dict) -> dict[str, dict]:
+    """
+    Builds the indexes of the tables after the data is loaded (see get_table_indexes). The tables are handled in
+    parallel by 'index_workers' threads (database config), every thread builds the indexes of one table at a time.
+    SQLite only builds one index at a time, since it allows only one writer.
+
+    :param engine: Database engine
+    :param tables: the tables
+    :param db_type: the type of the database
+    :param db_config: config of the database in config.json
+    :return: dict with the index names as keys and the table, columns, reason and build time (or error) as values
+    """
+    index_workers = db_config.get('index_workers', 4)
+    if db_type.is_type(DBTypes.SQLITE):
+        index_workers = 1
+    table_indexes = {table: get_table_indexes(table) for table in tables}
+    table_indexes = {table: indexes for table, indexes in table_indexes.items() if indexes}
+    if not table_indexes:
+        return {}
+
+    print(f"[{db_type.display_name}] Building the indexes of {len(table_indexes)} table(s) with {index_workers} worker(s)...")
+    statistics = {}
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(index_workers, 1)) as executor:
+        futures = [executor.submit(build_table_indexes, engine, table, indexes, db_type, db_config)
+                   for table, indexes in table_indexes.items()]
+        for future in as_completed(futures):
+            statistics.update(future.result())
+    print(f"[{db_type.display_name}] Built the indexes in {time.perf_counter() - start_time:.2f} s")
+    return statistics
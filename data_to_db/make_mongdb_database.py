@@ -1,130 +1,661 @@
 import orjson as json
+import bson
 import pymongo
+from bson.raw_bson import RawBSONDocument
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, PyMongoError
 from tqdm import tqdm
-from general import check_files, make_mongodb_client, update_summary_log
-from line_counts import get_line_count_file
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from collections import deque
+from itertools import islice
+from typing import Any, Generator
+from general import check_files, make_mongodb_client, update_summary_log, write_dead_letter, update_index_summary_log
+from line_counts import get_line_count_file, load_line_index
+from ndjson_reader import iter_lines, iter_line_blocks, split_block_lines, split_file_shards, is_compressed
 import os
 from data_to_db.data_to_sql import add_file_table_db_info, is_file_tables_added_db, get_primary_key, load_json, write_json
+from data_to_db.data_to_sql import get_on_conflict, load_json_no_cache, SHARD_SIZE_BYTES, COMPRESSED_SHARD_SIZE_BYTES
+from data_to_db.data_to_sql import get_table_columns, make_table_plans, make_dedup_store
+from data_to_db.index_builder import get_table_indexes
+from classes.IndexDefinition import IndexDefinition
+from classes.DocumentPlan import DocumentPlan
+from classes.DedupStore import DedupStore
+from classes.FilePlan import FilePlan
 import sys
 from classes.logger import Logger
 import time
 from datetime import datetime
 from classes.DBType import DBType, DBTypes
-from itertools import islice
 
-# Update working directory
-current_directory = os.getcwd()
-parent_directory = os.path.dirname(current_directory)
-os.chdir(parent_directory)
-
-# Make 'databases' folder for SQLite database and .json file containing info about each database
-os.makedirs('databases', exist_ok=True)
-
-# Check if necessary data files exist
-check_files()
-pbar = None
-
-# Make db_type object for MongoDB database
-db_type = DBType(DBTypes.MONGODB, name_suffix='20m', max_rows=20_000_000)
-
-# Set up the logger
-os.makedirs("logs/summaries", exist_ok=True)
-time_now = time.time()
-log_filename = f"logs/sql_{time_now}.txt"
-summary_filename = f"logs/summaries/summary_mongodb.json"
-sys.stdout = Logger(log_filename)
-
-# Load config
-data = load_json('config.json')
-data_files_tables = data['data_files_tables']
-if db_type.max_rows:
-    maximum_rows_database = db_type.max_rows
-else:
-    maximum_rows_database = data['maximum_rows_database']
-chunk_size = data['mongodb']['chunk_size']
-
-db = make_mongodb_client(db_type)
-db_info_file = f'databases/db_info_mongodb_{db_type.name_suffix}.json'
-
-print(f'[{db_type.display_name}] Max rows: {maximum_rows_database:,}')
-
-count = 0
-for data_file, tables_file in data_files_tables.items():
-    count += 1
+MONGODB_DUPLICATE_KEY_ERROR = 11000
+DEFAULT_BATCH_SIZE_MB = 16  # Size of the insert batches, MongoDB accepts messages of up to 48 MB
+DOCUMENT_MODES = ('raw', 'schema')
+# BSON types of the column types of the schema, for the schema validator (see DocumentPlan for the conversion)
+JSON_SCHEMA_BSON_TYPES = {'integer': ['int', 'long'], 'float': ['double', 'int', 'long'], 'bool': ['bool'],
+                          'text': ['string']}
+
+# Collection of the data file and plan of the documents of the worker process (None stores the lines as they are),
+# set by init_encode_worker
+_worker_collection: str | None = None
+_worker_document_plan: DocumentPlan | None = None
+
+
+def create_primary_key_index(collection: Collection, primary_keys: list[str]):
+    """
+    Creates a unique index on the primary keys of a collection, so documents with the same primary key are found while
+    they are inserted. Documents without the primary keys are not in the index, so they can't conflict.
+
+    :param collection: the collection
+    :param primary_keys: the primary key fields
+    """
+    collection.create_index([(primary_key, pymongo.ASCENDING) for primary_key in primary_keys], unique=True,
+                            partialFilterExpression={primary_key: {'$exists': True} for primary_key in primary_keys})
+
+
+def insert_documents(collection: Collection, documents: list[dict], primary_keys: list[str], on_conflict: str,
+                     db_type: DBType) -> int:
+    """
+    Inserts documents unordered, so one document that fails doesn't stop the others. With on_conflict 'update' the
+    documents replace the documents with the same primary key (upserts), with 'ignore' documents with a primary key
+    that is already in the collection are skipped. Documents that fail otherwise go to the dead-letter file.
+
+    :param collection: the collection
+    :param documents: the documents to insert
+    :param primary_keys: the primary key fields, these have a unique index (see create_primary_key_index)
+    :param on_conflict: what to do with documents with a primary key that is already in the collection
+    (error, ignore or update)
+    :param db_type: database type
+    :return: the number of documents written to the dead-letter file
+    """
+    try:
+        if on_conflict == 'update' and primary_keys:
+            collection.bulk_write([pymongo.ReplaceOne({key: document[key] for key in primary_keys}, document,
+                                                      upsert=True)
+                                   if all(key in document for key in primary_keys) else pymongo.InsertOne(document)
+                                   for document in documents], ordered=False)
+        else:
+            collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        failed_documents = []
+        errors = []
+        for write_error in e.details['writeErrors']:
+            if on_conflict == 'ignore' and write_error['code'] == MONGODB_DUPLICATE_KEY_ERROR:
+                continue
+            document = documents[write_error['index']]
+            if isinstance(document, RawBSONDocument):
+                document = bson.decode(document.raw)  # Only dicts can be written as JSON
+            failed_documents.append(document)
+            errors.append(write_error['errmsg'])
+        failed_count = len(failed_documents)
+        if failed_count:
+            write_dead_letter(db_type, collection.name, failed_documents, errors)
+            print(f"\n[{db_type.display_name}] {failed_count:,} document(s) of {collection.name} could not be written, "
+                  f"they are in the dead-letter file (logs/dead_letter)")
+        return failed_count
+    return 0
+
+
+def filter_new_documents(dedup_store: DedupStore, collection_name: str,
+                         documents: list[RawBSONDocument]) -> list[RawBSONDocument]:
+    """
+    Gets the documents with a primary key that was not added before (see DedupStore.filter_new), like the rows of the
+    deduplicated tables are filtered for the SQL databases (for example an author with more than one post).
+    Documents without all primary key fields are kept, they are not in the unique index either.
+
+    :param dedup_store: the dedup store
+    :param collection_name: the collection of the documents
+    :param documents: the documents
+    :return: the new documents, in the same order
+    """
+    primary_keys = get_primary_key(collection_name)
+    rows = [(*[document[key] for key in primary_keys], i) for i, document in enumerate(documents)
+            if all(key in document for key in primary_keys)]
+    if not rows:
+        return documents
+    new_indexes = {row[-1] for row in dedup_store.filter_new(collection_name, rows, list(range(len(primary_keys))))}
+    keyed_indexes = {row[-1] for row in rows}
+    return [document for i, document in enumerate(documents) if i in new_indexes or i not in keyed_indexes]
+
+
+def load_dedup_keys(db: Database, collection_name: str, dedup_store: DedupStore, db_type: DBType):
+    """
+    Loads the primary keys of the documents that are already in a collection into the dedup store (see
+    data_to_sql.load_dedup_keys), so documents of an earlier data file or run are not added again.
+
+    :param db: the MongoDB database
+    :param collection_name: the collection
+    :param dedup_store: the dedup store
+    :param db_type: database type
+    """
+    primary_keys = get_primary_key(collection_name)
+    dedup_store.clear(collection_name)
+    cursor = db[collection_name].find({key: {'$exists': True} for key in primary_keys},
+                                      {'_id': 0, **{key: 1 for key in primary_keys}})
+    while rows := [tuple(document[key] for key in primary_keys) for document in islice(cursor, 100_000)]:
+        dedup_store.filter_new(collection_name, rows, list(range(len(primary_keys))))
+    dedup_store.commit()
+    if dedup_store.count(collection_name):
+        print(f'[{db_type.display_name}] Loaded {dedup_store.count(collection_name):,} primary keys of collection '
+              f'{collection_name}')
+
+
+def get_data_file_collections(tables_file: dict, mongodb_config: dict) -> list[str]:
+    """
+    Gets the collections that the documents of a data file are added to: the collection of the data file, and with
+    'documents' set to 'schema' without 'embed_tables' also a collection per other table of the data file.
+
+    :param tables_file: the tables of the data file (its entry in data_files_tables in config.json)
+    :param mongodb_config: config of MongoDB in config.json
+    :return: the collections, the collection of the data file first
+    """
     collection_name = tables_file['mongodb']
-    if not is_file_tables_added_db(data_file, collection_name, db_info_file):
-        print(f'[{db_type.display_name}] Skipping {collection_name}...')
-        continue
-    collection = db[collection_name]  # Collection Name
-    # Check if collection exists
+    if mongodb_config.get('documents', 'raw') != 'schema' or mongodb_config.get('embed_tables', False):
+        return [collection_name]
+    return [collection_name] + [table for table in tables_file['sql'] if table != collection_name]
+
+
+def make_document_plan(tables_file: dict, mongodb_config: dict, ignored_author_names: set,
+                       db_type: DBType) -> DocumentPlan | None:
+    """
+    Makes the plan of the documents of a data file, see DocumentPlan.
+
+    :param tables_file: the tables of the data file (its entry in data_files_tables in config.json)
+    :param mongodb_config: config of MongoDB in config.json
+    :param ignored_author_names: author names to ignore (see AuthorCleaner)
+    :param db_type: database type
+    :raises ValueError: if 'documents' is unknown
+    :return: the plan, None when the lines are added as they are ('documents' is 'raw')
+    """
+    documents = mongodb_config.get('documents', 'raw')
+    if documents not in DOCUMENT_MODES:
+        raise ValueError(f"[{db_type.display_name}] Unknown documents '{documents}', use one of {DOCUMENT_MODES}")
+    if documents == 'raw':
+        return None
+
+    tables = tables_file['sql']
+    schema = load_json('schemas/db_schema.json')
+    table_columns = {table: get_table_columns(json_schema_path='schemas/db_schema.json', table_name=table)
+                     for table in tables}
+    file_plan = FilePlan(make_table_plans(tables, table_columns, ignored_author_names, db_type))
+    return DocumentPlan(tables_file['mongodb'], file_plan, {table: schema[table]['columns'] for table in tables},
+                        mongodb_config.get('embed_tables', False), mongodb_config.get('date_columns', []))
+
+
+def init_encode_worker(collection_name: str, document_plan: DocumentPlan | None):
+    """
+    Initializes a worker process that encodes lines (or the main process), so the plan doesn't have to be sent with
+    every shard.
+
+    :param collection_name: the collection of the data file
+    :param document_plan: plan of the documents, None to add the lines as they are
+    """
+    global _worker_collection, _worker_document_plan
+    _worker_collection = collection_name
+    _worker_document_plan = document_plan
+
+
+def encode_line(line: bytes) -> list[tuple[str, bytes]] | None:
+    """
+    Parses a line of a data file, makes its documents with the plan of the worker process and encodes them as BSON.
+
+    :param line: the line
+    :return: the BSON of the documents of the line with their collection, empty for an empty line. If the line is not
+    a JSON object, it returns None (the line is skipped, like data_to_sql.clean_line does).
+    """
+    if not line.strip():
+        return []
+    try:
+        document = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(document, dict):
+        return None
+    if _worker_document_plan is None:
+        return [(_worker_collection, bson.encode(document))]
+    return [(collection_name, bson.encode(document))
+            for collection_name, document in _worker_document_plan.execute(document)]
+
+
+def encode_lines(lines) -> list[list[tuple[str, bytes]] | None]:
+    """
+    Encodes lines of a data file (see encode_line), so the documents don't have to be encoded again when they are
+    inserted (see RawBSONDocument). Runs in a worker process (or in the main process with one worker).
+
+    :param lines: the lines
+    :return: for every line, the BSON of its documents with their collection (None for a line that is skipped)
+    """
+    return [encode_line(line) for line in lines]
+
+
+def encode_shard(data_file: str, start: int, end: int) -> list[list[tuple[str, bytes]] | None]:
+    """
+    Encodes the lines of a shard (byte range) of the data file, see encode_lines. Runs in a worker process.
+
+    :param data_file: Path to the Reddit data file
+    :param start: byte offset of the first line of the shard
+    :param end: byte offset of the end of the shard (exclusive)
+    :return: for every line, the BSON of its documents with their collection
+    """
+    return encode_lines(iter_lines(data_file, start, end))
+
+
+def encode_block(block: bytes) -> list[list[tuple[str, bytes]] | None]:
+    """
+    Encodes the lines of a block of a decompressed data file (see iter_line_blocks), see encode_lines. Runs in a
+    worker process.
+
+    :param block: the block, it only has complete lines
+    :return: for every line, the BSON of its documents with their collection
+    """
+    return encode_lines(split_block_lines(block))
+
+
+def iter_encoded_lines(data_file: str, collection_name: str, document_plan: DocumentPlan | None, workers: int = 1,
+                       chunk_size: int = 1000) -> Generator[list[list[tuple[str, bytes]] | None], Any, None]:
+    """
+    Yields the lines of the data file encoded as BSON (see encode_lines), in input order and in lists of lines.
+    With more than one worker, the file is split in shards that are parsed and encoded by a process pool, like the
+    lines are cleaned for the SQL databases (see data_to_sql.iter_cleaned_lines).
+
+    :param data_file: Path to the Reddit data file
+    :param collection_name: the collection of the data file
+    :param document_plan: plan of the documents, None to add the lines as they are
+    :param workers: Number of worker processes, 1 encodes the lines in the main process
+    :param chunk_size: number of lines that are encoded at a time in the main process
+    :return: generator yielding for every line the BSON of its documents with their collection
+    """
+    if workers <= 1:
+        init_encode_worker(collection_name, document_plan)
+        lines = iter_lines(data_file)
+        while lines_chunk := list(islice(lines, chunk_size)):
+            yield encode_lines(lines_chunk)
+        return
+
+    if is_compressed(data_file):
+        blocks = iter_line_blocks(data_file, COMPRESSED_SHARD_SIZE_BYTES)
+        tasks = ((encode_block, block) for block in blocks)
+    else:
+        blocks = None
+        shards = split_file_shards(data_file, SHARD_SIZE_BYTES, load_line_index(data_file))
+        tasks = ((encode_shard, data_file, start, end) for start, end in shards)
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_encode_worker,
+                             initargs=(collection_name, document_plan)) as executor:
+        try:
+            while True:
+                # Keep a limited number of shards in flight, so memory stays bounded when the inserts are slower
+                while len(pending) < workers * 2 and (task := next(tasks, None)) is not None:
+                    pending.append(executor.submit(*task))
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            if blocks is not None:
+                blocks.close()  # Stops the decompression
+
+
+def wait_for_batches(pending: deque[Future], max_in_flight: int) -> int:
+    """
+    Waits until at most max_in_flight insert batches are still being written, the oldest batches first.
+
+    :param pending: the futures of the batches (see insert_documents), the finished batches are removed
+    :param max_in_flight: the number of batches that can still be written
+    :return: the number of documents of the finished batches that were written to the dead-letter file
+    """
+    dead_letter_count = 0
+    while len(pending) > max_in_flight:
+        dead_letter_count += pending.popleft().result()
+    return dead_letter_count
+
+
+def import_data_file(db: Database, data_file: str, collection_name: str, document_plan: DocumentPlan | None,
+                     on_conflict: dict[str, str], db_type: DBType, mongodb_config: dict, max_rows: int,
+                     progress_bar: tqdm, dedup_store: DedupStore | None = None) -> tuple[int, int, int]:
+    """
+    Adds the documents of a data file to the database. The lines are parsed and encoded as BSON by 'workers'
+    processes, the documents are collected in batches of 'batch_size_mb' per collection and every batch is inserted
+    unordered by one of 'writer_threads' threads, which share the connection pool of the client. At most
+    'max_in_flight' batches are written at the same time, so memory stays bounded when the inserts are slower than
+    the parsing. Documents of the collections of the dedup store with a primary key that was already added are
+    skipped (see filter_new_documents), this is done per chunk of lines in the main process.
+
+    :param db: the MongoDB database
+    :param data_file: Path to the Reddit data file
+    :param collection_name: the collection of the data file
+    :param document_plan: plan of the documents, None to add the lines as they are
+    :param on_conflict: conflict mode per collection (see get_on_conflict)
+    :param db_type: database type
+    :param mongodb_config: config of MongoDB in config.json
+    :param max_rows: maximum number of lines to add
+    :param progress_bar: progress bar of the lines
+    :param dedup_store: the dedup store, None to not skip documents
+    :return: the number of lines read, the number of documents written to the dead-letter file and the number of
+    lines that were skipped because they are not JSON objects
+    """
+    workers = mongodb_config.get('workers', 1)
+    writer_threads = mongodb_config.get('writer_threads', 1)
+    max_in_flight = mongodb_config.get('max_in_flight', writer_threads * 2)
+    batch_size_bytes = int(mongodb_config.get('batch_size_mb', DEFAULT_BATCH_SIZE_MB) * 1024 * 1024)
+
+    line_count = 0
+    dead_letter_count = 0
+    encode_errors = 0
+    batches = {}  # Documents and their number of bytes per collection
+    pending = deque()
+    encoded_chunks = iter_encoded_lines(data_file, collection_name, document_plan, workers, mongodb_config['chunk_size'])
+    with ThreadPoolExecutor(max_workers=max(writer_threads, 1)) as executor:
+        def submit_batch(batch_collection_name: str):
+            documents, _ = batches.pop(batch_collection_name)
+            pending.append(executor.submit(insert_documents, db[batch_collection_name], documents,
+                                           get_primary_key(batch_collection_name),
+                                           on_conflict.get(batch_collection_name, 'error'), db_type))
+
+        try:
+            for encoded_lines in encoded_chunks:
+                encoded_lines = encoded_lines[:max_rows - line_count]
+                line_count += len(encoded_lines)
+                progress_bar.update(len(encoded_lines))
+                chunk_documents = {}  # Documents of the chunk per collection
+                for encoded_line in encoded_lines:
+                    if encoded_line is None:
+                        encode_errors += 1
+                        continue
+                    for document_collection_name, encoded_document in encoded_line:
+                        chunk_documents.setdefault(document_collection_name, []).append(
+                            RawBSONDocument(encoded_document))
+
+                for document_collection_name, documents in chunk_documents.items():
+                    if dedup_store is not None and document_collection_name in dedup_store.tables:
+                        documents = filter_new_documents(dedup_store, document_collection_name, documents)
+                    for document in documents:
+                        batch = batches.setdefault(document_collection_name, [[], 0])
+                        batch[0].append(document)
+                        batch[1] += len(document.raw)
+                        if batch[1] >= batch_size_bytes:
+                            dead_letter_count += wait_for_batches(pending, max_in_flight - 1)
+                            submit_batch(document_collection_name)
+                if line_count >= max_rows:
+                    break
+        finally:
+            encoded_chunks.close()  # Stops the worker processes when the maximum number of lines is reached
+
+        for document_collection_name in list(batches):
+            submit_batch(document_collection_name)
+        dead_letter_count += wait_for_batches(pending, 0)
+    return line_count, dead_letter_count, encode_errors
+
+
+def get_collection_indexes(collection_name: str) -> list[IndexDefinition]:
+    """
+    Gets the indexes that are built for a collection after the documents are added: the indexes of the table (see
+    index_builder.get_table_indexes) without the primary key, which already has its unique index. The index of a
+    foreign key also gets the primary key fields (a compound index), so a $lookup on the foreign key can return the
+    primary key from the index. Indexes on the first fields of another index are left out, that index is used instead.
+
+    :param collection_name: the collection
+    :return: the indexes
+    """
+    table = load_json('schemas/db_schema.json').get(collection_name, {})
+    primary_keys = table.get('primary_keys', [])
+    indexes = [index for index in get_table_indexes(collection_name) if not index.primary_key]
+    for foreign_key in table.get('foreign_keys', []):
+        column = foreign_key['column']
+        if column in table['columns'] and column not in primary_keys:
+            references = foreign_key['references']
+            indexes.append(IndexDefinition(collection_name, [column, *primary_keys],
+                                           reason=f"foreign key to {references['table']}.{references['column']}"))
+    return [index for index in dict.fromkeys(indexes)
+            if not any(other.columns[:len(index.columns)] == index.columns and len(other.columns) > len(index.columns)
+                       for other in indexes)]
+
+
+def get_index_sizes(collection: Collection) -> dict[str, int]:
+    """
+    Gets the size of every index of a collection.
+
+    :param collection: the collection
+    :return: dict with the index names as keys and their sizes in bytes as values
+    """
+    collection_stats = next(collection.aggregate([{'$collStats': {'storageStats': {}}}]), {})
+    return collection_stats.get('storageStats', {}).get('indexSizes', {})
+
+
+def build_collection_index(collection: Collection, index: IndexDefinition, db_type: DBType) -> dict:
+    """
+    Builds one index of a collection, unless an index on the same fields already exists.
+
+    :param collection: the collection
+    :param index: the index
+    :param db_type: the type of the database
+    :return: the collection, fields, reason and build time (or error) of the index
+    """
+    keys = [(column, pymongo.ASCENDING) for column in index.columns]
+    statistics = {'table': collection.name, 'columns': index.columns, 'reason': index.reason}
+    if any(index_info['key'] == keys for index_info in collection.index_information().values()):
+        statistics['existed'] = True
+        return statistics
+
+    start_time = time.perf_counter()
+    try:
+        collection.create_index(keys, name=index.name)
+    except PyMongoError as e:
+        statistics['error'] = str(e)
+        print(f"[{db_type.display_name}] Error building {index.name} on {collection.name}: {e}")
+        return statistics
+    statistics['seconds'] = round(time.perf_counter() - start_time, 3)
+    return statistics
+
+
+def build_mongodb_indexes(db: Database, collections: list[str], db_type: DBType, db_config: dict) -> dict[str, dict]:
+    """
+    Builds the indexes of the collections after the documents are added (see get_collection_indexes), in parallel
+    by 'index_workers' threads (MongoDB config): MongoDB can build multiple indexes, also of the same collection, at
+    the same time. The size of every index is added to its statistics afterward.
+
+    :param db: the MongoDB database
+    :param collections: the collections
+    :param db_type: the type of the database
+    :param db_config: config of MongoDB in config.json
+    :return: dict with the index names as keys and the collection, fields, reason, build time (or error) and size as
+    values
+    """
+    indexes = [index for collection_name in collections for index in get_collection_indexes(collection_name)]
+    if not indexes:
+        return {}
+
+    index_workers = db_config.get('index_workers', 4)
+    print(f"[{db_type.display_name}] Building {len(indexes)} index(es) of {len(collections)} collection(s) "
+          f"with {index_workers} worker(s)...")
+    statistics = {}
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(index_workers, 1)) as executor:
+        futures = {executor.submit(build_collection_index, db[index.table], index, db_type): index for index in indexes}
+        for future in as_completed(futures):
+            statistics[futures[future].name] = future.result()
+
+    for collection_name in collections:
+        for index_name, size in get_index_sizes(db[collection_name]).items():
+            if index_name in statistics:
+                statistics[index_name]['size_bytes'] = size
+    for index in indexes:
+        index_statistics = statistics[index.name]
+        if 'seconds' in index_statistics:
+            print(f"[{db_type.display_name}] Built {index.name} on {index.table}({', '.join(index.columns)}) "
+                  f"({index.reason}) in {index_statistics['seconds']:.2f} s, "
+                  f"{index_statistics.get('size_bytes', 0) / 1024 / 1024:.1f} MB")
+    print(f"[{db_type.display_name}] Built the indexes in {time.perf_counter() - start_time:.2f} s")
+    return statistics
+
+
+def get_json_schema(table: str, date_columns: list[str]) -> dict:
+    """
+    Makes the $jsonSchema validator of a collection with documents of a table (see DocumentPlan): the primary keys
+    are required and every column has the BSON type of its type in the schema. Fields that are not columns (such as
+    embedded tables) are allowed.
+
+    :param table: the table
+    :param date_columns: columns that are stored as dates
+    :return: the $jsonSchema
+    """
+    table_schema = load_json('schemas/db_schema.json')[table]
+    properties = {}
+    for column, column_type in table_schema['columns'].items():
+        bson_types = JSON_SCHEMA_BSON_TYPES.get(column_type.lower(), ['string'])
+        if column in date_columns:
+            bson_types = ['date']
+        properties[column] = {'bsonType': bson_types}
+    return {'bsonType': 'object', 'required': table_schema.get('primary_keys', []), 'properties': properties}
+
+
+def set_collection_validator(db: Database, collection_name: str, mongodb_config: dict, db_type: DBType):
+    """
+    Sets the $jsonSchema validator (see get_json_schema) of a collection that gets documents made with the schema.
+    With 'validation_action' 'warn' (the default) documents that don't match are added and MongoDB logs a warning,
+    with 'error' they are not added but written to the dead-letter file.
+
+    :param db: the MongoDB database
+    :param collection_name: the collection (and table)
+    :param mongodb_config: config of MongoDB in config.json
+    :param db_type: the type of the database
+    """
+    validator = {'$jsonSchema': get_json_schema(collection_name, mongodb_config.get('date_columns', []))}
+    validation_action = mongodb_config.get('validation_action', 'warn')
     if collection_name in db.list_collection_names():
+        db.command('collMod', collection_name, validator=validator, validationLevel='strict',
+                   validationAction=validation_action)
+    else:
+        db.create_collection(collection_name, validator=validator, validationLevel='strict',
+                             validationAction=validation_action)
+    print(f"[{db_type.display_name}] Set the schema validator of '{collection_name}' ({validation_action})")
 
-        response = input(f"[{db_type.display_name}] Collection '{collection_name}' already exists. Remove it? (y/n): ")
-
-        if response == "y":
-            collection.drop()  # Remove collection
-            print(f"[{db_type.display_name}] Collection '{collection_name}' deleted.")
-        elif response == "n":
-            print(f"[{db_type.display_name}] Skipping collection '{collection_name}'.")
-            continue  # Skip to next iteration if user says no
-
-    # Time measurements
-    start_time = datetime.now()
-    # Add index
-    pm = get_primary_key(collection_name)
-
-    # Open NDJSON file and insert in chunks
-    with open(data_file, "r", encoding="utf-8") as file:
-        buffer = []
-        total_lines = min(get_line_count_file(data_file), maximum_rows_database)
-        line_count = 0
-        pbar = tqdm(total=total_lines, desc=f"[{db_type.display_name}] Importing {collection_name} data to MongoDB collection {collection_name} [{count}/{len(data_files_tables)}]", unit="docs")
-        for line in islice(file, maximum_rows_database):
-            line_count += 1
-            pbar.update(1)
-            if line.strip():  # Ignore empty lines
-                buffer.append(json.loads(line))
-
-            if len(buffer) >= chunk_size:  # Insert when buffer reaches chunk size
-                collection.insert_many(buffer)
-                buffer.clear()  # Clear buffer after inserting
-
-            # if line_count >= maximum_rows_database:  # Stop if there are maximum_rows_database written to avoid a very very large db
-            #     if buffer:
-            #         collection.insert_many(buffer)
-            #         pbar.update(len(buffer))
-            #         buffer.clear()  # Clear memory
-            #     break
-
-        # Insert any remaining documents
-        if buffer:
-            collection.insert_many(buffer)
-            pbar.update(len(buffer))
 
-        pbar.close()
+# The main guard is needed because the worker processes that encode the lines (and count the lines) import this
+# module again when the 'spawn' start method is used (default on Windows and macOS)
+if __name__ == '__main__':
+    # Update working directory
+    current_directory = os.getcwd()
+    parent_directory = os.path.dirname(current_directory)
+    os.chdir(parent_directory)
 
-        # Creating index
-        if isinstance(pm, list):
-            for primary_key in pm:
-                print(f"[{db_type.display_name}] Creating index for '{collection_name}' and pm: {primary_key}...")
-                collection.create_index([(primary_key, pymongo.ASCENDING)])
-        else:
-            print(f"[{db_type.display_name}] Creating index for '{collection_name}' and pm: {pm}...")
-            collection.create_index([(pm, pymongo.ASCENDING)])
+    # Make 'databases' folder for SQLite database and .json file containing info about each database
+    os.makedirs('databases', exist_ok=True)
+
+    # Check if necessary data files exist
+    check_files()
+    pbar = None
+
+    # Make db_type object for MongoDB database
+    db_type = DBType(DBTypes.MONGODB, name_suffix='20m', max_rows=20_000_000)
+
+    # Set up the logger
+    os.makedirs("logs/summaries", exist_ok=True)
+    time_now = time.time()
+    log_filename = f"logs/sql_{time_now}.txt"
+    summary_filename = f"logs/summaries/summary_mongodb.json"
+    sys.stdout = Logger(log_filename)
+
+    # Load config
+    data = load_json('config.json')
+    data_files_tables = data['data_files_tables']
+    if db_type.max_rows:
+        maximum_rows_database = db_type.max_rows
+    else:
+        maximum_rows_database = data['maximum_rows_database']
+    chunk_size = data['mongodb']['chunk_size']
+    # Load ignored author names (these can be discarded, only used when the documents are made with the schema)
+    ignored_author_names = set()
+    with open('ignored.txt', 'r', encoding='utf-8') as ignored:
+        for ignored_name in ignored:
+            ignored_author_names.add(ignored_name.strip().lower())
+    on_conflict = {collection_name: get_on_conflict(db_type, data['mongodb'], collection_name)
+                   for collection_name in load_json('schemas/db_schema.json')}
+
+    db = make_mongodb_client(db_type)
+    db_info_file = f'databases/db_info_mongodb_{db_type.name_suffix}.json'
+
+    # Documents with a primary key that was already added are skipped for the same tables as for the SQL databases
+    # (dedup_tables), the keys of the documents that are already in these collections are loaded first
+    dedup_store = make_dedup_store(db_type, data['mongodb'])
+    existing_collections = db.list_collection_names()
+    for dedup_collection_name in sorted(dedup_store.tables):
+        if dedup_collection_name in existing_collections:
+            load_dedup_keys(db, dedup_collection_name, dedup_store, db_type)
+
+    print(f'[{db_type.display_name}] Max rows: {maximum_rows_database:,}')
+
+    count = 0
+    for data_file, tables_file in data_files_tables.items():
+        count += 1
+        collection_name = tables_file['mongodb']
+        if not is_file_tables_added_db(data_file, collection_name, db_info_file):
+            print(f'[{db_type.display_name}] Skipping {collection_name}...')
+            continue
+        collection = db[collection_name]  # Collection Name
+        # Check if collection exists
+        if collection_name in db.list_collection_names():
+
+            response = input(f"[{db_type.display_name}] Collection '{collection_name}' already exists. Remove it? (y/n): ")
+
+            if response == "y":
+                collection.drop()  # Remove collection
+                if collection_name in dedup_store.tables:
+                    dedup_store.clear(collection_name)  # The keys of the deleted documents can be added again
+                print(f"[{db_type.display_name}] Collection '{collection_name}' deleted.")
+            elif response == "n":
+                print(f"[{db_type.display_name}] Skipping collection '{collection_name}'.")
+                continue  # Skip to next iteration if user says no
+
+        # Time measurements
+        start_time = datetime.now()
+        # Add the unique indexes before the documents, so documents with the same primary key are found
+        file_collections = get_data_file_collections(tables_file, data['mongodb'])
+        for file_collection_name in file_collections:
+            if data['mongodb'].get('documents', 'raw') == 'schema':
+                set_collection_validator(db, file_collection_name, data['mongodb'], db_type)
+            pm = get_primary_key(file_collection_name)
+            if pm:
+                print(f"[{db_type.display_name}] Creating unique index for '{file_collection_name}' and pm: {pm}...")
+                create_primary_key_index(db[file_collection_name], pm)
+        document_plan = make_document_plan(tables_file, data['mongodb'], ignored_author_names, db_type)
+
+        # Read NDJSON file and insert in batches
+        total_lines = min(get_line_count_file(data_file, estimate=data.get('estimate_line_counts', False)), maximum_rows_database)
+        pbar = tqdm(total=total_lines, desc=f"[{db_type.display_name}] Importing {collection_name} data to MongoDB collection {collection_name} [{count}/{len(data_files_tables)}]", unit="docs")
+        line_count, dead_letter_count, encode_errors = import_data_file(db, data_file, collection_name, document_plan,
+                                                                        on_conflict, db_type, data['mongodb'],
+                                                                        maximum_rows_database, pbar, dedup_store)
+        pbar.close()
+        dedup_store.commit()
+        if encode_errors:
+            print(f"[{db_type.display_name}] Skipped {encode_errors:,} line(s) of {data_file} that are not JSON objects")
+        if dead_letter_count:
+            print(f"[{db_type.display_name}] {dead_letter_count:,} document(s) of {collection_name} are in the dead-letter file")
 
         # Time measurements
         end_time = datetime.now()
 
+        dedup_stats = dedup_store.get_statistics() if dedup_store.tables & set(file_collections) else None
         update_summary_log(db_type=db_type, data_file=data_file,
                            start_time=start_time, end_time=end_time,
                            line_count=line_count, total_lines=total_lines,
-                           tables=None, chunk_size=chunk_size, sql_writes=None)
+                           tables=None, chunk_size=chunk_size, sql_writes=None, dedup_stats=dedup_stats)
 
+        add_file_table_db_info(data_file, collection_name, db_info_file)
 
-    add_file_table_db_info(data_file, collection_name, db_info_file)
+    # Build the other indexes after all documents are added
+    success_collections = {collection_name for obj in load_json_no_cache(db_info_file) if obj['file'] in data_files_tables
+                           for collection_name in get_data_file_collections(data_files_tables[obj['file']], data['mongodb'])}
+    dedup_store.close()
+    index_stats = build_mongodb_indexes(db, sorted(success_collections), db_type, data['mongodb'])
+    if index_stats:
+        update_index_summary_log(db_type, index_stats)
 
-# Save the tqdm bar (for timing)
-if pbar:
-    print(str(pbar))
+    # Save the tqdm bar (for timing)
+    if pbar:
+        print(str(pbar))
 
-print(f"[{db_type.display_name}] Data import completed successfully!")
+    print(f"[{db_type.display_name}] Data import completed successfully!")
@@ -3,23 +3,25 @@ import os
 from general import check_files, make_sqlite_engine
 from classes.DBType import DBType, DBTypes
 
-# Update working directory
-current_directory = os.getcwd()
-parent_directory = os.path.dirname(current_directory)
-os.chdir(parent_directory)
+# The main guard is needed because the worker processes that clean the lines import this module again
+# when the 'spawn' start method is used (default on Windows and macOS)
+if __name__ == '__main__':
+    # Update working directory
+    current_directory = os.getcwd()
+    parent_directory = os.path.dirname(current_directory)
+    os.chdir(parent_directory)
 
-# Make 'databases' folder for SQLite database and .json file containing info about each database
-os.makedirs('databases', exist_ok=True)
-db_folder = load_json('config.json')['sqlite']['db_folder']
-os.makedirs(db_folder, exist_ok=True)
+    # Make 'databases' folder for SQLite database and .json file containing info about each database
+    os.makedirs('databases', exist_ok=True)
+    db_folder = load_json('config.json')['sqlite']['db_folder']
+    os.makedirs(db_folder, exist_ok=True)
 
-# Check if necessary data files exist
-check_files()
+    # Check if necessary data files exist
+    check_files()
 
-# Make engine
-db_type_sqlite = DBType(db_type=DBTypes.SQLITE, name_suffix='20m', max_rows=20_000_000)
-engine = make_sqlite_engine(db_type_sqlite)
-
-# Make the database
-main(engine, db_type_sqlite)
+    # Make engine
+    db_type_sqlite = DBType(db_type=DBTypes.SQLITE, name_suffix='20m', max_rows=20_000_000)
+    engine = make_sqlite_engine(db_type_sqlite)
 
+    # Make the database
+    main(engine, db_type_sqlite)
@@ -0,0 +1,447 @@
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from sqlalchemy import Connection, Engine, table as table_clause, column as column_clause
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from classes.RowBatch import RowBatch
+from general import load_json_cached as load_json
+
+
+def get_table_column_types(table_name: str, schema_json_file: str = "schemas/db_schema.json") -> dict[str, str]:
+    """
+    Gets the column types of a table from the schema.
+
+    :param table_name: Name of the table.
+    :param schema_json_file: Path to the schema json file.
+    :return: dict with the column names as keys and the types (as in the schema) as values.
+    """
+    schema = load_json(schema_json_file)
+    return schema[table_name]['columns']
+
+
+# What happens with a row that has the same primary key as a row in the table:
+# 'error' fails the write (the row goes to the dead-letter file), 'ignore' skips the row and 'update' overwrites the
+# other columns of the row in the table
+ON_CONFLICT_MODES = ('error', 'ignore', 'update')
+
+
+def get_conflict_columns(table_name: str, schema_json_file: str = "schemas/db_schema.json") -> list[str]:
+    """
+    Gets the columns that identify a row of a table for the conflict handling, these are the primary keys in the schema.
+
+    :param table_name: Name of the table.
+    :param schema_json_file: Path to the schema json file.
+    :return: the primary key columns, empty if the table has no primary key (then there are no conflicts)
+    """
+    schema = load_json(schema_json_file)
+    return schema.get(table_name, {}).get('primary_keys', [])
+
+
+def get_on_conflict_clause(columns: list[str], conflict_columns: list[str], on_conflict: str) -> str:
+    """
+    Makes the ON CONFLICT clause of an INSERT statement for PostgreSQL and SQLite.
+
+    :param columns: the columns that are inserted
+    :param conflict_columns: the primary key columns of the table
+    :param on_conflict: the conflict mode, see ON_CONFLICT_MODES
+    :return: the clause (starting with a space), empty if conflicts are errors
+    """
+    if on_conflict == 'error' or not conflict_columns:
+        return ''
+    conflict_text = ', '.join(f'"{column}"' for column in conflict_columns)
+    update_columns = [column for column in columns if column not in conflict_columns]
+    if on_conflict == 'ignore' or not update_columns:
+        return f' ON CONFLICT ({conflict_text}) DO NOTHING'
+    update_text = ', '.join(f'"{column}" = excluded."{column}"' for column in update_columns)
+    return f' ON CONFLICT ({conflict_text}) DO UPDATE SET {update_text}'
+
+
+def get_rows_written(rowcount: int, batch: RowBatch) -> int:
+    """
+    Gets the number of rows that a write added to (or changed in) a table from the row count of the driver.
+    Rows that were skipped because of a conflict are not counted, rows that were updated are.
+
+    :param rowcount: the row count of the statement, -1 if the driver doesn't know it
+    :param batch: the rows that were written
+    :return: the number of rows written, the number of rows in the batch if the driver doesn't know it
+    """
+    if rowcount < 0:
+        return len(batch)
+    return min(rowcount, len(batch))  # MySQL counts a row that is updated or replaced twice
+
+
+def keep_last_row_per_key(batch: RowBatch, conflict_columns: list[str]) -> RowBatch:
+    """
+    Removes the rows of a batch that have the same primary key as a later row of the batch. PostgreSQL can't update
+    the same row twice in one INSERT ... ON CONFLICT DO UPDATE, so only the last row (the one that would be in the
+    table after updating the row with every row in order) is written.
+
+    :param batch: the rows to write
+    :param conflict_columns: the primary key columns of the table
+    :return: the batch without the earlier rows of a key, the same batch if all keys are unique
+    """
+    if not conflict_columns or any(column not in batch.columns for column in conflict_columns):
+        return batch
+    key_indexes = [batch.columns.index(column) for column in conflict_columns]
+    last_rows = {}
+    for row in batch.rows:
+        last_rows[tuple([row[i] for i in key_indexes])] = row
+    if len(last_rows) == len(batch):
+        return batch
+    return RowBatch(batch.columns, list(last_rows.values()))
+
+
+@contextmanager
+def savepoint(connection: Connection, name: str = 'write_batch', raw_connection: bool = False):
+    """
+    Runs the code in the with block in a savepoint: if it raises an error, only the changes made in the block are
+    rolled back, the rows written before it in the same transaction are kept.
+
+    :param connection: connection to the database
+    :param name: name of the savepoint
+    :param raw_connection: True to run the savepoint on the DB API connection, for writes that don't go through
+    SQLAlchemy (executemany_to_sqlite). SQLAlchemy would otherwise start a transaction that is committed with the
+    connection, so the rows would be committed before commit_sqlite_chunk commits them.
+    """
+    execute = connection.connection.execute if raw_connection else connection.exec_driver_sql
+    # sqlite3 only starts a transaction before INSERT statements, a savepoint outside a transaction would commit
+    # when it is released
+    if connection.dialect.name == 'sqlite' and not connection.connection.in_transaction:
+        execute('BEGIN')
+    execute(f'SAVEPOINT {name}')
+    try:
+        yield
+    except BaseException:
+        execute(f'ROLLBACK TO SAVEPOINT {name}')
+        execute(f'RELEASE SAVEPOINT {name}')
+        raise
+    execute(f'RELEASE SAVEPOINT {name}')
+
+
+def format_postgres_copy_value(value, column_type: str) -> str:
+    """
+    Formats a value for the text format of PostgreSQL's COPY.
+
+    :param value: the value to format
+    :param column_type: type of the column in the schema (text, integer, float or bool)
+    :return: the value as text, with the special characters of the COPY text format escaped
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        if column_type == 'bool':
+            return 't' if value else 'f'
+        return 'true' if value else 'false'  # Same text as PostgreSQL casts a boolean to text
+    if isinstance(value, float) and column_type == 'integer' and value.is_integer():
+        return str(int(value))  # Some data files have integers written as floats (for example 1.0)
+    if not isinstance(value, str):
+        value = str(value)
+
+    # PostgreSQL can't store the null character in text, so it is removed.
+    # The other characters are escaped because they have a special meaning in the COPY text format
+    return (value.replace('\x00', '')
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def make_insert_statement(batch: RowBatch, table: str, dialect_name: str, on_conflict: str = 'error'):
+    """
+    Makes the INSERT statement for a batch with the conflict handling of the database: ON CONFLICT DO NOTHING or
+    DO UPDATE on PostgreSQL and SQLite, INSERT IGNORE or ON DUPLICATE KEY UPDATE on MySQL.
+
+    :param batch: the rows to write
+    :param table: name of the table
+    :param dialect_name: name of the SQLAlchemy dialect of the database
+    :param on_conflict: the conflict mode, see ON_CONFLICT_MODES
+    :return: the INSERT statement
+    """
+    # A lightweight table object is enough, SQLAlchemy quotes the names and uses the parameter style of the driver
+    table_object = table_clause(table, *[column_clause(column) for column in batch.columns])
+    conflict_columns = get_conflict_columns(table)
+    if on_conflict == 'error' or not conflict_columns:
+        return table_object.insert()
+    update_columns = [column for column in batch.columns if column not in conflict_columns]
+
+    if dialect_name == 'mysql':
+        insert_statement = mysql.insert(table_object)
+        if on_conflict == 'ignore' or not update_columns:
+            return insert_statement.prefix_with('IGNORE')
+        return insert_statement.on_duplicate_key_update({column: insert_statement.inserted[column]
+                                                         for column in update_columns})
+
+    insert_statement = (postgresql if dialect_name == 'postgresql' else sqlite).insert(table_object)
+    if on_conflict == 'ignore' or not update_columns:
+        return insert_statement.on_conflict_do_nothing(index_elements=conflict_columns)
+    return insert_statement.on_conflict_do_update(index_elements=conflict_columns,
+                                                  set_={column: insert_statement.excluded[column]
+                                                        for column in update_columns})
+
+
+def insert_rows(batch: RowBatch, table: str, connection: Connection, on_conflict: str = 'error') -> int:
+    """
+    Writes a batch to a table with an INSERT statement that is executed for all rows at once (executemany),
+    works for every SQL database. The rows are committed when the connection is committed.
+
+    :param batch: the rows to write
+    :param table: name of the table
+    :param connection: connection to the database
+    :param on_conflict: what to do with rows that have the same primary key as a row in the table, see ON_CONFLICT_MODES
+    :return: the number of rows written, see get_rows_written
+    """
+    if on_conflict == 'update' and connection.dialect.name == 'postgresql':
+        batch = keep_last_row_per_key(batch, get_conflict_columns(table))
+    insert_statement = make_insert_statement(batch, table, connection.dialect.name, on_conflict)
+    result = connection.execute(insert_statement, [dict(zip(batch.columns, row)) for row in batch.rows])
+    return get_rows_written(result.rowcount, batch)
+
+
+def copy_to_postgres(batch: RowBatch, table: str, connection: Connection, on_conflict: str = 'error') -> int:
+    """
+    Writes a batch to a PostgreSQL table with COPY FROM STDIN, which is much faster than INSERT statements.
+    COPY has no conflict handling, so unless conflicts are errors, the batch is copied to a temporary staging table
+    first and moved to the table with INSERT ... SELECT ... ON CONFLICT. The rows are committed when the connection
+    is committed.
+
+    :param batch: the rows to write
+    :param table: name of the table
+    :param connection: connection to the PostgreSQL database
+    :param on_conflict: what to do with rows that have the same primary key as a row in the table, see ON_CONFLICT_MODES
+    :return: the number of rows written, see get_rows_written
+    """
+    if on_conflict == 'update':
+        batch = keep_last_row_per_key(batch, get_conflict_columns(table))
+    column_types = get_table_column_types(table)
+    columns = batch.columns
+    types = [column_types.get(column, 'text') for column in columns]
+
+    buffer = io.StringIO()
+    for row in batch.rows:
+        buffer.write('\t'.join([format_postgres_copy_value(value, column_type)
+                                for value, column_type in zip(row, types)]))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    # Make sure SQLAlchemy has started a transaction, otherwise committing the connection does not commit the COPY
+    if not connection.in_transaction():
+        connection.begin()
+
+    columns_text = ', '.join(f'"{column}"' for column in columns)
+    on_conflict_clause = get_on_conflict_clause(columns, get_conflict_columns(table), on_conflict)
+    copy_table = table
+    if on_conflict_clause:
+        # The staging table has the columns of the table without the constraints, it exists until the connection
+        # is closed (every writer thread has its own)
+        copy_table = f'_staging_{table}'
+        connection.exec_driver_sql(f'CREATE TEMPORARY TABLE IF NOT EXISTS "{copy_table}" '
+                                   f'(LIKE "{table}" INCLUDING DEFAULTS)')
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY "{copy_table}" ({columns_text}) FROM STDIN', buffer)
+        rowcount = cursor.rowcount
+    finally:
+        cursor.close()
+
+    if on_conflict_clause:
+        rowcount = connection.exec_driver_sql(f'INSERT INTO "{table}" ({columns_text}) SELECT {columns_text} '
+                                              f'FROM "{copy_table}"{on_conflict_clause}').rowcount
+        connection.exec_driver_sql(f'TRUNCATE "{copy_table}"')
+    return get_rows_written(rowcount, batch)
+
+
+MYSQL_DUPLICATE_KEY_ERROR = 1062  # Code of the warning that LOAD DATA gives for a skipped row with a duplicate key
+MAX_MYSQL_TEXT_BYTES = 65_535  # Maximum size of a value in a MySQL TEXT column
+MAX_MYSQL_VARCHAR_PRIMARY_KEY_LENGTH = 255  # Length of the VARCHAR primary keys made by get_mysql_column_types
+
+
+def format_mysql_load_data_value(value, column_name: str, column_type: str) -> str:
+    """
+    Formats a value for the default (tab separated) format of MySQL's LOAD DATA.
+
+    :param value: the value to format
+    :param column_name: name of the column (only used in the error message)
+    :param column_type: type of the column in MySQL, as returned by get_mysql_column_types
+    :raises ValueError: if the value is too long for the column, MySQL would otherwise silently cut it off
+    :return: the value as text, with the special characters of the LOAD DATA format escaped
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'  # Same as pymysql does for INSERT statements
+    if isinstance(value, float) and column_type == 'integer' and value.is_integer():
+        return str(int(value))  # Some data files have integers written as floats (for example 1.0)
+    if not isinstance(value, str):
+        return str(value)
+
+    if column_type == 'text' and len(value.encode('utf-8')) > MAX_MYSQL_TEXT_BYTES:
+        raise ValueError(f"Value of column '{column_name}' is too long for TEXT ({len(value):,} characters), "
+                         f"run count_characters_db.py again so this column gets the type LONGTEXT")
+    if column_type.upper().startswith('VARCHAR') and len(value) > MAX_MYSQL_VARCHAR_PRIMARY_KEY_LENGTH:
+        raise ValueError(f"Value of primary key column '{column_name}' is too long ({len(value):,} characters)")
+
+    return (value.replace('\\', '\\\\')
+            .replace('\x00', '\\0')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def start_mysql_bulk_load(connection: Connection):
+    """
+    Turns off autocommit, unique checks and foreign key checks of a MySQL session for the whole load.
+    The previous settings are stored in the connection, so end_mysql_bulk_load can restore them.
+
+    :param connection: connection to the MySQL database
+    """
+    previous_settings = connection.exec_driver_sql('SELECT @@autocommit, @@unique_checks, @@foreign_key_checks').fetchone()
+    connection.info['mysql_previous_settings'] = tuple(int(setting) for setting in previous_settings)
+    connection.exec_driver_sql('SET autocommit = 0, unique_checks = 0, foreign_key_checks = 0')
+
+
+def end_mysql_bulk_load(connection: Connection):
+    """
+    Restores the session settings that were changed by start_mysql_bulk_load.
+
+    :param connection: connection to the MySQL database
+    """
+    autocommit, unique_checks, foreign_key_checks = connection.info.pop('mysql_previous_settings', (0, 1, 1))
+    connection.commit()
+    connection.exec_driver_sql(f'SET autocommit = {autocommit}, unique_checks = {unique_checks}, '
+                               f'foreign_key_checks = {foreign_key_checks}')
+
+
+def load_data_to_mysql(batch: RowBatch, table: str, connection: Connection, column_types: dict[str, str],
+                       on_conflict: str = 'error') -> int:
+    """
+    Writes a batch to a MySQL table with LOAD DATA LOCAL INFILE, by first writing it to a temporary TSV file.
+    Rows with a duplicate key are skipped with IGNORE or replace the row in the table with REPLACE.
+    The rows are committed when the connection is committed.
+
+    :param batch: the rows to write
+    :param table: name of the table
+    :param connection: connection to the MySQL database (made with local_infile enabled)
+    :param column_types: column types of the table in MySQL, as returned by get_mysql_column_types
+    :param on_conflict: what to do with rows that have the same primary key as a row in the table, see ON_CONFLICT_MODES
+    :raises ValueError: if MySQL gave warnings, LOAD DATA LOCAL only warns about wrong values or duplicate keys
+    (duplicate keys are only an error if on_conflict is 'error')
+    :return: the number of rows written, see get_rows_written
+    """
+    columns = batch.columns
+    types = [column_types.get(column, 'text') for column in columns]
+
+    # newline='' so the line endings are not changed on Windows
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.tsv', delete=False) as tsv_file:
+        tsv_path = tsv_file.name
+        for row in batch.rows:
+            tsv_file.write('\t'.join([format_mysql_load_data_value(value, column, column_type)
+                                      for value, column, column_type in zip(row, columns, types)]))
+            tsv_file.write('\n')
+
+    duplicate_keys_allowed = on_conflict != 'error' and bool(get_conflict_columns(table))
+    duplicate_keyword = {'ignore': 'IGNORE ', 'update': 'REPLACE '}.get(on_conflict, '') if duplicate_keys_allowed else ''
+    try:
+        columns_text = ', '.join(f'`{column}`' for column in columns)
+        # The TSV file uses the default format of LOAD DATA (tab separated, escaped by a backslash, \N for NULL)
+        result = connection.exec_driver_sql(f"LOAD DATA LOCAL INFILE '{tsv_path.replace(os.sep, '/')}' "
+                                            f"{duplicate_keyword}INTO TABLE `{table}` CHARACTER SET utf8mb4 "
+                                            f"({columns_text})")
+        rows_loaded = result.rowcount
+        warning_count = connection.exec_driver_sql('SELECT @@warning_count').scalar()
+        if warning_count or rows_loaded != len(batch):
+            warnings = [tuple(warning) for warning in connection.exec_driver_sql('SHOW WARNINGS').fetchall()]
+            if duplicate_keys_allowed:
+                # Skipped (or replaced, which counts as two rows) rows with a duplicate key are expected
+                warnings = [warning for warning in warnings if warning[1] != MYSQL_DUPLICATE_KEY_ERROR]
+            if warnings or not duplicate_keys_allowed:
+                raise ValueError(f'LOAD DATA loaded {rows_loaded:,} of {len(batch):,} rows into {table} '
+                                 f'with {warning_count:,} warning(s): {warnings[:5]}')
+    finally:
+        os.remove(tsv_path)
+    return get_rows_written(rows_loaded, batch)
+
+
+def start_sqlite_bulk_load(connection: Connection):
+    """
+    Changes the settings of a SQLite connection for a fast import: the journal in memory (or a write-ahead journal),
+    no syncing to disk, a large page cache and temporary tables in memory. The journal can't be turned off, it is
+    needed to roll back the savepoint of a batch that failed (see get_write_method). The settings come from
+    'executemany' in the sqlite config. If the import crashes with these settings, the database can be corrupt and has
+    to be made again.
+
+    :param connection: connection to the SQLite database
+    """
+    settings = load_json('config.json')['sqlite'].get('executemany', {})
+    journal_mode = settings.get('journal_mode', 'MEMORY')
+    cache_size_mb = settings.get('cache_size_mb', 1024)
+
+    connection.exec_driver_sql(f'PRAGMA journal_mode = {journal_mode}')
+    connection.exec_driver_sql('PRAGMA synchronous = OFF')
+    connection.exec_driver_sql(f'PRAGMA cache_size = -{cache_size_mb * 1024}')  # Negative means size in KiB
+    connection.exec_driver_sql('PRAGMA temp_store = MEMORY')
+
+
+def end_sqlite_bulk_load(connection: Connection):
+    """
+    Commits the rows that are not committed yet and restores the default (safe) settings of a SQLite connection.
+
+    :param connection: connection to the SQLite database
+    """
+    connection.connection.commit()
+    connection.info.pop('chunks_not_committed', None)
+    connection.exec_driver_sql('PRAGMA journal_mode = DELETE')
+    connection.exec_driver_sql('PRAGMA synchronous = FULL')
+    connection.exec_driver_sql('PRAGMA cache_size = -2000')
+    connection.exec_driver_sql('PRAGMA temp_store = DEFAULT')
+
+
+def executemany_to_sqlite(batch: RowBatch, table: str, connection: Connection, on_conflict: str = 'error') -> int:
+    """
+    Writes a batch to a SQLite table with executemany of one prepared INSERT statement on the raw sqlite3
+    connection. The rows are committed by commit_sqlite_chunk (once every 'commit_every_chunks' chunks) and at the
+    end of the load by end_sqlite_bulk_load, committing the SQLAlchemy connection does not commit them.
+
+    :param batch: the rows to write
+    :param table: name of the table
+    :param connection: connection to the SQLite database, prepared by start_sqlite_bulk_load
+    :param on_conflict: what to do with rows that have the same primary key as a row in the table, see ON_CONFLICT_MODES
+    :return: the number of rows written, see get_rows_written
+    """
+    columns_text = ', '.join(f'"{column}"' for column in batch.columns)
+    placeholders = ', '.join('?' * len(batch.columns))
+    on_conflict_clause = get_on_conflict_clause(batch.columns, get_conflict_columns(table), on_conflict)
+
+    # sqlite3 caches the prepared statement, so it is only compiled once per table
+    cursor = connection.connection.executemany(f'INSERT INTO "{table}" ({columns_text}) VALUES ({placeholders})'
+                                               f'{on_conflict_clause}', batch.rows)
+    return get_rows_written(cursor.rowcount, batch)
+
+
+def commit_sqlite_chunk(connection: Connection):
+    """
+    Commits the rows written by executemany_to_sqlite once every 'commit_every_chunks' chunks (sqlite config).
+    This is done separately from writing, so the chunk can be written in a savepoint. The number of chunks that are
+    not committed yet is kept in connection.info['chunks_not_committed'] (see WriterPipeline).
+
+    :param connection: connection to the SQLite database, prepared by start_sqlite_bulk_load
+    """
+    commit_every_chunks = load_json('config.json')['sqlite'].get('executemany', {}).get('commit_every_chunks', 10)
+    dbapi_connection = connection.connection
+    chunks_not_committed = connection.info.get('chunks_not_committed', 0) + 1
+    if chunks_not_committed >= commit_every_chunks:
+        dbapi_connection.commit()
+        chunks_not_committed = 0
+    connection.info['chunks_not_committed'] = chunks_not_committed
+
+
+def analyze_sqlite(engine: Engine):
+    """
+    Runs ANALYZE on a SQLite database, so the query planner has statistics about the tables and indexes.
+
+    :param engine: engine of the SQLite database
+    """
+    with engine.connect() as connection:
+        connection.exec_driver_sql('ANALYZE')
+        connection.commit()
@@ -2,12 +2,15 @@ import orjson as json
 import sqlite3
 from typing import Any, Mapping
 from pymongo import MongoClient
-from collections import deque
 from pymongo.synchronous.database import Database
 from sqlalchemy import Engine, text, create_engine
 import subprocess
 import os
+import threading
 from classes.DBType import DBTypes, DBType
+from ndjson_reader import iter_line_range, iter_lines_reverse
+from line_counts import load_line_index
+from classes.LengthProfiler import LengthProfiler
 from datetime import datetime
 import psycopg2
 from sqlalchemy import create_engine
@@ -66,19 +69,29 @@ def write_json(data: dict | list, file_path: str):
 
 def extract_line(line_nr, content_file_path) -> str | None:
     """"
-    Extracts a line from a file given a line number.
+    Extracts a line from a file given a line number. The line index of the file is used when it exists
+    (see load_line_index), otherwise the file is read from the start.
 
-    :param line_nr: The line number to extract.
-    :return: The extracted line, or None if the line number is invalid or the file is empty.
+    :param line_nr: The line number to extract (starting at 1).
+    :return: The extracted line (without the newline), or None if the line number is invalid or the file is empty.
     """
-    line_nr = int(line_nr)
-    count_line_find = 0
-    with open(content_file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            count_line_find += 1
-            if count_line_find == line_nr:
-                return line
-    return None
+    lines = extract_line_range(line_nr, 1, content_file_path)
+    return lines[0] if lines else None
+
+
+def extract_line_range(first_line_nr, line_count, content_file_path) -> list[str]:
+    """
+    Extracts consecutive lines from a file, using the line index of the file when it exists (see load_line_index).
+
+    :param first_line_nr: The line number of the first line to extract (starting at 1).
+    :param line_count: The number of lines to extract.
+    :return: The extracted lines (without the newlines), fewer if the file ends before the last line.
+    """
+    first_line_nr = int(first_line_nr)
+    if first_line_nr < 1:
+        return []
+    lines = iter_line_range(content_file_path, first_line_nr - 1, line_count, load_line_index(content_file_path))
+    return [bytes(line).decode('utf-8', errors='replace') for line in lines]
 
 
 def get_tables_database(engine: Engine, db_type: DBType):
@@ -113,19 +126,15 @@ def get_tables_database(engine: Engine, db_type: DBType):
 
 
 def read_file_reverse(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        # Initialize a deque with a fixed size, so it can store lines in reverse order
-        lines = deque(maxlen=1)  # Using deque to simulate the reverse reading
-        f.seek(0, 2)  # Seek to the end of the file
-        buffer = ''
+    """
+    Reads the lines of a file from the last to the first (see iter_lines_reverse), for example to read the tail of a
+    large file without reading the whole file.
 
-        while f.tell() > 0:
-            f.seek(f.tell() - 1024, 0)  # Move the pointer back 1024 bytes
-            buffer = f.read(1024) + buffer  # Read the chunk and add to buffer
-            lines = deque(buffer.splitlines(), maxlen=1)
-            if lines:
-                for line in reversed(lines):
-                    yield line  # Yield lines in reverse order
+    :param file_path: path to the file
+    :return: generator yielding the lines (without the newline) in reverse order
+    """
+    for line in iter_lines_reverse(file_path):
+        yield line.decode('utf-8', errors='replace')
 
 
 def check_files(db_type: None | DBType = None):
@@ -151,6 +160,36 @@ def check_files(db_type: None | DBType = None):
         raise FileNotFoundError(f"The following files were not found:\n{file_not_found_text}")
 
 
+def save_character_lengths(data_file: str, profiler: LengthProfiler, output_file: str = 'character_lengths.json',
+                           statistics_file: str = 'character_length_statistics.json'):
+    """
+    Saves the maximum character count per attribute of a data file to the character lengths file (used for the MySQL
+    column types), and the other statistics of the lengths to a separate statistics file. The character lengths file
+    only has data files as keys, like the file that count_characters_db.py can download.
+
+    :param data_file: the data file that was profiled
+    :param profiler: the profiler with the lengths of the whole data file (or the lines that are imported)
+    :param output_file: the JSON file where the results will be written to
+    :param statistics_file: the JSON file where the statistics of the lengths will be written to
+    """
+    current_data = {}
+    if os.path.isfile(output_file):
+        current_data = load_json(output_file)
+    current_statistics = {}
+    if os.path.isfile(statistics_file):
+        current_statistics = load_json(statistics_file)
+
+    current_data[data_file] = dict(sorted(profiler.max_lengths.items()))
+    current_statistics[data_file] = profiler.get_statistics()
+
+    # Add rule_id for subreddit_rules_2025-01 (also when it is read from the compressed file)
+    if data_file.removesuffix('.zst') == 'data/subreddits/subreddit_rules_2025-01/subreddit_rules_2025-01':
+        current_data[data_file]['rule_id'] = 20
+    write_json(current_data, output_file)
+    write_json(current_statistics, statistics_file)
+    _json_cache.pop(output_file, None)  # The file can be loaded again later in the same run
+
+
 def get_count_rows_database(conn, table_name):
     cursor = conn.cursor()
     cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
@@ -245,7 +284,12 @@ def make_mysql_engine(db_type: DBType|None=None):
     if db_type is not None:
         engine_url = f"{engine_url}/reddit_data_{db_name}"
 
-    engine = create_engine(engine_url)
+    # LOAD DATA LOCAL INFILE has to be allowed by the client
+    connect_args = {}
+    if data.get("write_method") == "load_data":
+        connect_args["local_infile"] = True
+
+    engine = create_engine(engine_url, connect_args=connect_args)
     return engine
 
 
@@ -273,7 +317,8 @@ def make_mongodb_client(db_type: DBType=None) -> Database[Mapping[str, Any] | An
 
     return db
 
-def update_summary_log(db_type: DBType, data_file: str, start_time: datetime, end_time: datetime, line_count: int, total_lines: int, tables: list|None, chunk_size: int, sql_writes: int|None):
+def update_summary_log(db_type: DBType, data_file: str, start_time: datetime, end_time: datetime, line_count: int, total_lines: int, tables: list|None, chunk_size: int, sql_writes: int|None,
+                       write_stats: dict|None = None, dedup_stats: dict|None = None):
     """
     Updates the summary log file.
 
@@ -286,6 +331,8 @@ def update_summary_log(db_type: DBType, data_file: str, start_time: datetime, en
     :param tables: list of tables processed
     :param chunk_size: number of lines written to the sql database at a time
     :param sql_writes: number of sql writes
+    :param write_stats: write method, number of rows written and the time spent writing them (summed over the writer threads)
+    :param dedup_stats: number of keys and skipped duplicates of the deduplicated tables and the memory use of the store
     """
     summary_path = f"logs/summaries/summary_{db_type.to_string()}_{db_type.name_suffix}.json"
     current_summary = load_json(summary_path)
@@ -301,6 +348,15 @@ def update_summary_log(db_type: DBType, data_file: str, start_time: datetime, en
                        'time_elapsed_seconds': time_elapsed_seconds, 'tables': tables,
                        'line_count': line_count, 'chunk_size': chunk_size, 'total_lines': total_lines,
                        'sql_writes': sql_writes}
+    if write_stats:
+        info_to_add_log['write_method'] = write_stats['write_method']
+        info_to_add_log['rows_written'] = write_stats['rows_written']
+        info_to_add_log['write_seconds'] = round(write_stats['write_seconds'], 3)
+        if write_stats['write_seconds'] > 0:
+            info_to_add_log['rows_per_second'] = round(write_stats['rows_written'] / write_stats['write_seconds'])
+        info_to_add_log['dead_letter_rows'] = write_stats.get('dead_letter_rows', 0)
+    if dedup_stats:
+        info_to_add_log['dedup'] = dedup_stats
     if db_type.is_type(DBTypes.MONGODB):
         del info_to_add_log['tables']
         del info_to_add_log['sql_writes']
@@ -308,6 +364,50 @@ def update_summary_log(db_type: DBType, data_file: str, start_time: datetime, en
     write_json(current_summary, summary_path)
 
 
+def update_index_summary_log(db_type: DBType, index_stats: dict[str, dict]):
+    """
+    Updates the index summary log file with the indexes built after the import (see data_to_db/index_builder.py).
+    It is separate from the summary log, which has one entry per data file.
+
+    :param db_type: database type
+    :param index_stats: dict with the index names as keys and the table, columns, reason and build time (or error) as values
+    """
+    summary_path = f"logs/summaries/indexes_{db_type.to_string()}_{db_type.name_suffix}.json"
+    current_summary = load_json(summary_path)
+    for index_name, statistics in index_stats.items():
+        if statistics.get('existed') and index_name in current_summary:
+            # Keep the build time of the import that built the index, the size can have changed
+            if 'size_bytes' in statistics:
+                current_summary[index_name]['size_bytes'] = statistics['size_bytes']
+            continue
+        current_summary[index_name] = statistics
+    write_json(current_summary, summary_path)
+
+
+dead_letter_lock = threading.Lock()  # The dead-letter file can be written by multiple writer threads
+
+
+def write_dead_letter(db_type: DBType, table: str, rows: list[dict], error: str | list[str]) -> str:
+    """
+    Appends rows that could not be written to the database to the dead-letter file of the database, one JSON object
+    per line with the table, the error and the row, so the import can continue and the rows can be checked afterward.
+
+    :param db_type: database type
+    :param table: the table (or collection) the rows were written to
+    :param rows: the rows, as dicts with the column names as keys
+    :param error: the error that the database gave for the rows, or a list with the error of every row
+    :return: path to the dead-letter file
+    """
+    errors = error if isinstance(error, list) else [error] * len(rows)
+    os.makedirs('logs/dead_letter', exist_ok=True)
+    file_path = f'logs/dead_letter/dead_letter_{db_type.to_string()}_{db_type.name_suffix}.ndjson'
+    with dead_letter_lock, open(file_path, 'ab') as f:
+        for row, row_error in zip(rows, errors):
+            f.write(json.dumps({'table': table, 'error': row_error, 'row': row}, default=str))
+            f.write(b'\n')
+    return file_path
+
+
 def should_skip(line: dict|list[dict], primary_keys: list) -> bool:
     """
     Determines whether the line should be skipped based on the primary keys and other values.
@@ -326,11 +426,6 @@ def should_skip(line: dict|list[dict], primary_keys: list) -> bool:
     if any(line.get(key) is None or line.get(key) == '' for key in primary_keys):
         return True
 
-    # Get all other keys not in primary_keys
-    other_keys = [k for k in line.keys() if k not in primary_keys]
-
-    # If all other values are None or empty
-    if all(line.get(k) is None or line.get(k) == '' for k in other_keys):
-        return True
-    return False
+    # If all other values are None or empty, stops at the first other value that is not
+    return not any(value is not None and value != '' for key, value in line.items() if key not in primary_keys)
 
@@ -1,118 +1,228 @@
 import json
-import hashlib
 import time
+import zlib
 from pathlib import Path
 import os
 from tqdm import tqdm
+from ndjson_reader import (count_lines_parallel, count_newline_checkpoints, ends_with_newline, estimate_line_count,
+                           is_compressed, COUNT_RANGE_SIZE)
+from classes.LineIndex import LineIndex
 
 CACHE_FILE = "cache/file_counts.json"
+COUNT_WORKERS = min(8, os.cpu_count() or 1)  # Number of processes that count the lines of a file
+HASH_METHOD = "sampled_crc32"
+FINGERPRINT_SAMPLES = 16  # Number of blocks spread across the file that are hashed
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+LINE_INDEX_FOLDER = "cache/line_index"
+LINE_INDEX_INTERVAL = 1000  # Number of lines between the entries of a line index
 # os.makedirs('cache', exist_ok=True)
 
 
-def count_lines_in_file(file_path):
-    """Count the number of lines in a file."""
-    with open(file_path, "r", encoding="utf-8") as file:
-        return sum(1 for _ in tqdm(file, desc="Counting lines", unit="lines"))
+def count_lines_in_file(file_path, workers=COUNT_WORKERS):
+    """Count the number of lines in a file, parts of the file are counted in parallel by `workers` processes."""
+    with tqdm(total=os.path.getsize(file_path), desc="Counting lines", unit="B", unit_scale=True) as progress_bar:
+        return count_lines_parallel(file_path, workers, progress_bar=progress_bar)
 
 
-def get_line_count_file(file_path: str):
+def get_line_count_file(file_path: str, estimate: bool = False):
     """
-    Get the line count of a file. If the file is cached and the MD5 hash is correct,
-    return the cached line count. If not, compute the line count, hash, and update the cache.
+    Get the line count of a file. If the file is cached and its fingerprint is unchanged,
+    return the cached line count. If not, count the lines (only the new part if lines were appended) and update the cache.
 
     :param file_path: Path to the file
+    :param estimate: if the line count is not cached, return an estimate (see estimate_line_count) instead of
+    counting the lines, for example when it is only used as the total of a progress bar. Estimates are not cached.
 
     :return: Line count of the file.
     """
     # Load cached data
     cached_data = {entry["path"]: entry for entry in load_cached_data()}
+    cached_entry = cached_data.get(file_path)
+    fingerprint = compute_fingerprint(file_path)
 
-    # Check if file is cached
-    if file_path in cached_data:
-        file_hash, hash_method = compute_md5(file_path)  # Compute hash of current file
-        cached_hash = cached_data[file_path]["hash"]
+    # If the fingerprint matches, return the cached line count
+    if cached_entry is not None and is_unchanged(cached_entry, fingerprint):
+        return cached_entry["line_count"]
 
-        # If hash matches, return the cached line count
-        if file_hash == cached_hash:
-            return cached_data[file_path]["line_count"]
+    if estimate:
+        return estimate_line_count(file_path)
 
-    # If no cache or hash mismatch, compute line count and hash
-    line_count = count_lines_in_file(file_path)  # Replace with actual line count function
-    file_hash, hash_method = compute_md5(file_path)  # Compute file hash
-
-    # Update cache
-    file_data = {"path": file_path, "line_count": line_count, "hash": file_hash, "hash_method": hash_method}
+    # If no cache or the file changed, count the lines and update the cache
+    file_data = make_cache_entry(file_path, fingerprint, cached_entry)
     cached_data[file_path] = file_data
     save_cached_data(list(cached_data.values()))  # Save updated cache
 
-    return line_count
+    return file_data["line_count"]
+
+
+def save_line_count(file_path: str, line_count: int):
+    """
+    Save a line count that was found while reading the whole file for something else (for example the profile stage of
+    an import), so the lines don't have to be counted again. A line count that is already cached is kept, since that
+    entry can also have checkpoints and a line index.
+
+    :param file_path: Path to the file
+    :param line_count: the number of lines in the file
+    """
+    cached_data = {entry["path"]: entry for entry in load_cached_data()}
+    fingerprint = compute_fingerprint(file_path)
+    if file_path in cached_data and is_unchanged(cached_data[file_path], fingerprint):
+        return
+    cached_data[file_path] = {"path": file_path, **fingerprint, "line_count": line_count, "newlines": None,
+                              "checkpoints": [], "line_index_file": None}
+    save_cached_data(list(cached_data.values()))
+
+
+def compute_fingerprint(file_path) -> dict:
+    """
+    Compute the fingerprint of a file: its size, modification time and a hash of sampled blocks (see compute_sampled_hash).
+
+    :param file_path: Path to the file.
+
+    :return: dict with the size, mtime_ns, hash and hash_method of the file
+    """
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "hash": compute_sampled_hash(file_path, stat.st_size), "hash_method": HASH_METHOD}
 
 
-def compute_md5(file_path, chunk_size=4096, size_threshold=10, preferred_hash_method=None) -> (str, str):
+def compute_sampled_hash(file_path, size, samples=FINGERPRINT_SAMPLES, block_size=FINGERPRINT_BLOCK_SIZE) -> str:
     """
-    Compute MD5 hash of the file. If the file is larger than `size_limit`,
-    it computes the hash of the first chunk only.
+    Compute a CRC32 hash of `samples` blocks spread evenly over the first `size` bytes of a file, including the first
+    and the last block. Files up to samples * block_size bytes are hashed completely. Because the blocks only depend on
+    `size`, the hash of the start of a grown file can be compared with the hash of the file before it grew.
 
     :param file_path: Path to the file.
-    :param chunk_size: Size of the chunk to read for large files (default: 4096 bytes).
-    :param size_threshold: The file size threshold in GB's (default: 5GB), if above this threshold (and preferred_hash_method=None) then partial MD5 hash will be used to save time (but reduced accuracy).
-    :param preferred_hash_method: The preferred hash method to use ('md5_partial' or 'md5_full'), set to None to determine the preferred hash method based on file size.
+    :param size: number of bytes at the start of the file that are hashed
+    :param samples: number of blocks that are hashed
+    :param block_size: size of the blocks in bytes
 
-    :return (hash, hash_method): MD5 hash of the file and hash method (md5_full or md5_partial)
+    :return: the hash as a hexadecimal string
     """
-    # If preferred_hash_method is not None, then already compute with method without looking at file size
-    if preferred_hash_method is not None:
-        if 'partial' in preferred_hash_method:
-            hash_method = 'md5_partial'
-            return compute_md5_partial(file_path, chunk_size), hash_method
+    crc = 0
+    with open(file_path, "rb") as f:
+        if size <= samples * block_size:
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(block_size, remaining))
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
         else:
-            hash_method = 'md5_full'
-            return compute_md5_full(file_path), hash_method
+            for i in range(samples):
+                f.seek((size - block_size) * i // (samples - 1))
+                crc = zlib.crc32(f.read(block_size), crc)
+    return f"{crc:08x}"
+
+
+def is_unchanged(cached_entry: dict, fingerprint: dict) -> bool:
+    """Check if a cached file has the same fingerprint as now (cache entries of older hash methods never match)."""
+    return all(cached_entry.get(key) == value for key, value in fingerprint.items())
+
+
+def can_count_appended_lines(file_path, cached_entry: dict | None, size: int) -> bool:
+    """
+    Check if a file only grew since it was cached, so the cached newlines are still correct and only the new part has
+    to be counted. The start of the file must have the same hash as the whole file had when it was cached.
 
-    size_threshold = size_threshold * 1024 * 1024 * 1024
-    file_size = os.path.getsize(file_path)
+    :param file_path: Path to the file.
+    :param cached_entry: cache entry of the file, or None if not cached
+    :param size: current size of the file
+
+    :return: True if only the lines after the cached size have to be counted
+    """
+    if cached_entry is None or cached_entry.get("hash_method") != HASH_METHOD or cached_entry.get("newlines") is None:
+        return False
+    cached_size = cached_entry["size"]
+    if not 0 < cached_size < size:
+        return False
+    return compute_sampled_hash(file_path, cached_size) == cached_entry["hash"]
+
+
+def get_line_index_path(file_path) -> str:
+    """Get the path of the line index file of a data file, the hash of the path keeps files with the same name apart."""
+    return f"{LINE_INDEX_FOLDER}/{Path(file_path).name}-{zlib.crc32(Path(file_path).as_posix().encode()):08x}.idx"
+
+
+def load_line_index(file_path) -> LineIndex | None:
+    """
+    Load the line index of a data file, made when its lines were counted (see make_cache_entry).
+
+    :param file_path: Path to the data file.
+
+    :return: the line index, or None if the file has no index or changed since it was indexed
+    """
+    cached_entry = {entry["path"]: entry for entry in load_cached_data()}.get(file_path)
+    if cached_entry is None or cached_entry.get("line_index_file") is None:
+        return None
+    if not is_unchanged(cached_entry, compute_fingerprint(file_path)) or \
+            not os.path.isfile(cached_entry["line_index_file"]):
+        return None
+    return LineIndex.load(cached_entry["line_index_file"])
+
+
+def make_cache_entry(file_path, fingerprint: dict, cached_entry: dict | None = None, workers=COUNT_WORKERS) -> dict:
+    """
+    Count the lines of a file and make its cache entry. Besides the line count, the entry of an uncompressed file has
+    the number of newlines and checkpoints: the number of newlines before every multiple of COUNT_RANGE_SIZE bytes.
+    When the file only grew since `cached_entry` was made, only the newlines after the cached size are counted.
+    A line index of the file (see LineIndex) is made while counting and saved in LINE_INDEX_FOLDER.
+
+    :param file_path: Path to the file.
+    :param fingerprint: fingerprint of the file, see compute_fingerprint
+    :param cached_entry: previous cache entry of the file, or None if not cached
+    :param workers: number of processes that count the lines
 
-    if file_size > size_threshold:
-        # If file is larger than the size limit, hash only the first chunk
-        hash_method = 'md5_partial'
-        return compute_md5_partial(file_path, chunk_size), hash_method
+    :return: the cache entry
+    """
+    file_data = {"path": file_path, **fingerprint}
+    if is_compressed(file_path):
+        # Compressed files can only be counted from the start
+        file_data.update({"line_count": count_lines_in_file(file_path, workers), "newlines": None, "checkpoints": [],
+                          "line_index_file": None})
+        return file_data
+
+    size = fingerprint["size"]
+    line_index_file = get_line_index_path(file_path)
+    line_index = None
+    if can_count_appended_lines(file_path, cached_entry, size) and os.path.isfile(line_index_file):
+        line_index = LineIndex.load(line_index_file)
+    if line_index is not None and line_index.interval == LINE_INDEX_INTERVAL:
+        start = cached_entry["size"]
+        newlines_before = cached_entry["newlines"]
+        checkpoints = list(cached_entry["checkpoints"])
+        print(f"Counting the lines appended to {file_path} after byte {start}")
     else:
-        # Otherwise, compute the full MD5 hash of the file
-        hash_method = 'md5_full'
-        return compute_md5_full(file_path), hash_method
-
-
-def compute_md5_partial(file_path, chunk_size=4096):
-    """Compute MD5 hash of only the first chunk of the file."""
-    hash_md5 = hashlib.md5()
-    try:
-        with open(file_path, "rb") as f:
-            chunk = f.read(chunk_size)  # Read only the first chunk
-            hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-    except Exception as e:
-        print(f"Error hashing {file_path}: {e}")
-        return None  # In case of error
-
-
-def compute_md5_full(file_path):
-    """Compute the full MD5 hash of the file."""
-    hash_md5 = hashlib.md5()
-    try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-    except Exception as e:
-        print(f"Error hashing {file_path}: {e}")
-        return None  # In case of error
+        start = 0
+        newlines_before = 0
+        checkpoints = []
+        line_index = LineIndex(LINE_INDEX_INTERVAL)
+
+    with tqdm(total=size, initial=start, desc="Counting lines", unit="B", unit_scale=True) as progress_bar:
+        new_checkpoints, line_offsets = count_newline_checkpoints(file_path, start, workers, progress_bar=progress_bar,
+                                                                  index_interval=LINE_INDEX_INTERVAL)
+    checkpoints += [[offset, newlines_before + newlines] for offset, newlines in new_checkpoints
+                    if offset % COUNT_RANGE_SIZE == 0]
+    newlines = newlines_before + new_checkpoints[-1][1]
+
+    for line_newlines, offset in line_offsets:
+        line_index.add(newlines_before + line_newlines, offset)
+    os.makedirs(LINE_INDEX_FOLDER, exist_ok=True)
+    line_index.save(line_index_file)
+
+    # The last line is also counted when it doesn't end with a newline
+    file_data.update({"line_count": newlines + (not ends_with_newline(file_path)), "newlines": newlines,
+                      "checkpoints": checkpoints, "line_index_file": line_index_file})
+    return file_data
 
 
 def find_files_without_extension(root_folder=None):
-    """Find all files without extensions recursively."""
+    """Find all files without extensions (and compressed .zst data files) recursively."""
     if root_folder is None:
         root_folder = ''
-    return [file.as_posix() for file in Path(root_folder).rglob('*') if file.is_file() and file.suffix == '' and '.' not in file.as_posix()]
+    return [file.as_posix() for file in Path(root_folder).rglob('*') if file.is_file() and
+            ((file.suffix == '' and '.' not in file.as_posix()) or file.suffix == '.zst')]
 
 
 def load_cached_data():
@@ -125,26 +235,26 @@ def load_cached_data():
 
 def save_cached_data(data):
     """Save updated file counts and hashes to the cache file."""
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
     with open(CACHE_FILE, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4)
 
 
 def make_dict_file_counts(files):
-    """Compute line counts, using cache if file hash is unchanged."""
+    """Compute line counts, using cache if the file fingerprint is unchanged."""
     cached_data = {entry["path"]: entry for entry in load_cached_data()}
     updated_data = []
 
     for file in files:
-        file_hash, hash_method = compute_md5(file)
+        fingerprint = compute_fingerprint(file)
 
-        if file in cached_data and cached_data[file]["hash"] == file_hash:
+        if file in cached_data and is_unchanged(cached_data[file], fingerprint):
             print(f"Skipping {file} (unchanged)")
             updated_data.append(cached_data[file])  # Keep existing data
         else:
-            print(f"Processing {file} (hash changed or new file)")
+            print(f"Processing {file} (file changed or new file)")
             time.sleep(0.2)
-            line_count = get_line_count_file(file)
-            updated_data.append({"path": file, "line_count": line_count, "hash": file_hash, "hash_method": hash_method})
+            updated_data.append(make_cache_entry(file, fingerprint, cached_data.get(file)))
 
     return updated_data
 
@@ -1,8 +1,15 @@
+import tracemalloc
+from typing import Any, Callable
 from openpyxl.utils import get_column_letter
 from openpyxl import load_workbook
 from classes.DBType import DBType, DBTypes
+from classes.RssSampler import RssSampler
 from data_to_db.data_to_sql import load_json, write_json
 
+# latency: only the time is measured (perf_counter_ns, nothing traced); memory: only the memory is measured
+# (tracemalloc and sampling the RSS), since tracing the allocations slows down the query
+MEASUREMENT_MODES = ('latency', 'memory')
+
 def expand_excel(excel_path: str):
     """
     Expands the columns visually in Excel such that users does not have to manually adjust the width.
@@ -30,14 +37,56 @@ def expand_excel(excel_path: str):
     # Save the updated workbook
     wb.save(excel_path)
 
-def update_query_metrics(db_type: DBType, query_name: str, time: float, memory: float, output_length: int, query_metrics_file_base_name: str):
+def get_query_metrics_config() -> dict:
+    """
+    Gets the settings of the query benchmarks (query_metrics in config.json).
+
+    :raises ValueError: if a measurement mode is unknown
+    :return: the modes to run (see MEASUREMENT_MODES), whether to split the times of the SQL queries and the
+    interval of the RSS samples in milliseconds (0 to not sample the RSS)
+    """
+    cfg = {'modes': list(MEASUREMENT_MODES), 'split_timings': False, 'rss_sample_interval_ms': 1}
+    cfg.update(load_json('config.json').get('query_metrics', {}))
+    for mode in cfg['modes']:
+        if mode not in MEASUREMENT_MODES:
+            raise ValueError(f"Unknown measurement mode '{mode}' in query_metrics, use one of {list(MEASUREMENT_MODES)}")
+    return cfg
+
+def measure_memory(run: Callable[[], Any], rss_sample_interval_ms: float) -> tuple[Any, dict[str, float]]:
+    """
+    Runs a query while tracing the allocations with tracemalloc and (if rss_sample_interval_ms > 0) sampling the RSS
+    of the process. The query is not timed, tracing makes it a lot slower.
+
+    :param run: Function that executes the query and returns its result.
+    :param rss_sample_interval_ms: Interval of the RSS samples in milliseconds, 0 to not sample the RSS.
+    :return: The result and the measurements: peak traced memory (KB) under 'memories' and the increase of the peak
+    RSS (KB) under 'rss_memories'
+    """
+    sampler = RssSampler(rss_sample_interval_ms / 1000) if rss_sample_interval_ms > 0 else None
+    tracemalloc.start()
+    try:
+        if sampler is None:
+            result = run()
+        else:
+            with sampler:
+                result = run()
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    measurements = {'memories': peak_memory / 1024}
+    if sampler is not None:
+        measurements['rss_memories'] = sampler.peak_increase_kb
+    return result, measurements
+
+def update_query_metrics(db_type: DBType, query_name: str, measurements: dict[str, float], output_length: int, query_metrics_file_base_name: str):
     """
     Updates the JSON file containing the query times and memory needed for each query for a database.
 
     :param db_type: Type of database.
     :param query_name: Name of the query.
-    :param time: Time needed to execute the query.
-    :param memory: The memory (KB) needed to execute the query.
+    :param measurements: The measurements of the query, added to the list of their key (for example 'times' in
+    seconds or 'memories' in KB).
     :param output_length: Length of the output dataframe.
     :param query_metrics_file_base_name: JSON base name for the query times.
     """
@@ -51,15 +100,11 @@ def update_query_metrics(db_type: DBType, query_name: str, time: float, memory:
     if query_name not in current_metrics_data:
         current_metrics_data[query_name] = {}
 
-    # Add time
-    if 'times' not in current_metrics_data[query_name]:
-        current_metrics_data[query_name]['times'] = []
-    current_metrics_data[query_name]['times'].append(round(time, 4))
-
-    # Add memory
-    if 'memories' not in current_metrics_data[query_name]:
-        current_metrics_data[query_name]['memories'] = []
-    current_metrics_data[query_name]['memories'].append(round(memory, 4))
+    # Add times and memories (times are rounded to microseconds)
+    for key, value in measurements.items():
+        if key not in current_metrics_data[query_name]:
+            current_metrics_data[query_name][key] = []
+        current_metrics_data[query_name][key].append(round(value, 6 if key.endswith('times') else 4))
 
     # Add output length of dataframe
     if 'output_lengths' not in current_metrics_data[query_name]:
@@ -68,6 +113,22 @@ def update_query_metrics(db_type: DBType, query_name: str, time: float, memory:
 
     write_json(current_metrics_data, path)
 
+def update_setup_metrics(db_type: DBType, setup_time: float, query_metrics_file_base_name: str):
+    """
+    Updates the JSON file containing the time needed to connect to a database (making the engine and the first
+    connection) before the queries, which is not part of the query times.
+
+    :param db_type: Type of database.
+    :param setup_time: Time needed to connect to the database.
+    :param query_metrics_file_base_name: JSON base name for the query times.
+    """
+    path = f'{query_metrics_file_base_name}_setup_{db_type.get_type().display_name.lower()}_{db_type.name_suffix}.json'
+    current_setup_data = load_json(path)
+    if 'setup_times' not in current_setup_data:
+        current_setup_data['setup_times'] = []
+    current_setup_data['setup_times'].append(round(setup_time, 4))
+    write_json(current_setup_data, path)
+
 def get_total_queries_number(json_queries: dict, db_types: list[DBType]) -> int:
     """
     Gets the total number of queries for all query types.
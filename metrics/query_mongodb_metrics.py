@@ -1,45 +1,56 @@
 import os
 import time
-import tracemalloc
 from typing import Tuple
-from pymongo import MongoClient
 from tqdm import tqdm
-from general_metrics import update_query_metrics, get_total_queries_number
+from general_metrics import update_query_metrics, get_total_queries_number, update_setup_metrics, \
+    get_query_metrics_config, measure_memory
 from queries_mongodb import get_queries
 from collections.abc import Sized
 from classes.DBType import DBTypes, DBType
+from classes.EngineRegistry import EngineRegistry
 
+# Client of the database, made once per run so the query times don't include connecting (see EngineRegistry)
+engine_registry = EngineRegistry()
 
 
-def execute_query(query, db) -> Tuple[int, float, float]:
+def execute_query(query, db, mode: str, cfg: dict) -> Tuple[int, dict[str, float]]:
     """"
-    Executes a MongoDB query and returns the number of results, the execution time and (peak) memory usage in KB.
+    Executes a MongoDB query and returns the number of results and the measurements: in latency mode the execution time
+    in seconds (perf_counter_ns, nothing traced), in memory mode the (peak) memory usage in KB (see measure_memory).
 
     :param query: The MongoDB query (dict)
     :param db: The MongoDB db
-    :return Tuple[len(result), time, memory]
+    :param mode: The measurement mode (see MEASUREMENT_MODES)
+    :param cfg: The settings of the query benchmarks (see get_query_metrics_config)
+    :return Tuple[len(result), measurements]
     """
     try:
-        tracemalloc.start()
-        begin_time = time.time()
-        result = query(db)
-        end_time = time.time()
-        current_memory, peak_memory = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
+        if mode == 'memory':
+            result, measurements = measure_memory(lambda: query(db), cfg['rss_sample_interval_ms'])
+        else:
+            begin_time = time.perf_counter_ns()
+            result = query(db)
+            end_time = time.perf_counter_ns()
+            measurements = {'times': (end_time - begin_time) / 1e9}
 
         if isinstance(result, Sized):
-            return len(result), end_time - begin_time, peak_memory / 1024
+            return len(result), measurements
         else:
-            return 1, end_time - begin_time, peak_memory / 1024
+            return 1, measurements
     except Exception as e:
         print(f'Error with q: {query}\nError: {e}')
-        return -1, -1, -1
+        return -1, {'memories' if mode == 'memory' else 'times': -1}
         # raise ValueError(f"Error executing '{query}': {e}")
 
 
 # Execute and print results
-def execute_queries(query_definitions: dict, db_type: DBType, query_metrics_file_base_name: str):
-    db = MongoClient('mongodb://localhost:27017/')[f'reddit_data_{db_type.name_suffix}']
+def execute_queries(query_definitions: dict, db_type: DBType, query_metrics_file_base_name: str, mode: str, cfg: dict):
+    # Connect before the queries, the setup time is saved separately from the query times
+    if engine_registry.get_setup_seconds(db_type) is None:
+        engine_registry.get(db_type)
+        update_setup_metrics(db_type=db_type, setup_time=engine_registry.get_setup_seconds(db_type),
+                             query_metrics_file_base_name=query_metrics_file_base_name)
+    db = engine_registry.get(db_type)
 
     pbar = tqdm(total=get_total_queries_number(query_definitions, [db_type]), desc='Executing queries')
     for group_name, group in query_definitions.items():
@@ -48,11 +59,11 @@ def execute_queries(query_definitions: dict, db_type: DBType, query_metrics_file
             pbar.update(1)
             pbar.set_postfix_str(f'{db_type.display_name}: {q["name"]}')
             collection = db[q["collection"]]
-            output_length, execution_time, memory = execute_query(q["query"], collection)
+            output_length, measurements = execute_query(q["query"], collection, mode=mode, cfg=cfg)
 
             # Update metrics
-            update_query_metrics(db_type=db_type, query_name=q['name'], memory=memory,
-                                 time=execution_time, output_length=output_length,
+            update_query_metrics(db_type=db_type, query_name=q['name'], measurements=measurements,
+                                 output_length=output_length,
                                  query_metrics_file_base_name=query_metrics_file_base_name)
 
 
@@ -66,6 +77,7 @@ if __name__ == "__main__":
     # Make db_type object
     db_type = DBType(db_type=DBTypes.MONGODB, name_suffix="1m")
     query_metrics_file_base_name = 'metrics/output/query_metrics'
+    cfg = get_query_metrics_config()
 
     LOOP_TIMES = 10
     count = 0
@@ -77,4 +89,8 @@ if __name__ == "__main__":
         # Only get analytical queries to test. Comment the following line if you want to test all queries
         queries = {'analytical': queries['analytical']}
 
-        execute_queries(queries, db_type, query_metrics_file_base_name)
+        # The time and the memory are measured in separate runs of the queries, see MEASUREMENT_MODES
+        for mode in cfg['modes']:
+            execute_queries(queries, db_type, query_metrics_file_base_name, mode=mode, cfg=cfg)
+
+    engine_registry.dispose()
@@ -1,106 +1,93 @@
 import os
-from general import make_postgres_engine, make_mysql_engine, make_sqlite_engine, write_json
+from sqlalchemy import Engine
 from data_to_db.data_to_sql import load_json
 from classes.DBType import DBTypes, DBType
+from classes.EngineRegistry import EngineRegistry
 from tqdm import tqdm
-from metrics.general_metrics import update_query_metrics, get_total_queries_number
-import tracemalloc
+from metrics.general_metrics import update_query_metrics, get_total_queries_number, update_setup_metrics, \
+    get_query_metrics_config, measure_memory
 import time
 import pandas as pd
 import random
 
-def execute_sqlite_query(query: str, db_type: DBType) -> tuple[float, float, int]:
-    """
-    Executes a sqlite query (string) and return the memory, execution time and length of dataframe (result).
+# Engines of the databases, made once per run so the query times don't include connecting (see EngineRegistry)
+engine_registry = EngineRegistry()
 
-    :param query: The query to execute
-    :return: Memory (KB) and time (seconds) needed to execute the query
+def read_sql_split(query: str, conn) -> tuple[pd.DataFrame, dict[str, float]]:
     """
-    tracemalloc.start()
-    begin_time = time.time()
-
-    engine = make_sqlite_engine(db_type)
-    with engine.connect() as conn:
-        df = pd.read_sql(query, conn)
-
-    end_time = time.time()
-    current_memory, peak_memory = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-    len_df = len(df)
-    del df
-    return peak_memory / 1024, end_time - begin_time, len_df
-
-def execute_postgres_query(query: str, db_type: DBType) -> tuple[float, float, int]:
-    """
-    Executes a PostgreSQL query (string) and return the memory, execution time and length of dataframe (result).
+    Executes a query in the steps of pd.read_sql and times every step: executing the query, fetching the rows and
+    building the dataframe. The drivers of PostgreSQL and MySQL receive the whole result while executing the query, so
+    for these databases the execute time includes sending the rows and the fetch time is only making the Python rows.
 
     :param query: The query to execute
-    :param db_type: Database type to execute the query for.
-    :return: Memory (KB) and time (seconds) needed to execute the query
+    :param conn: Connection to the database
+    :return: The dataframe and the times (seconds) under 'execute_times', 'fetch_times' and 'dataframe_times'
     """
-    tracemalloc.start()
-    begin_time = time.time()
-
-    engine = make_postgres_engine(db_type=db_type)
-    with engine.connect() as conn:
-        df = pd.read_sql(query, conn)
-
-    end_time = time.time()
-    current_memory, peak_memory = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
-    len_df = len(df)
-    del df
-    return peak_memory / 1024, end_time - begin_time, len_df
-
-def execute_mysql_query(db_type: DBType, query: str) -> tuple[float, float, int]:
+    begin_time = time.perf_counter_ns()
+    result = conn.exec_driver_sql(query)
+    executed_time = time.perf_counter_ns()
+    rows = result.fetchall()
+    fetched_time = time.perf_counter_ns()
+    df = pd.DataFrame.from_records(rows, columns=list(result.keys()), coerce_float=True)
+    end_time = time.perf_counter_ns()
+    return df, {'execute_times': (executed_time - begin_time) / 1e9, 'fetch_times': (fetched_time - executed_time) / 1e9,
+                'dataframe_times': (end_time - fetched_time) / 1e9}
+
+def execute_sql_query(query: str, engine: Engine, mode: str, cfg: dict) -> tuple[dict[str, float], int]:
     """
-    Executes a MySQL query (string) and return the memory, execution time and length of dataframe (result).
+    Executes a SQL query (string) and measures it. In latency mode the time is measured with perf_counter_ns (and
+    split in steps with split_timings, see read_sql_split), in memory mode the memory is measured (see measure_memory).
+    The connection is taken from the pool of the engine before the query is measured.
 
-    :param db_type: Database type to execute the query for.
     :param query: The query to execute
-    :return: Memory (KB) and time (seconds) needed to execute the query
+    :param engine: Engine of the database
+    :param mode: The measurement mode (see MEASUREMENT_MODES)
+    :param cfg: The settings of the query benchmarks (see get_query_metrics_config)
+    :return: The measurements (times in seconds under 'times', memory in KB under 'memories') and the length of the
+    dataframe (result)
     """
-    tracemalloc.start()
-    begin_time = time.time()
-
-    engine = make_mysql_engine(db_type)
     with engine.connect() as conn:
-        df = pd.read_sql(query, conn)
-
-    end_time = time.time()
-    current_memory, peak_memory = tracemalloc.get_traced_memory()
-    tracemalloc.stop()
+        if mode == 'memory':
+            df, measurements = measure_memory(lambda: pd.read_sql(query, conn), cfg['rss_sample_interval_ms'])
+        elif cfg['split_timings']:
+            df, measurements = read_sql_split(query, conn)
+            measurements['times'] = sum(measurements.values())
+        else:
+            begin_time = time.perf_counter_ns()
+            df = pd.read_sql(query, conn)
+            end_time = time.perf_counter_ns()
+            measurements = {'times': (end_time - begin_time) / 1e9}
     len_df = len(df)
     del df
-    return peak_memory / 1024, end_time - begin_time, len_df
+    return measurements, len_df
 
-def execute_query(db_type: DBType, query: str) -> tuple[float, float, int]:
+def execute_query(db_type: DBType, query: str, mode: str, cfg: dict) -> tuple[dict[str, float], int]:
     """
-    Executes a query (string) for a database and return the memory, execution time, and length of dataframe (result).
+    Executes a query (string) for a database and return the measurements and length of dataframe (result).
 
     :param db_type: Database type to execute the query for.
     :param query: The query to execute.
-    :return: (memory (KB), execution time (s), length of dataframe (result)))
+    :param mode: The measurement mode (see MEASUREMENT_MODES)
+    :param cfg: The settings of the query benchmarks (see get_query_metrics_config)
+    :return: (measurements, length of dataframe (result))
     """
     match db_type.get_type():
-        case DBTypes.SQLITE:
-            return execute_sqlite_query(query, db_type=db_type)
-        case DBTypes.POSTGRESQL:
-            return execute_postgres_query(query, db_type=db_type)
-        case DBTypes.MYSQL:
-            return execute_mysql_query(db_type=db_type, query=query)
+        case DBTypes.SQLITE | DBTypes.POSTGRESQL | DBTypes.MYSQL:
+            return execute_sql_query(query, engine=engine_registry.get(db_type), mode=mode, cfg=cfg)
         case DBTypes.MONGODB:
             raise ValueError("Run 'query_mongodb_metrics.py' for executing MongoDB queries.")
         case _:
             raise ValueError(f'Unknown database type: {db_type}')
 
 
-def execute_queries(queries_sql_json: dict, db_types: list[DBType], existing_queries: set = None) -> None:
+def execute_queries(queries_sql_json: dict, db_types: list[DBType], mode: str, cfg: dict, existing_queries: set = None) -> None:
     """
     Execute the full queries and save metrics.
 
     :param queries_sql_json: SQL queries to execute.
     :param db_types: List of database types to execute the queries for.
+    :param mode: The measurement mode (see MEASUREMENT_MODES)
+    :param cfg: The settings of the query benchmarks (see get_query_metrics_config)
     :param existing_queries: Set of existing queries to skip.
     """
     if existing_queries is None:
@@ -108,10 +95,17 @@ def execute_queries(queries_sql_json: dict, db_types: list[DBType], existing_que
 
     total = get_total_queries_number(queries_sql_json, db_types)
 
-    print(f'Executing {total} FULL queries. Please wait...')
+    print(f'Executing {total} FULL queries ({mode} mode). Please wait...')
     print(f'Skipping {len(existing_queries)} queries: {list(existing_queries)}')
     time.sleep(0.1)
 
+    # Connect to the databases before the queries, the setup time is saved separately from the query times
+    for db_type in db_types:
+        if engine_registry.get_setup_seconds(db_type) is None:
+            engine_registry.get(db_type)
+            update_setup_metrics(db_type=db_type, setup_time=engine_registry.get_setup_seconds(db_type),
+                                 query_metrics_file_base_name=query_metrics_file_base_name)
+
     pbar = tqdm(total=total, desc='Executing queries')
     for db_type in db_types:
         # Set the right query information
@@ -127,9 +121,9 @@ def execute_queries(queries_sql_json: dict, db_types: list[DBType], existing_que
                 if existing_queries and query['name'] in existing_queries:
                     continue
                 pbar.set_postfix_str(f"{db_type.display_name}: {query["name"]}")
-                memory, execution_time, output_length = execute_query(db_type, query['query'])
-                update_query_metrics(db_type=db_type, query_name=query['name'], memory=memory,
-                                     time=execution_time, output_length=output_length,
+                measurements, output_length = execute_query(db_type, query['query'], mode=mode, cfg=cfg)
+                update_query_metrics(db_type=db_type, query_name=query['name'], measurements=measurements,
+                                     output_length=output_length,
                                      query_metrics_file_base_name=query_metrics_file_base_name)
 
 def print_order(db_types: list[DBType]):
@@ -152,6 +146,7 @@ if __name__ == '__main__':
     os.makedirs('metrics/output', exist_ok=True)
     query_metrics_file_base_name = 'metrics/output/query_metrics'
     queries_sql_json = load_json('metrics/queries_sql.json')
+    cfg = get_query_metrics_config()
 
     for i in range(10):
         print(f'Loop {i+1} of 10...')
@@ -161,5 +156,9 @@ if __name__ == '__main__':
         db_types.append(DBType(db_type=DBTypes.MYSQL, name_suffix=name_suffix))
         print_order(db_types)
 
-        execute_queries(queries_sql_json, db_types)
+        # The time and the memory are measured in separate runs of the queries, see MEASUREMENT_MODES
+        for mode in cfg['modes']:
+            execute_queries(queries_sql_json, db_types, mode=mode, cfg=cfg)
+
+    engine_registry.dispose()
 
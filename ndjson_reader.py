@@ -0,0 +1,636 @@
+import mmap
+import os
+import queue
+import threading
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+from typing import Generator
+
+BLOCK_SIZE = 1024 * 1024  # Number of bytes read from the file at a time, larger blocks are slower to split
+ZST_MAX_WINDOW_SIZE = 2 ** 31  # The Reddit dumps are compressed with a window of 2GB (zstd --long=31)
+ZST_QUEUE_BLOCKS = 16  # Maximum number of decompressed blocks waiting to be split into lines
+COUNT_BLOCK_SIZE = 16 * 1024 * 1024  # Number of bytes read at a time when counting newlines
+COUNT_RANGE_SIZE = 256 * 1024 * 1024  # Size of the byte ranges that are counted by one worker process
+# Number of bytes in which the newlines are counted at a time when making a line index, and when finding the indexed line
+INDEX_COUNT_STEP_SIZE = 64 * 1024
+INDEX_FIND_STEP_SIZE = 4096
+
+
+def is_compressed(file_path: str) -> bool:
+    """
+    Checks if a data file is compressed with zstd (a .zst file), these are decompressed while reading.
+
+    :param file_path: path to the file
+    :return: True if the file is a .zst file
+    """
+    return file_path.endswith('.zst')
+
+
+def _make_decompressor(file_path: str):
+    """
+    Makes a zstd decompressor that can decompress the Reddit dumps.
+
+    :param file_path: path to the .zst file (only used in the error message)
+    :raises ImportError: if zstandard is not installed
+    :return: the decompressor
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f'The package zstandard is needed to read {file_path}, install it with: pip install zstandard')
+    return zstandard.ZstdDecompressor(max_window_size=ZST_MAX_WINDOW_SIZE)
+
+
+def _iter_decompressed_blocks(file_path: str, block_size: int, progress_bar=None) -> Generator[bytes, None, None]:
+    """
+    Decompresses a .zst file in a background thread, so the decompression overlaps with the parsing of the lines.
+    zstandard releases the GIL while decompressing.
+
+    :param file_path: path to the .zst file
+    :param block_size: number of decompressed bytes per block
+    :param progress_bar: optional tqdm progress bar that is updated with the number of compressed bytes read
+
+    :return: generator yielding the decompressed blocks, these don't end at line boundaries
+    """
+    decompressor = _make_decompressor(file_path)
+    blocks = queue.Queue(maxsize=ZST_QUEUE_BLOCKS)
+    stopped = threading.Event()  # Set when the reading stops early, so the thread stops too
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def decompress():
+        try:
+            with open(file_path, 'rb') as f:
+                with decompressor.stream_reader(f, read_size=block_size) as reader:
+                    compressed_position = 0
+                    while not stopped.is_set():
+                        block = reader.read(block_size)
+                        if not block:
+                            break
+                        put(block)
+                        if progress_bar is not None:
+                            progress_bar.update(f.tell() - compressed_position)
+                            compressed_position = f.tell()
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=decompress, name='zst-decompress', daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def _iter_file_blocks(file_path: str, block_size: int, progress_bar=None) -> Generator[bytes, None, None]:
+    """
+    Reads an uncompressed file in blocks.
+
+    :param file_path: path to the file
+    :param block_size: number of bytes per block
+    :param progress_bar: optional tqdm progress bar that is updated with the number of bytes read
+
+    :return: generator yielding the blocks, these don't end at line boundaries
+    """
+    with open(file_path, 'rb') as f:
+        while block := f.read(block_size):
+            if progress_bar is not None:
+                progress_bar.update(len(block))
+            yield block
+
+
+def _split_lines(blocks) -> Generator[bytes, None, None]:
+    """
+    Splits blocks of a file into lines, a line can continue in the next block.
+
+    :param blocks: the blocks of the file in order
+    :return: generator yielding the lines without the newline
+    """
+    remainder = b''  # Start of a line that continues in the next block
+    for block in blocks:
+        lines = block.split(b'\n')
+        if remainder:
+            lines[0] = remainder + lines[0]
+        remainder = lines.pop()
+        yield from lines
+    # The last line of the file doesn't always end with a newline
+    if remainder:
+        yield remainder
+
+
+def split_block_lines(block: bytes) -> list[bytes]:
+    """
+    Splits a block from iter_line_blocks into its lines.
+
+    :param block: the block, it only has complete lines
+    :return: the lines without the newline
+    """
+    lines = block.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()  # The block ends with a newline
+    return lines
+
+
+def iter_line_blocks(file_path: str, block_size: int = BLOCK_SIZE, skip_lines: int = 0) -> Generator[bytes, None, None]:
+    """
+    Reads a file (.zst files are decompressed) in blocks of roughly `block_size` bytes that end at a line boundary,
+    so the blocks can be split into lines independently (for example by worker processes), see split_block_lines.
+
+    :param file_path: path to the file
+    :param block_size: approximate number of bytes per block
+    :param skip_lines: number of lines at the start of the file that are not yielded (a compressed file can't be read
+    from a byte offset, so this is how reading continues after a number of lines)
+
+    :return: generator yielding the blocks
+    """
+    if is_compressed(file_path):
+        blocks = _iter_decompressed_blocks(file_path, block_size)
+    else:
+        blocks = _iter_file_blocks(file_path, block_size)
+
+    remainder = b''
+    for block in blocks:
+        last_newline = block.rfind(b'\n')
+        if last_newline == -1:
+            remainder += block  # A line that is longer than the block
+            continue
+        line_block = remainder + block[:last_newline + 1]
+        remainder = block[last_newline + 1:]
+        if skip_lines > 0:
+            newlines = line_block.count(b'\n')
+            if newlines <= skip_lines:
+                skip_lines -= newlines
+                continue
+            line_block = line_block[_find_nth_newline(line_block, 0, len(line_block), skip_lines) + 1:]
+            skip_lines = 0
+        yield line_block
+    if remainder and skip_lines == 0:
+        yield remainder
+
+
+def split_file_shards(file_path: str, shard_size: int, line_index=None, stop: int | None = None,
+                      start: int = 0) -> list[tuple[int, int]]:
+    """
+    Splits a file into byte ranges (shards) of roughly `shard_size` bytes.
+    Every shard starts at the beginning of a line and ends directly after a newline (or at the end of the file),
+    so each line belongs to exactly one shard. Compressed files can't be split, use iter_line_blocks for these.
+
+    :param file_path: path to the file to split
+    :param shard_size: approximate size of a shard in bytes
+    :param line_index: optional LineIndex of the file, the shards then end at the first indexed line after shard_size
+    bytes, so the file doesn't have to be read to find the ends of the lines
+    :param stop: byte offset where the last shard ends (must be the start of a line, see get_line_offset), None splits
+    the whole file
+    :param start: byte offset where the first shard starts (must be the start of a line), for example to continue
+    reading a file
+
+    :return: list of (start, end) byte offsets, end is exclusive
+    """
+    file_size = os.path.getsize(file_path) if stop is None else stop
+    shards = []
+    with open(file_path, 'rb') as f:
+        while start < file_size:
+            end = start + shard_size
+            if end >= file_size:
+                end = file_size
+            elif line_index is not None and (i := bisect_left(line_index.offsets, end)) < len(line_index) \
+                    and line_index.offsets[i] < file_size:
+                end = line_index.offsets[i]
+            else:
+                # Move the end of the shard to the end of the line it falls in
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            shards.append((start, end))
+            start = end
+    return shards
+
+
+def _iter_lines_blocks(file_path: str, start: int, stop: int | None, block_size: int) -> Generator[bytes, None, None]:
+    """
+    Reads the lines with large reads of the file, see iter_lines.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remainder = b''  # Start of a line that continues in the next block
+        while True:
+            read_size = block_size
+            if stop is not None:
+                bytes_to_stop = stop - f.tell()
+                if bytes_to_stop <= 0:
+                    # The reads don't go past the stop, so only a line that started before it still has to be finished
+                    if remainder:
+                        rest = f.readline()
+                        yield remainder + (rest[:-1] if rest.endswith(b'\n') else rest)
+                    return
+                read_size = min(block_size, bytes_to_stop)
+
+            block = f.read(read_size)
+            if not block:
+                # The last line of the file doesn't always end with a newline
+                if remainder:
+                    yield remainder
+                return
+
+            lines = block.split(b'\n')
+            if remainder:
+                lines[0] = remainder + lines[0]
+            remainder = lines.pop()
+            yield from lines
+
+
+def _iter_lines_mmap(file_path: str, start: int, stop: int | None) -> Generator[memoryview, None, None]:
+    """
+    Gets the lines as slices of a memory map of the file (without copying them), see iter_lines.
+    """
+    if os.path.getsize(file_path) == 0:
+        return  # An empty file can't be memory mapped
+    with open(file_path, 'rb') as f:
+        mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # The memory map is not closed explicitly, since the yielded lines can still refer to it.
+    # It is closed when it is garbage collected
+    view = memoryview(mapped_file)
+    file_size = len(mapped_file)
+    end = file_size if stop is None else min(stop, file_size)
+
+    position = start
+    while position < end:
+        newline = mapped_file.find(b'\n', position)
+        if newline == -1:
+            newline = file_size
+        yield view[position:newline]
+        position = newline + 1
+
+
+def iter_lines(file_path: str, start: int = 0, stop: int | None = None, max_rows: int | None = None,
+               use_mmap: bool = False, block_size: int = BLOCK_SIZE) -> Generator[bytes | memoryview, None, None]:
+    """
+    Reads the lines of a NDJSON file without decoding them to text, orjson.loads can decode the lines directly.
+    The lines don't include the newline. A .zst file is decompressed while it is read.
+
+    :param file_path: path to the file
+    :param start: byte offset of the first line (must be the start of a line, for example of a shard)
+    :param stop: byte offset where to stop, only lines that start before it are read. None reads to the end of the file
+    :param max_rows: maximum number of lines to read, None reads all lines
+    :param use_mmap: memory map the file and yield memoryview slices instead of reading blocks into bytes
+    :param block_size: number of bytes read at a time (without mmap)
+    :raises ValueError: if a start or stop offset is given for a compressed file
+
+    :return: generator yielding the lines as bytes, or as memoryview with use_mmap
+    """
+    if is_compressed(file_path):
+        if start != 0 or stop is not None:
+            raise ValueError(f'Byte offsets are not supported for compressed files: {file_path}')
+        lines = _split_lines(_iter_decompressed_blocks(file_path, block_size))
+    elif use_mmap:
+        lines = _iter_lines_mmap(file_path, start, stop)
+    else:
+        lines = _iter_lines_blocks(file_path, start, stop, block_size)
+    if max_rows is not None:
+        lines = islice(lines, max_rows)
+    return lines
+
+
+def iter_line_range(file_path: str, first_line: int, max_rows: int | None = None,
+                    line_index=None) -> Generator[bytes, None, None]:
+    """
+    Reads the lines of a file starting from a line number. With a line index the reading starts at the closest indexed
+    line before it, so at most about the interval of the index lines are skipped, instead of all lines before it.
+
+    :param file_path: path to the file
+    :param first_line: number of the first line to read (starting at 0)
+    :param max_rows: maximum number of lines to read, None reads to the end of the file
+    :param line_index: optional LineIndex of the file (not used for compressed files)
+
+    :return: generator yielding the lines as bytes
+    """
+    start_line, start = 0, 0
+    if line_index is not None and not is_compressed(file_path):
+        start_line, start = line_index.locate(first_line)
+    stop = None if max_rows is None else first_line - start_line + max_rows
+    return islice(iter_lines(file_path, start=start), first_line - start_line, stop)
+
+
+def get_line_offset(file_path: str, line_number: int, line_index=None) -> int:
+    """
+    Finds the byte offset where a line of an uncompressed file starts, for example to stop reading after a number of
+    lines. With a line index only the lines after the closest indexed line are read.
+
+    :param file_path: path to the file
+    :param line_number: number of the line (starting at 0)
+    :param line_index: optional LineIndex of the file
+
+    :return: the byte offset, the size of the file if it has less lines
+    """
+    start_line, offset = 0, 0
+    if line_index is not None:
+        start_line, offset = line_index.locate(line_number)
+    for line in islice(iter_lines(file_path, start=offset), line_number - start_line):
+        offset += len(line) + 1
+    return min(offset, os.path.getsize(file_path))
+
+
+def iter_lines_reverse(file_path: str, block_size: int = BLOCK_SIZE) -> Generator[bytes, None, None]:
+    """
+    Reads the lines of an uncompressed file from the last to the first, reading blocks from the end of the file.
+    The same lines as iter_lines are yielded (without the newline), only in reverse order.
+
+    :param file_path: path to the file
+    :param block_size: number of bytes read at a time
+    :raises ValueError: if the file is compressed (it can't be read from the end)
+
+    :return: generator yielding the lines as bytes
+    """
+    if is_compressed(file_path):
+        raise ValueError(f'Compressed files can not be read in reverse: {file_path}')
+    with open(file_path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        if position == 0:
+            return
+        remainder = b''  # End of a line that starts in an earlier block
+        at_end = True
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + remainder).split(b'\n')
+            if at_end and lines[-1] == b'':
+                lines.pop()  # The newline at the end of the file doesn't start another line
+            at_end = False
+            remainder = lines[0]
+            yield from reversed(lines[1:])
+        yield remainder
+
+
+def count_lines(file_path: str, block_size: int = BLOCK_SIZE, progress_bar=None) -> int:
+    """
+    Counts the lines of a file by counting the newlines in large blocks (.zst files are decompressed).
+    The last line is also counted when it doesn't end with a newline, the same as iter_lines.
+
+    :param file_path: path to the file
+    :param block_size: number of bytes read at a time
+    :param progress_bar: optional tqdm progress bar that is updated with the number of (compressed) bytes read
+
+    :return: number of lines in the file
+    """
+    if is_compressed(file_path):
+        blocks = _iter_decompressed_blocks(file_path, block_size, progress_bar)
+    else:
+        blocks = _iter_file_blocks(file_path, block_size, progress_bar)
+
+    line_count = 0
+    last_byte = b'\n'
+    for block in blocks:
+        line_count += block.count(b'\n')
+        last_byte = block[-1:]
+    if last_byte != b'\n':
+        line_count += 1
+    return line_count
+
+
+def count_newlines_range(file_path: str, start: int, end: int, block_size: int = COUNT_BLOCK_SIZE) -> int:
+    """
+    Counts the newlines in a byte range of an uncompressed file. The range doesn't have to start at a line,
+    so a file can be split anywhere and the counts of the ranges added up.
+
+    :param file_path: path to the file
+    :param start: byte offset of the start of the range
+    :param end: byte offset of the end of the range (exclusive)
+    :param block_size: number of bytes read at a time
+
+    :return: number of newlines in the range
+    """
+    buffer = bytearray(block_size)  # Reused for every read, so no new bytes objects are made
+    buffer_view = memoryview(buffer)
+    newlines = 0
+    with open(file_path, 'rb', buffering=0) as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            bytes_read = f.readinto(buffer_view[:min(block_size, remaining)])
+            if not bytes_read:
+                break
+            newlines += buffer.count(b'\n', 0, bytes_read)
+            remaining -= bytes_read
+    return newlines
+
+
+def _find_nth_newline(buffer: bytearray, position: int, end: int, n: int) -> int:
+    """
+    Finds the n-th newline in a buffer from `position`, there have to be at least n newlines before `end`.
+    The newlines are counted in small steps first, so only the last step is searched newline by newline.
+
+    :return: position of the newline in the buffer
+    """
+    while True:
+        step_end = min(position + INDEX_FIND_STEP_SIZE, end)
+        newlines = buffer.count(b'\n', position, step_end)
+        if newlines >= n:
+            break
+        n -= newlines
+        position = step_end
+    for _ in range(n):
+        newline = buffer.find(b'\n', position, step_end)
+        position = newline + 1
+    return newline
+
+
+def index_newlines_range(file_path: str, start: int, end: int, interval: int,
+                         block_size: int = COUNT_BLOCK_SIZE) -> tuple[int, list[int]]:
+    """
+    Counts the newlines in a byte range of an uncompressed file, the same as count_newlines_range, and also finds
+    where every `interval`-th line (counted from the start of the range) starts, for a line index.
+
+    :param file_path: path to the file
+    :param start: byte offset of the start of the range
+    :param end: byte offset of the end of the range (exclusive)
+    :param interval: number of newlines between the offsets
+    :param block_size: number of bytes read at a time
+
+    :return: number of newlines in the range, and the byte offsets directly after the interval-th, 2*interval-th, ...
+    newline of the range
+    """
+    buffer = bytearray(block_size)
+    buffer_view = memoryview(buffer)
+    newlines = 0
+    needed = interval  # Newlines until the next offset
+    line_offsets = []
+    with open(file_path, 'rb', buffering=0) as f:
+        f.seek(start)
+        block_start = start
+        while block_start < end:
+            bytes_read = f.readinto(buffer_view[:min(block_size, end - block_start)])
+            if not bytes_read:
+                break
+            position = 0
+            while position < bytes_read:
+                # Count in steps, so only the step with the next offset is searched again
+                step_end = min(position + INDEX_COUNT_STEP_SIZE, bytes_read)
+                step_newlines = buffer.count(b'\n', position, step_end)
+                if step_newlines < needed:
+                    newlines += step_newlines
+                    needed -= step_newlines
+                    position = step_end
+                    continue
+                position = _find_nth_newline(buffer, position, step_end, needed) + 1
+                line_offsets.append(block_start + position)
+                newlines += needed
+                needed = interval
+            block_start += bytes_read
+    return newlines, line_offsets
+
+
+def count_newline_checkpoints(file_path: str, start: int, workers: int, range_size: int = COUNT_RANGE_SIZE,
+                              progress_bar=None, index_interval: int | None = None
+                              ) -> tuple[list[tuple[int, int]], list[tuple[int, int]]]:
+    """
+    Counts the newlines of an uncompressed file from `start` to the end, in byte ranges that are counted by a process
+    pool. The ranges end at multiples of `range_size`, so the checkpoints are at the same offsets when the counting
+    starts again later from one of them.
+
+    :param file_path: path to the file
+    :param start: byte offset to start counting from
+    :param workers: number of worker processes, with 1 the ranges are counted in this process
+    :param range_size: number of bytes counted by a worker at a time
+    :param progress_bar: optional tqdm progress bar that is updated with the number of bytes counted
+    :param index_interval: if given, also find the offsets of lines for a line index, about every index_interval lines
+    (every index_interval-th line of each range, see index_newlines_range)
+
+    :return: list of (offset, newlines) at the end of every range, newlines is the number of newlines between start and
+    offset. The last offset is the size of the file. And a list of (newlines, offset) of the lines for the line index,
+    here newlines is the number of newlines between start and the start of the line at offset
+    """
+    file_size = os.path.getsize(file_path)
+    if start >= file_size:
+        return [(file_size, 0)], []
+    range_ends = list(range((start // range_size + 1) * range_size, file_size, range_size)) + [file_size]
+    ranges = list(zip([start] + range_ends[:-1], range_ends))
+
+    if index_interval is None:
+        count_range = count_newlines_range
+        args = ()
+    else:
+        count_range = index_newlines_range
+        args = (index_interval,)
+
+    range_results = {}
+    if workers <= 1 or len(ranges) == 1:
+        for range_start, range_end in ranges:
+            range_results[range_end] = count_range(file_path, range_start, range_end, *args)
+            if progress_bar is not None:
+                progress_bar.update(range_end - range_start)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(count_range, file_path, range_start, range_end, *args): (range_start, range_end)
+                       for range_start, range_end in ranges}
+            for future in as_completed(futures):
+                range_start, range_end = futures[future]
+                range_results[range_end] = future.result()
+                if progress_bar is not None:
+                    progress_bar.update(range_end - range_start)
+
+    checkpoints = []
+    line_offsets = []
+    newlines = 0
+    for range_end in range_ends:
+        if index_interval is None:
+            range_newlines = range_results[range_end]
+        else:
+            range_newlines, range_line_offsets = range_results[range_end]
+            line_offsets += [(newlines + (i + 1) * index_interval, offset)
+                             for i, offset in enumerate(range_line_offsets)]
+        newlines += range_newlines
+        checkpoints.append((range_end, newlines))
+    return checkpoints, line_offsets
+
+
+def ends_with_newline(file_path: str) -> bool:
+    """
+    Checks if an uncompressed file ends with a newline, if not, its last line is not counted by counting the newlines.
+
+    :param file_path: path to the file
+    :return: True if the last byte is a newline or the file is empty
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        return True
+    with open(file_path, 'rb') as f:
+        f.seek(file_size - 1)
+        return f.read(1) == b'\n'
+
+
+def count_lines_parallel(file_path: str, workers: int, range_size: int = COUNT_RANGE_SIZE, progress_bar=None) -> int:
+    """
+    Counts the lines of a file, the same as count_lines, but the file is split into byte ranges that are counted by
+    a process pool. Compressed files can't be split, these are counted with count_lines.
+
+    :param file_path: path to the file
+    :param workers: number of worker processes
+    :param range_size: number of bytes counted by a worker at a time
+    :param progress_bar: optional tqdm progress bar that is updated with the number of bytes counted
+
+    :return: number of lines in the file
+    """
+    if is_compressed(file_path):
+        return count_lines(file_path, progress_bar=progress_bar)
+    checkpoints, _ = count_newline_checkpoints(file_path, 0, workers, range_size, progress_bar)
+    newlines = checkpoints[-1][1]
+    # The last line is also counted when it doesn't end with a newline
+    return newlines + (not ends_with_newline(file_path))
+
+
+def estimate_line_count(file_path: str, samples: int = 16, sample_size: int = BLOCK_SIZE) -> int:
+    """
+    Estimates the number of lines of a file from the average number of bytes per line in blocks spread over the file,
+    for example for the total of a progress bar. A compressed file is estimated from the start of the file and the
+    compression ratio so far. Small files are counted exactly.
+
+    :param file_path: path to the file
+    :param samples: number of sampled blocks
+    :param sample_size: number of bytes per sampled block
+
+    :return: the estimated number of lines
+    """
+    file_size = os.path.getsize(file_path)
+
+    if is_compressed(file_path):
+        decompressed_size, newlines = 0, 0
+        with open(file_path, 'rb') as f:
+            # Small reads of the compressed file, so the position in it is close to what was decompressed
+            with _make_decompressor(file_path).stream_reader(f, read_size=64 * 1024) as reader:
+                while decompressed_size < samples * sample_size:
+                    block = reader.read(sample_size)
+                    if not block:
+                        return count_lines(file_path)  # The whole file is decompressed already
+                    decompressed_size += len(block)
+                    newlines += block.count(b'\n')
+                compressed_size_read = f.tell()
+        return round(newlines * file_size / compressed_size_read)
+
+    if file_size <= samples * sample_size:
+        return count_lines(file_path)
+    sampled_size, newlines = 0, 0
+    with open(file_path, 'rb') as f:
+        for i in range(samples):
+            f.seek((file_size - sample_size) * i // max(samples - 1, 1))
+            block = f.read(sample_size)
+            sampled_size += len(block)
+            newlines += block.count(b'\n')
+    if newlines == 0:
+        return 1  # No line ends in the samples, so the lines are longer than the samples
+    return round(file_size * newlines / sampled_size)